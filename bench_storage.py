@@ -0,0 +1,138 @@
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+from config import MYSQL_CONFIG, SQLITE_CONFIG, KNOWN_BRANDS
+from database import Database
+from migrations import apply_migrations
+from storage import MySQLBackend, SQLiteBackend
+from journal_queue import JournalQueue
+
+# Names that normalize to themselves, so get_corrected_brand resolves them by exact match like real captions do
+BENCH_BRANDS = [brand for brand in KNOWN_BRANDS if brand.isascii()]
+BENCH_TABLES = ("post_queue", "posts", "posts_archive", "post_deliveries", "photo_hashes", "brands", "groupss", "topics")
+
+def file_id():
+    return ''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-') for _ in range(40))
+
+def seed(db, posts):
+    for table in BENCH_TABLES:
+        db.cursor.execute(f"DELETE FROM {table}")
+    db.cursor.executemany(
+        "INSERT INTO brands (input_name, corrected_name, target_groups, target_topic) VALUES (%s, %s, %s, %s)",
+        [(brand.lower(), brand, "Bench_Client", brand) for brand in BENCH_BRANDS]
+    )
+    db.cursor.executemany(
+        "INSERT INTO groupss (group_name, group_id) VALUES (%s, %s)",
+        [("Bench_Client", -1001), ("Bench_Buyer_1", -1002), ("Bench_Buyer_2", -1003)]
+    )
+    db.cursor.executemany(
+        "INSERT INTO topics (group_name, target_topic, message_thread_id) VALUES (%s, %s, %s)",
+        [("Bench_Client", brand, i) for i, brand in enumerate(BENCH_BRANDS, 1)]
+    )
+    rows = []
+    for i in range(posts):
+        brand = random.choice(BENCH_BRANDS)
+        rows.append(("bench", i, brand, 100.0, 125.0, "-20%", "M L", f"{file_id()},{file_id()}", 10 ** 6 + i, -1001, brand, None, None, None, f"{brand} 125€ -20% M L"))
+    for start in range(0, len(rows), 1000):
+        db.cursor.executemany(
+            "INSERT INTO posts (bot_name, message_id, brand, price, original_price, adjusted_price, sizes, photo_ids, client_message_id, client_chat_id, client_topic_name, forward_from_message_id, watermarked_photo_ids, buyer_message_ids, caption) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            rows[start:start + 1000]
+        )
+    db.conn.commit()
+
+def run_post(db, queue, n, timings):
+    # The database calls one new post makes on its way from caption to persist, in bot.py order
+    user_id = 1000 + n % 7
+    photo_ids = [file_id() for _ in range(random.randint(1, 4))]
+    brand = random.choice(BENCH_BRANDS)
+    caption = f"{brand} 150€ -20% M L"
+    client_message_id = 2 * 10 ** 6 + n
+
+    def timed(name, func, *args, **kwargs):
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[name].append(time.perf_counter() - started)
+        return result
+
+    started = time.perf_counter()
+    timed("check_queue_duplicate", queue.check_queue_duplicate, user_id, photo_ids, len(photo_ids), caption)
+    timed("queue_post", queue.queue_post, user_id, photo_ids, caption, n, len(photo_ids), f"bench-{n}")
+    post_id = timed("get_pending_queue_posts", queue.get_pending_queue_posts)[-1][0]
+    corrected_brand, target_groups, target_topic = timed("get_corrected_brand", db.get_corrected_brand, brand)
+    timed("get_existing_posts", db.get_existing_posts, corrected_brand, photo_ids, 150)
+    timed("get_group_info", db.get_group_info, target_groups[0])
+    timed("get_topic_thread_id", db.get_topic_thread_id, target_groups[0], target_topic)
+    timed("log_post", db.log_post, "bench", n, corrected_brand, 150, "-20%", "M L", ','.join(photo_ids),
+          client_message_id=client_message_id, client_chat_id=-1001, client_topic_name=target_topic, caption=caption)
+    timed("log_deliveries", db.log_deliveries, -1001, client_message_id, [
+        (-1002, "Bench_Buyer_1", 3 * 10 ** 6 + n, len(photo_ids), 'sent'),
+        (-1003, "Bench_Buyer_2", 4 * 10 ** 6 + n, len(photo_ids), 'sent')
+    ])
+    timed("log_photo_hashes", db.log_photo_hashes, "bench", -1001, client_message_id, [random.getrandbits(63) for _ in photo_ids])
+    timed("update_queue_status", queue.update_queue_status, post_id, 'sent')
+    timings["per_post"].append(time.perf_counter() - started)
+
+def bench(backend, posts, seed_posts, journal_path=None):
+    db = Database(backend=backend)
+    # Measure the storage engine itself, not the in-process caches in front of it
+    db.post_cache = None
+    db.lookup_filters = None
+    apply_migrations(db)
+    seed(db, seed_posts)
+    # post_queue calls go to the journal instead of the backend when one is given
+    queue = JournalQueue(journal_path).open() if journal_path else db
+    timings = defaultdict(list)
+    for n in range(posts // 10):
+        run_post(db, queue, n, defaultdict(list))  # warm-up
+    for n in range(posts // 10, posts // 10 + posts):
+        run_post(db, queue, n, timings)
+    if queue is not db:
+        queue.close()
+    db.close()
+    return timings
+
+def ms(values, q=None):
+    if q is None:
+        return statistics.mean(values) * 1000
+    return statistics.quantiles(values, n=100)[q - 1] * 1000
+
+def report(results):
+    names = list(results)
+    methods = [method for method in next(iter(results.values())) if method != "per_post"]
+    print(f"{'':26}" + ''.join(f"{name:>16}" for name in names))
+    for label, q in (("per post mean", None), ("per post p50", 50), ("per post p95", 95)):
+        print(f"{label:26}" + ''.join(f"{ms(results[name]['per_post'], q):14.3f}ms" for name in names))
+    print()
+    for method in methods:
+        print(f"{method:26}" + ''.join(f"{ms(results[name][method]):14.3f}ms" for name in names))
+    baseline = names[0]
+    for name in names[1:]:
+        print(f"\n{name} per post is {ms(results[baseline]['per_post']) / ms(results[name]['per_post']):.1f}x faster than {baseline}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-post database time across storage backends")
+    parser.add_argument("--posts", type=int, default=500)
+    parser.add_argument("--seed-posts", type=int, default=5000, help="existing posts loaded before measuring")
+    parser.add_argument("--sqlite-path", default=None, help="defaults to a temporary file")
+    parser.add_argument("--sqlite-synchronous", default=SQLITE_CONFIG["synchronous"])
+    parser.add_argument("--mysql-database", default=None, help="scratch MySQL database; MySQL is skipped without it")
+    parser.add_argument("--journal", action="store_true", help="also run SQLite with post_queue in a journal_queue.py journal")
+    args = parser.parse_args()
+
+    results = {}
+    if args.mysql_database:
+        if args.mysql_database == MYSQL_CONFIG["database"]:
+            parser.error("refusing to benchmark against the production database, pass a scratch database")
+        results["mysql"] = bench(MySQLBackend(dict(MYSQL_CONFIG, database=args.mysql_database)), args.posts, args.seed_posts)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.sqlite_path or os.path.join(tmp, "bench.db")
+        backend = SQLiteBackend(dict(SQLITE_CONFIG, path=path, synchronous=args.sqlite_synchronous))
+        results["sqlite"] = bench(backend, args.posts, args.seed_posts)
+        if args.journal:
+            results["sqlite+journal"] = bench(backend, args.posts, args.seed_posts, os.path.join(tmp, "bench.journal"))
+    report(results)
@@ -0,0 +1,55 @@
+import hashlib
+import math
+from config import BLOOM_CONFIG
+from metrics import metrics
+
+class BloomFilter:
+    def __init__(self, capacity, false_positive_rate):
+        capacity = max(capacity, 1)
+        self.size = max(int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+# Only photo sets are filtered: file ids are issued per bot, so no other process (the other bots sharing
+# the tables, catalog_import) can write a matching row between rebuilds. Message ids, forwards and
+# post_queue entries are written by those processes too, so a miss here would be a false "not found".
+def post_keys(photo_ids, watermarked_photo_ids):
+    return [f"p:{photo_set}" for photo_set in (photo_ids, watermarked_photo_ids) if photo_set]
+
+class LookupFilters:
+    def __init__(self, capacity=None, false_positive_rate=None):
+        capacity = capacity or BLOOM_CONFIG["capacity"]
+        false_positive_rate = false_positive_rate or BLOOM_CONFIG["false_positive_rate"]
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.posts = BloomFilter(capacity, false_positive_rate)
+
+    def add_post(self, *fields):
+        for key in post_keys(*fields):
+            self.posts.add(key)
+
+    def might_have_post(self, key):
+        return self._check(self.posts, key)
+
+    @staticmethod
+    def _check(bloom, key):
+        if key in bloom:
+            metrics.incr("bloom.maybe")
+            return True
+        metrics.incr("bloom.definite_miss")
+        return False
@@ -1,16 +1,34 @@
 import asyncio
+import signal
 import sys
 import os
 import re
 import uuid
 import time
+from datetime import date, datetime, timedelta
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, InputMediaPhoto, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.exceptions import TelegramBadRequest
-from config import BOT_TOKENS, BOT_CONFIGS, PROJECT_BOT_IDS, contact_url
+from config import BOT_TOKENS, BOT_CONFIGS, PROJECT_BOT_IDS, ADMIN_IDS, WEBHOOK_CONFIG, PHASH_CONFIG, MIGRATIONS_CONFIG, DB_METRICS_CONFIG, ARCHIVE_CONFIG, BLOOM_CONFIG, PIPELINE_CONFIG, PREFETCH_CONFIG, WATCHDOG_CONFIG, PROFILER_CONFIG, WARMUP_CONFIG, QUEUE_CONFIG, contact_url
 from database import Database
-from utils import adjust_price, add_watermark, download_photo, extract_sizes, select_unique_photos
-import mysql.connector
+from storage import DatabaseError
+from migrations import apply_migrations
+from metrics import metrics
+from scheduler import FairScheduler
+from coalescer import UpdateCoalescer
+from jobs import PostJob
+from journal_queue import JournalQueue, journal_path
+from pipeline import PublishPipeline, Stage
+from prefetch import MediaPrefetcher
+from media_groups import MediaGroupAssembler
+from repricing import RepricingCampaign
+from ledger import ForwardedLedger
+from watchdog import loop_watchdog
+from profiler import profile_capture
+from tracing import tracer, current_trace, activate, span, record_span, tag_trace, UNDECIDED
+from phash import PhotoHashIndex, dhash
+from utils import adjust_price, add_watermark, download_photo, parse_caption, select_unique_photos, update_caption_price_and_percentage, http_session, close_http_session, preload_watermark
 
 BOT_NAME = os.getenv("BOT_NAME", "bella")
 if BOT_NAME not in BOT_TOKENS:
@@ -18,63 +36,22 @@ if BOT_NAME not in BOT_TOKENS:
 
 bot = Bot(token=BOT_TOKENS[BOT_NAME])
 dp = Dispatcher()
-db = Database()
+db = Database(connect=False)  # connected during warm_up()
+# Database or JournalQueue, both expose the post_queue methods
+post_queue = JournalQueue(journal_path(BOT_NAME)) if QUEUE_CONFIG["backend"] == "journal" else db
+scheduler = FairScheduler(post_queue)
+price_update_coalescer = UpdateCoalescer()
+forwarded_ledger = ForwardedLedger(db, BOT_NAME)
+photo_hash_index = PhotoHashIndex()
+publish_pipeline = None
+media_prefetcher = None
+media_group_assembler = None
 config = BOT_CONFIGS[BOT_NAME]
 router = Router()
 dp.include_router(router)
 
-media_groups = {}
 queue_lock = asyncio.Lock()
 
-def update_caption_price_and_percentage(caption, new_price, new_percentage, currency, brand=None):
-    if not caption:
-        return f"{brand or 'Unknown'} {new_price}{currency} {new_percentage}" if new_percentage else f"{brand or 'Unknown'} {new_price}{currency}"
-
-    price_pattern = r'(\d+\.?\d*)\s*([€$])'
-    percentage_pattern = r'([-+]\d+%?)'
-
-    brand_match = re.search(r'^\s*([A-Za-z\s&]+)(?:\s*[\W\s]*(?:\d+\.?\d*\s*[€$]|\s*$))?', caption, re.IGNORECASE)
-    original_brand = brand_match.group(1).strip() if brand_match else None
-
-    updated_caption = caption
-    price_match = re.search(price_pattern, caption)
-    if price_match:
-        old_price = price_match.group(1)
-        updated_caption = re.sub(
-            r'\b' + re.escape(old_price) + r'\s*' + re.escape(price_match.group(2)),
-            f"{new_price}{currency}",
-            updated_caption
-        )
-    else:
-        updated_caption = f"{updated_caption.strip()} {new_price}{currency}"
-
-    percentage_match = re.search(percentage_pattern, caption)
-    if percentage_match and new_percentage:
-        updated_caption = re.sub(
-            re.escape(percentage_match.group(0)),
-            new_percentage,
-            updated_caption
-        )
-    elif new_percentage:
-        updated_caption = f"{updated_caption.strip()} {new_percentage}"
-    elif percentage_match and not new_percentage:
-        updated_caption = re.sub(
-            re.escape(percentage_match.group(0)),
-            '',
-            updated_caption
-        ).strip()
-
-    if brand and original_brand and brand.lower() != original_brand.lower():
-        updated_caption = re.sub(
-            r'^\s*' + re.escape(original_brand) + r'\b',
-            brand,
-            updated_caption,
-            flags=re.IGNORECASE
-        )
-
-    updated_caption = updated_caption[:1024]
-    return updated_caption.strip()
-
 async def send_with_retry(func, *args, max_retries=3, **kwargs):
     for attempt in range(max_retries):
         try:
@@ -96,7 +73,68 @@ async def send_with_retry(func, *args, max_retries=3, **kwargs):
                 raise
     raise TelegramBadRequest("Max retries reached due to rate limits")
 
-async def queue_post(user_id, photo_ids, description, message_id, photo_count, batch_id, forward_from_message_id=None):
+async def edit_or_resend_post(chat_id, message_id, photo_ids, caption, reply_markup=None, message_thread_id=None):
+    # Editing the caption of the first album message is one light call; resend only when Telegram refuses the edit
+    try:
+        await send_with_retry(
+            bot.edit_message_caption,
+            chat_id=chat_id,
+            message_id=message_id,
+            caption=caption,
+            reply_markup=reply_markup
+        )
+        print(f"DEBUG - Edited caption in place: chat_id={chat_id}, message_id={message_id}")
+        return message_id
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e).lower():
+            print(f"DEBUG - Caption already up to date: chat_id={chat_id}, message_id={message_id}")
+            return message_id
+        print(f"DEBUG - Caption edit refused, falling back to resend: chat_id={chat_id}, message_id={message_id}, error={e}")
+
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except TelegramBadRequest as e:
+        print(f"DEBUG - Error deleting message before resend: chat_id={chat_id}, message_id={message_id}, error={e}")
+    await asyncio.sleep(5)
+    if len(photo_ids) > 1:
+        media_group = [
+            InputMediaPhoto(media=pid, caption=caption if i == 0 else None)
+            for i, pid in enumerate(photo_ids)
+        ]
+        sent_messages = await send_with_retry(
+            bot.send_media_group,
+            chat_id=chat_id,
+            media=media_group,
+            message_thread_id=message_thread_id
+        )
+        new_message_id = sent_messages[0].message_id
+    else:
+        sent_message = await send_with_retry(
+            bot.send_photo,
+            chat_id=chat_id,
+            photo=photo_ids[0],
+            caption=caption,
+            reply_markup=reply_markup,
+            message_thread_id=message_thread_id
+        )
+        new_message_id = sent_message.message_id
+    print(f"DEBUG - Resent post: chat_id={chat_id}, old_message_id={message_id}, new_message_id={new_message_id}")
+    return new_message_id
+
+async def queue_post(user_id, photo_ids, description, message_id, photo_count, batch_id, forward_from_message_id=None, trace=UNDECIDED):
+    if trace is UNDECIDED:
+        trace = tracer.start(user_id=user_id)
+    with activate(trace):
+        tag_trace(batch_id=batch_id)
+        with span("queue_post", photo_count=photo_count):
+            queued = await enqueue_post(user_id, photo_ids, description, message_id, photo_count, batch_id, forward_from_message_id)
+    if queued:
+        tracer.park(batch_id, trace)
+    else:
+        tracer.finish(trace, status="rejected")
+    return queued
+
+async def enqueue_post(user_id, photo_ids, description, message_id, photo_count, batch_id, forward_from_message_id=None):
     if not photo_ids:
         print(f"DEBUG - Cannot queue post with empty photo_ids: user_id={user_id}, message_id={message_id}, batch_id={batch_id}")
         await bot.send_message(user_id, "Ошибка: отсутствуют фото для поста.")
@@ -107,105 +145,207 @@ async def queue_post(user_id, photo_ids, description, message_id, photo_count, b
         await bot.send_message(user_id, "Ошибка: недействительные идентификаторы фото.")
         return False
     photo_ids_str = ','.join(sorted(valid_photo_ids))
-    if db.check_queue_duplicate(user_id, valid_photo_ids, len(valid_photo_ids), description):
+    if post_queue.check_queue_duplicate(user_id, valid_photo_ids, len(valid_photo_ids), description):
         print(f"DEBUG - Duplicate post detected: user_id={user_id}, batch_id={batch_id}, photo_ids={photo_ids_str}, photo_count={len(valid_photo_ids)}")
         await bot.send_message(user_id, "Этот пост уже отправлен.")
         return False
     try:
-        db.queue_post(user_id, valid_photo_ids, description, message_id, len(valid_photo_ids), batch_id, forward_from_message_id)
+        post_queue.queue_post(user_id, valid_photo_ids, description, message_id, len(valid_photo_ids), batch_id, forward_from_message_id)
         print(f"DEBUG - Queued post: user_id={user_id}, message_id={message_id}, batch_id={batch_id}, photo_ids={photo_ids_str}, photo_count={len(valid_photo_ids)}")
         db.clear_pending_photos(user_id, batch_id=batch_id)
         return True
-    except mysql.connector.Error as e:
+    except DatabaseError as e:
         print(f"DEBUG - Error queuing post: {e}")
         await bot.send_message(user_id, f"Ошибка при добавлении поста в очередь: {str(e)}")
         return False
 
 async def clear_stale_pending_photos(user_id):
     try:
-        db.cursor.execute(
-            "DELETE FROM pending_photos WHERE user_id = %s AND created_at < NOW() - INTERVAL 1 HOUR",
-            (user_id,)
-        )
-        db.conn.commit()
+        db.clear_stale_pending_photos(user_id)
         print(f"DEBUG - Cleared stale pending photos for user_id={user_id}")
     except Exception as e:
         print(f"Error clearing stale pending photos: {e}")
 
-async def cleanup_stale_media_groups():
+async def process_media_group(group):
+    valid_photo_ids = group.photo_ids
+    mg_id = group.media_group_id
+    batch_id = group.batch_id
+    if not valid_photo_ids:
+        print(f"DEBUG - No valid photo IDs in media group: media_group_id={mg_id}, batch_id={batch_id}")
+        await bot.send_message(group.user_id, "Ошибка: недействительные идентификаторы фото.")
+        return
+    prefetch_photos(valid_photo_ids)
+    try:
+        await db.log_pending_photo(
+            group.user_id,
+            group.message_id,
+            valid_photo_ids,
+            batch_id=batch_id,
+            media_group_id=mg_id,
+            forward_from_message_id=group.forward_from_message_id
+        )
+        print(f"DEBUG - Logged media group photos: message_id={group.message_id}, media_group_id={mg_id}, batch_id={batch_id}, photo_ids={valid_photo_ids}, photo_count={len(valid_photo_ids)}, forward_from_message_id={group.forward_from_message_id}")
+        if group.caption:
+            if await queue_post(
+                    group.user_id,
+                    valid_photo_ids,
+                    group.caption,
+                    group.message_id,
+                    len(valid_photo_ids),
+                    batch_id,
+                    group.forward_from_message_id
+            ):
+                print('Пост добавлен в очередь')
+            else:
+                await bot.send_message(group.user_id, "Ошибка: пост уже в очереди или произошла ошибка.")
+        else:
+            print('Фото получено')
+    except Exception as e:
+        print(f"DEBUG - Error logging pending photos: {e}")
+        await bot.send_message(group.user_id, f"Ошибка при сохранении фото: {str(e)}")
+
+async def report_metrics():
     while True:
-        expired = [mg_id for mg_id, data in list(media_groups.items()) if time.time() - data['timestamp'] > 300]  # 5 minutes
-        for mg_id in expired:
-            if media_groups[mg_id]['timeout_task']:
-                media_groups[mg_id]['timeout_task'].cancel()
-            del media_groups[mg_id]
-            print(f"DEBUG - Cleaned up stale media group: media_group_id={mg_id}")
-        await asyncio.sleep(60)
+        await asyncio.sleep(DB_METRICS_CONFIG["report_interval"])
+        print(metrics.format_report())
+        if WATCHDOG_CONFIG["enabled"]:
+            print(loop_watchdog.format_report())
+
+async def refresh_caches():
+    while True:
+        await asyncio.sleep(WARMUP_CONFIG["cache_refresh_interval"])
+        try:
+            db.warm_caches()
+        except Exception as e:
+            print(f"DEBUG - Error refreshing caches: {e}")
+
+async def archive_posts():
+    while True:
+        try:
+            db.archive_old_posts(ARCHIVE_CONFIG["hot_days"], ARCHIVE_CONFIG["batch_size"])
+        except Exception as e:
+            print(f"DEBUG - Error archiving posts: {e}")
+        await asyncio.sleep(ARCHIVE_CONFIG["interval"])
+
+async def rebuild_lookup_filters():
+    while True:
+        await asyncio.sleep(BLOOM_CONFIG["rebuild_interval"])
+        try:
+            db.rebuild_lookup_filters()
+        except Exception as e:
+            print(f"DEBUG - Error rebuilding lookup filters: {e}")
 
 async def process_queue():
+    queue_dirty = False
     while True:
         async with queue_lock:
-            post = db.get_next_queued_post()
+            post = scheduler.next_post()
             if not post:
-                await asyncio.sleep(1)
-                continue
-            post_id, user_id, photo_ids_str, photo_count, description, message_id, forward_from_message_id, batch_id = post
-            photo_ids = [pid for pid in photo_ids_str.split(',') if db.is_valid_file_id(pid)]
-            print(f"DEBUG - Processing queued post: post_id={post_id}, user_id={user_id}, batch_id={batch_id}, photo_ids={photo_ids}, photo_count={photo_count}")
-            if not photo_ids or len(photo_ids) != photo_count:
-                print(f"DEBUG - Invalid photo IDs or count for post_id={post_id}")
-                db.update_queue_status(post_id, 'failed')
-                await bot.send_message(user_id, f"Ошибка: недействительные фото для поста {post_id}.", reply_to_message_id=message_id)
-                await asyncio.sleep(5)
+                if queue_dirty and publish_pipeline.idle and not post_queue.get_next_queued_post():
+                    try:
+                        post_queue.clear_post_queue()
+                        queue_dirty = False
+                        print(f"DEBUG - Cleared post_queue as no pending posts remain")
+                    except Exception as e:
+                        print(f"DEBUG - Error clearing post_queue: {e}")
+                job = None
             else:
-                try:
-                    db.update_queue_status(post_id, 'processing')
-
-                    class MockMessage:
-                        def __init__(self, user_id, message_id, photo_ids, caption, forward_from_message_id):
-                            self.message_id = message_id
-                            self.from_user = type('User', (), {'id': user_id})()
-                            self.chat = type('Chat', (), {'id': user_id})()
-                            self.photo = [MockPhoto(file_id=pid) for pid in photo_ids]
-                            self.caption = caption
-                            self.forward_from = None
-                            self.forward_from_chat = None
-                            self.forward_from_message_id = forward_from_message_id
-
-                        async def reply(self, text, **kwargs):
-                            return await bot.send_message(chat_id=self.from_user.id, text=text, **kwargs)
-
-                    class MockPhoto:
-                        def __init__(self, file_id):
-                            self.file_id = file_id
-                            self.file_size = None
-
-                    mock_message = MockMessage(user_id, message_id, photo_ids, description, forward_from_message_id)
-                    await handle_photo_post(mock_message)
-                    db.update_queue_status(post_id, 'sent')
-                    print(f"DEBUG - Successfully processed queued post: post_id={post_id}, batch_id={batch_id}")
-                    await bot.send_message(
-                        user_id,
-                        f"Пост отправлен: {description[:50]}{'...' if len(description) > 50 else ''}",
-                        reply_to_message_id=message_id
-                    )
-                    await asyncio.sleep(5)
-                except Exception as e:
-                    print(f"DEBUG - Error processing queued post {post_id}: {e}")
-                    db.update_queue_status(post_id, 'failed')
-                    await bot.send_message(
-                        user_id,
-                        f"Ошибка при обработке поста {post_id}: {str(e)}",
-                        reply_to_message_id=message_id
-                    )
-                    await asyncio.sleep(5)
-            next_post = db.get_next_queued_post()
-            if not next_post:
-                try:
-                    db.clear_post_queue()
-                    print(f"DEBUG - Cleared post_queue as no pending posts remain")
-                except Exception as e:
-                    print(f"DEBUG - Error clearing post_queue: {e}")
+                queue_dirty = True
+                post_id, user_id, photo_ids_str, photo_count, description, message_id, forward_from_message_id, batch_id = post
+                photo_ids = [pid for pid in photo_ids_str.split(',') if db.is_valid_file_id(pid)]
+                print(f"DEBUG - Processing queued post: post_id={post_id}, user_id={user_id}, batch_id={batch_id}, photo_ids={photo_ids}, photo_count={photo_count}")
+                if not photo_ids or len(photo_ids) != photo_count:
+                    print(f"DEBUG - Invalid photo IDs or count for post_id={post_id}")
+                    post_queue.update_queue_status(post_id, 'failed')
+                    await bot.send_message(user_id, f"Ошибка: недействительные фото для поста {post_id}.", reply_to_message_id=message_id)
+                    job = None
+                else:
+                    post_queue.update_queue_status(post_id, 'processing')
+                    job = PostJob.from_queue_row(post, photo_ids)
+                    job.trace = tracer.resume(batch_id, user_id=user_id, batch_id=batch_id)
+                    if job.trace:
+                        job.trace.tag(post_id=post_id)
+        if job:
+            # Blocks while the send stage is full, which keeps prepare from running too far ahead
+            await publish_pipeline.submit(job)
+        elif not post:
+            await asyncio.sleep(1)
+
+async def prepare_stage(job):
+    with activate(job.trace), span("prepare"):
+        return await prepare_post(job)
+
+async def send_stage(item):
+    started_at = time.time()
+    with activate(item['job'].trace):
+        with span("wait_prepared"):
+            prepared = await item['prepared']
+        with span("send"):
+            item['post'] = await publish_post(item['job'], prepared)
+    scheduler.record_duration(time.time() - started_at)
+    return item
+
+# From here on the post is already in the client group: errors are logged per stage instead of going
+# to publish_failed, which would mark a published post as failed and tell the supplier it was not sent
+async def buyers_stage(item):
+    post = item['post']
+    if post:
+        with activate(item['job'].trace), span("buyers"):
+            try:
+                await forward_to_buyers(
+                    item['job'],
+                    post['photo_ids'],
+                    post['corrected_brand'],
+                    post['buyer_price'],
+                    post['sizes'],
+                    config["forward_to_buyers"],
+                    post['client_chat_id'],
+                    post['client_message_id'],
+                    post['buyer_caption']
+                )
+            except Exception as e:
+                print(f"DEBUG - Error forwarding published post to buyers: {item['job']}, error={e}")
+                metrics.incr("pipeline.buyers.errors")
+                tag_trace(buyers_error=str(e))
+    return item
+
+async def persist_stage(item):
+    job, post = item['job'], item['post']
+    with activate(job.trace), span("persist"):
+        if post and post['photo_hashes']:
+            try:
+                db.log_photo_hashes(BOT_NAME, post['client_chat_id'], post['client_message_id'], post['photo_hashes'])
+            except Exception as e:
+                print(f"DEBUG - Error logging photo hashes: {e}")
+        try:
+            post_queue.update_queue_status(job.post_id, 'sent')
+            print(f"DEBUG - Successfully processed queued post: post_id={job.post_id}, batch_id={job.batch_id}")
+            # A coalesced price update is still waiting in price_update_coalescer and reports back when applied
+            status = "Обновление цены запланировано" if job.message_id in forwarded_ledger.in_flight else "Пост отправлен"
+            await bot.send_message(
+                job.user_id,
+                f"{status}: {job.caption[:50]}{'...' if len(job.caption) > 50 else ''}",
+                reply_to_message_id=job.message_id
+            )
+        except Exception as e:
+            print(f"DEBUG - Error finishing processed post: post_id={job.post_id}, error={e}")
+            metrics.incr("pipeline.persist.errors")
+            tag_trace(persist_error=str(e))
+    tracer.finish(job.trace)
+    profile_capture.post_done()
+    return None
+
+async def publish_failed(item, error):
+    job = item['job']
+    if job.trace:
+        job.trace.tag(error=str(error))
+    tracer.finish(job.trace, status="failed")
+    post_queue.update_queue_status(job.post_id, 'failed')
+    await bot.send_message(
+        job.user_id,
+        f"Ошибка при обработке поста {job.post_id}: {str(error)}",
+        reply_to_message_id=job.message_id
+    )
 
 @router.message(F.photo | F.forward_from | F.forward_from_chat | F.forward_from_message_id)
 async def handle_photo(message: Message):
@@ -228,76 +368,17 @@ async def handle_photo(message: Message):
             return
 
         if message.media_group_id:
-            if message.media_group_id not in media_groups:
-                media_groups[message.media_group_id] = {
-                    'user_id': message.from_user.id,
-                    'message_id': message.message_id,
-                    'photo_ids': [],
-                    'photo_count': 0,
-                    'expected_count': photo_count,
-                    'caption': message.caption or '',
-                    'forward_from_message_id': message.forward_from_message_id,
-                    'batch_id': batch_id,
-                    'timeout_task': None,
-                    'timestamp': message.date.timestamp()
-                }
-            media_groups[message.media_group_id]['photo_ids'].extend(valid_photo_ids)
-            media_groups[message.media_group_id]['photo_ids'] = list(set(media_groups[message.media_group_id]['photo_ids']))
-            media_groups[message.media_group_id]['photo_count'] = len(media_groups[message.media_group_id]['photo_ids'])
-            if message.caption:
-                media_groups[message.media_group_id]['caption'] = message.caption
-            print(f"DEBUG - Added to media group: media_group_id={message.media_group_id}, batch_id={batch_id}, photo_ids={media_groups[message.media_group_id]['photo_ids']}, photo_count={media_groups[message.media_group_id]['photo_count']}, expected_count={media_groups[message.media_group_id]['expected_count']}")
-
-            if media_groups[message.media_group_id]['timeout_task']:
-                media_groups[message.media_group_id]['timeout_task'].cancel()
-
-            async def process_media_group(mg_id):
-                mg_data = media_groups.get(mg_id)
-                if not mg_data:
-                    return
-                start_time = time.time()
-                while mg_data['photo_count'] < mg_data['expected_count'] and time.time() - start_time < 10:
-                    await asyncio.sleep(0.5)
-                valid_photo_ids = list(set(mg_data['photo_ids']))
-                batch_id = mg_data['batch_id']
-                if not valid_photo_ids:
-                    print(f"DEBUG - No valid photo IDs in media group: media_group_id={mg_id}, batch_id={batch_id}")
-                    await bot.send_message(mg_data['user_id'], "Ошибка: недействительные идентификаторы фото.")
-                    del media_groups[mg_id]
-                    return
-                try:
-                    await db.log_pending_photo(
-                        mg_data['user_id'],
-                        mg_data['message_id'],
-                        valid_photo_ids,
-                        batch_id=batch_id,
-                        media_group_id=mg_id,
-                        forward_from_message_id=mg_data['forward_from_message_id']
-                    )
-                    print(f"DEBUG - Logged media group photos: message_id={mg_data['message_id']}, media_group_id={mg_id}, batch_id={batch_id}, photo_ids={valid_photo_ids}, photo_count={mg_data['photo_count']}, forward_from_message_id={mg_data['forward_from_message_id']}")
-                    if mg_data['caption']:
-                        if await queue_post(
-                                mg_data['user_id'],
-                                valid_photo_ids,
-                                mg_data['caption'],
-                                mg_data['message_id'],
-                                len(valid_photo_ids),
-                                batch_id,
-                                mg_data['forward_from_message_id']
-                        ):
-                            print('Пост добавлен в очередь')
-                        else:
-                            await bot.send_message(mg_data['user_id'], "Ошибка: пост уже в очереди или произошла ошибка.")
-                    else:
-                        print('Фото получено')
-                    del media_groups[mg_id]
-                except Exception as e:
-                    print(f"DEBUG - Error logging pending photos: {e}")
-                    await bot.send_message(mg_data['user_id'], f"Ошибка при сохранении фото: {str(e)}")
-                    del media_groups[mg_id]
-
-            media_groups[message.media_group_id]['timeout_task'] = asyncio.create_task(process_media_group(message.media_group_id))
+            media_group_assembler.add(
+                message.media_group_id,
+                message.from_user.id,
+                message.message_id,
+                valid_photo_ids,
+                message.caption,
+                message.forward_from_message_id,
+                batch_id
+            )
         else:
+            prefetch_photos(valid_photo_ids)
             if message.caption:
                 if await queue_post(
                         message.from_user.id,
@@ -336,6 +417,108 @@ async def handle_photo(message: Message):
             print(f"DEBUG - No photos in non-forwarded message: message_id={message.message_id}")
             await message.reply("Пожалуйста, отправьте фото или перешлите сообщение с фото.")
 
+@router.message(Command("queue"))
+async def handle_queue_status(message: Message):
+    positions = scheduler.queue_positions(message.from_user.id)
+    if not positions:
+        await message.reply("В очереди нет ваших постов.")
+        return
+    lines = [
+        f"Пост {post_id}: позиция {position + 1}, ожидание ~{int(wait_seconds // 60)} мин {int(wait_seconds % 60)} сек"
+        for post_id, position, wait_seconds in positions[:20]
+    ]
+    await message.reply("\n".join(lines))
+
+@router.message(Command("reprice"))
+async def handle_reprice(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.reply("Команда доступна только администраторам.")
+        return
+    usage = "Использование: /reprice -20% Бренд [30d]"
+    args = (command.args or "").split()
+    if not args or not re.fullmatch(r'[-+]\d+%', args[0]):
+        await message.reply(usage)
+        return
+    percentage = args[0]
+    since = None
+    if len(args) > 2 and re.fullmatch(r'\d+d', args[-1]):
+        # Day precision keeps the checkpoint key stable, so repeating the command the same day resumes it
+        since = datetime.combine(date.today() - timedelta(days=int(args[-1][:-1])), datetime.min.time())
+        args = args[:-1]
+    brand_text = ' '.join(args[1:])
+    if not brand_text:
+        await message.reply(usage)
+        return
+    corrected_brand, _, _ = db.get_corrected_brand(brand_text.lower())
+    if corrected_brand == "Unknown":
+        await message.reply(f"Бренд не найден: {brand_text}")
+        return
+    campaign = RepricingCampaign(bot, db, BOT_NAME, percentage, brand=corrected_brand, since=since)
+    await message.reply(f"Переоценка {corrected_brand} {percentage} запущена.")
+    asyncio.create_task(run_reprice_campaign(message, campaign))
+
+@router.message(Command("profile"))
+async def handle_profile(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.reply("Команда доступна только администраторам.")
+        return
+    usage = "Использование: /profile [60s | 20posts] [cprofile] [mem]"
+    seconds, posts, mode, memory = None, None, "sample", False
+    for arg in (command.args or "").lower().split():
+        if re.fullmatch(r'\d+s?', arg):
+            seconds = int(arg.rstrip('s'))
+        elif re.fullmatch(r'\d+posts?', arg):
+            posts = int(re.match(r'\d+', arg).group())
+        elif arg == "cprofile":
+            mode = "cprofile"
+        elif arg == "mem":
+            memory = True
+        else:
+            await message.reply(usage)
+            return
+    if profile_capture.busy():
+        await message.reply("Профилирование уже запущено.")
+        return
+    if posts:
+        # The capture still ends after max_seconds if the queue is quiet
+        seconds = seconds or PROFILER_CONFIG["max_seconds"]
+        await message.reply(f"Профилирование запущено до {posts} постов.")
+    else:
+        seconds = seconds or PROFILER_CONFIG["default_seconds"]
+        await message.reply(f"Профилирование запущено на {seconds} с.")
+    asyncio.create_task(run_profile_capture(message, seconds, posts, mode, memory))
+
+async def run_profile_capture(message, seconds, posts, mode, memory):
+    try:
+        report = await profile_capture.run(seconds=seconds, posts=posts, mode=mode, memory=memory, label=BOT_NAME)
+        await message.reply(report[:4000])
+    except Exception as e:
+        print(f"DEBUG - Error in profile capture: {e}")
+        await message.reply(f"Ошибка профилирования: {str(e)}")
+
+def clear_post_cache():
+    # Sent after an out-of-process repricing run so cached posts stop serving the old prices
+    if db.post_cache is not None:
+        db.post_cache.clear()
+    print("DEBUG - Post cache cleared on SIGUSR2")
+
+def start_signal_capture():
+    if profile_capture.busy():
+        print("DEBUG - Profile capture already running, SIGUSR1 ignored")
+        return
+    asyncio.create_task(profile_capture.run(memory=PROFILER_CONFIG["signal_memory"], label=f"{BOT_NAME}-signal"))
+
+async def run_reprice_campaign(message, campaign):
+    try:
+        state = await campaign.run()
+        await message.reply(
+            f"Переоценка завершена: изменено {state['edited']}, ошибок {state['failed']}, пропущено {state['skipped']}, "
+            f"у байеров изменено {state['buyer_edits']}, ошибок {state['buyer_failed']}."
+        )
+    except Exception as e:
+        print(f"DEBUG - Error in repricing campaign: {e}")
+        await message.reply(f"Ошибка переоценки: {str(e)}")
+
 @router.message(F.text | F.forward_from | F.forward_from_chat | F.forward_from_message_id)
 async def handle_text(message: Message):
     print(f"DEBUG - Received text: message_id={message.message_id}, text={message.text or 'None'}, forward_from_message_id={message.forward_from_message_id or 'None'}")
@@ -343,8 +526,11 @@ async def handle_text(message: Message):
     description = message.text or message.caption or ""
     is_forwarded = message.forward_from is not None or message.forward_from_chat is not None or message.forward_from_message_id is not None
 
+    current_trace.set(tracer.start(user_id=user_id, message_id=message.message_id))
+
     await clear_stale_pending_photos(user_id)
 
+    pairing_started = time.perf_counter()
     max_attempts = 10
     for attempt in range(max_attempts):
         pending = db.get_pending_photos(user_id)
@@ -356,6 +542,7 @@ async def handle_text(message: Message):
     if not pending:
         print(f"DEBUG - No pending photos found after retries for user_id={user_id}")
         await message.reply("Пожалуйста, сначала отправьте фото товара.")
+        tracer.finish(current_trace.get(), status="no_photos")
         return
 
     batch_groups = {}
@@ -368,6 +555,7 @@ async def handle_text(message: Message):
     if not batch_groups:
         print(f"DEBUG - No batch groups formed for user_id={user_id}")
         await message.reply("Ошибка: не удалось найти ожидающие фото.")
+        tracer.finish(current_trace.get(), status="no_batch")
         return
 
     # Сортируем по времени создания (created_at) и выбираем самую раннюю пару
@@ -391,10 +579,12 @@ async def handle_text(message: Message):
     latest_message_id = max(message_ids) if message_ids else message.message_id
 
     print(f"DEBUG - Processed batch: user_id={user_id}, batch_id={batch_id}, photo_ids={photo_ids}, photo_count={photo_count}, message_ids={message_ids}")
+    record_span("pair_photos", pairing_started, time.perf_counter(), attempts=attempt + 1, batch_id=batch_id)
     if not photo_ids:
         print(f"DEBUG - No valid photo IDs in batch_id={batch_id}, user_id={user_id}")
         await message.reply("Ошибка: сохраненные изображения имеют невалидные идентификаторы.")
         db.clear_pending_photos(user_id, batch_id=batch_id)
+        tracer.finish(current_trace.get(), status="invalid_photos")
         return
 
     if await queue_post(
@@ -404,7 +594,8 @@ async def handle_text(message: Message):
             latest_message_id,
             photo_count,
             batch_id,
-            message.forward_from_message_id if is_forwarded else selected_forward_from_message_id
+            message.forward_from_message_id if is_forwarded else selected_forward_from_message_id,
+            trace=current_trace.get()
     ):
         print('Пост добавлен в очередь!')
         print(f"DEBUG - Successfully queued post for batch_id={batch_id}, user_id={user_id}, photo_ids={photo_ids}")
@@ -416,9 +607,7 @@ async def handle_text(message: Message):
 
     pending_count = 0
     try:
-        db.cursor.execute("SELECT COUNT(*) FROM pending_photos WHERE user_id = %s", (user_id,))
-        pending_count = db.cursor.fetchone()[0]
-        db.conn.commit()
+        pending_count = db.count_pending_photos(user_id)
         print(f"DEBUG - Checked pending_photos for user_id={user_id}, count={pending_count}")
     except Exception as e:
         print(f"DEBUG - Error checking pending_photos: {e}")
@@ -427,9 +616,7 @@ async def handle_text(message: Message):
     if pending_count == 0:
         total_queued = 0
         try:
-            db.cursor.execute("SELECT COUNT(*) FROM post_queue WHERE user_id = %s", (user_id,))
-            total_queued = db.cursor.fetchone()[0]
-            db.conn.commit()
+            total_queued = post_queue.count_queued_posts(user_id)
             print(f"DEBUG - Queried post_queue for user_id={user_id}, total_queued={total_queued}")
         except Exception as e:
             print(f"DEBUG - Error querying post_queue: {e}")
@@ -444,36 +631,138 @@ async def handle_text(message: Message):
             await bot.delete_message(user_id, summary_message.message_id)
         except Exception as e:
             print(f"DEBUG - Error deleting summary message: {e}")
-async def handle_photo_post(message: Message):
-    print(f"DEBUG - Processing photo post: message_id={message.message_id}, caption={message.caption or ''}, photo_count={len(message.photo) if message.photo else 0}")
-    description = message.caption or ""
-    photo_ids = select_unique_photos(message.photo) if message.photo else []
+async def notify(job, text):
+    return await bot.send_message(chat_id=job.user_id, text=text)
+
+def resolve_target(corrected_brand, target_groups, target_topic):
+    if config["sort_by_brand"]:
+        if corrected_brand == "Unknown":
+            return None, None, "Не удалось определить бренд."
+        if not target_groups or not target_topic:
+            return None, None, f"Группа или тема не найдены для бренда: {corrected_brand}"
+        return target_groups[0], target_topic, None
+    if not config["target_group"] or not config["target_topic"]:
+        return None, None, "Отсутствует конфигурация группы или темы."
+    return config["target_group"], config["target_topic"], None
+
+async def download_and_hash(photo_id):
+    with span("download", photo_id=photo_id[-12:]):
+        photo_data = await download_photo(photo_id, bot)
+    if not photo_data:
+        return None, None
+    with span("dhash", photo_id=photo_id[-12:]):
+        photo_hash = await asyncio.to_thread(dhash, photo_data) if PHASH_CONFIG["enabled"] else None
+    return photo_hash, photo_data
+
+async def render_photo(photo_id, watermark_text):
+    photo_hash, photo_data = await download_and_hash(photo_id)
+    if not photo_data:
+        return None, None
+    with span("watermark", photo_id=photo_id[-12:], bytes=len(photo_data)):
+        return photo_hash, await add_watermark(photo_data, watermark_text)
+
+async def take_or_hash_photo(photo_id, watermark_text):
+    # (photo_hash, photo_data, watermarked_data); prefetched photos arrive already watermarked
+    if media_prefetcher:
+        with span("prefetch_take", photo_id=photo_id[-12:]):
+            prefetched = await media_prefetcher.take(photo_id, watermark_text)
+        if prefetched:
+            return prefetched[0], None, prefetched[1]
+    photo_hash, photo_data = await download_and_hash(photo_id)
+    return photo_hash, photo_data, None
+
+async def watermark_photos(photo_ids, photos, watermark_text):
+    if photos is None:
+        photos = await asyncio.gather(*(take_or_hash_photo(photo_id, watermark_text) for photo_id in photo_ids))
+
+    async def finish(photo_id, photo_data, watermarked_data):
+        if watermarked_data is None and photo_data:
+            with span("watermark", photo_id=photo_id[-12:], bytes=len(photo_data)):
+                watermarked_data = await add_watermark(photo_data, watermark_text)
+        return watermarked_data
+
+    rendered = await asyncio.gather(*(finish(photo_id, photo_data, watermarked_data)
+                                      for photo_id, (_, photo_data, watermarked_data) in zip(photo_ids, photos)))
+    watermarked_photos = []
+    for i, (photo_id, watermarked_data) in enumerate(zip(photo_ids, rendered)):
+        if watermarked_data:
+            watermarked_photos.append(BufferedInputFile(watermarked_data, filename=f"photo_{i}.jpg"))
+        else:
+            print(f"ERROR - Failed watermarking photo {photo_id}")
+            watermarked_photos.append(photo_id)
+    return watermarked_photos
+
+def prefetch_photos(photo_ids):
+    if media_prefetcher:
+        media_prefetcher.prefetch(photo_ids)
+
+async def prepare_post(job):
+    description = job.caption
+    photo_ids = list(dict.fromkeys(job.photo_ids))
+    brand, price, currency, sizes, original_percentage = parse_caption(description)
+    print(f"DEBUG - Extracted: brand={brand}, price={price}, currency={currency}, sizes={sizes}, original_percentage={original_percentage}")
+    with span("resolve_brand", brand=brand):
+        corrected_brand, target_groups, target_topic = db.get_corrected_brand(brand.lower())
+        if corrected_brand == "Unknown" and brand != "Unknown":
+            cleaned_brand = re.sub(r'[^\w\s]', '', brand.lower())
+            corrected_brand, target_groups, target_topic = db.get_corrected_brand(cleaned_brand)
+    print(f"DEBUG - Corrected brand: {corrected_brand}")
+    prepared = {
+        'description': description,
+        'photo_ids': photo_ids,
+        'price': price,
+        'currency': currency,
+        'sizes': sizes,
+        'original_percentage': original_percentage,
+        'corrected_brand': corrected_brand,
+        'target_groups': target_groups,
+        'target_topic': target_topic,
+        'photo_hashes': [],
+        'photos': None,
+        'watermarked_photos': None
+    }
+    target_group, _, error = resolve_target(corrected_brand, target_groups, target_topic)
+    if job.forward_from_message_id or not photo_ids or error or not config.get("add_watermark"):
+        return prepared
+
+    started_at = time.time()
+    # Reposts are answered by updating the existing post, so they skip the watermark work entirely;
+    # publish_post repeats both checks and renders after all if a match no longer resolves
+    if db.get_existing_posts(corrected_brand, photo_ids, price, job.message_id):
+        print(f"DEBUG - Skipping watermark for known photo set: message_id={job.message_id}")
+        return prepared
+    photos = await asyncio.gather(*(take_or_hash_photo(photo_id, target_group) for photo_id in photo_ids))
+    if PHASH_CONFIG["enabled"]:
+        prepared['photo_hashes'] = [photo_hash for photo_hash, _, _ in photos if photo_hash is not None]
+    if photo_hash_index.find_match(prepared['photo_hashes']):
+        print(f"DEBUG - Skipping watermark for likely repost: message_id={job.message_id}")
+        prepared['photos'] = photos
+        return prepared
+    prepared['watermarked_photos'] = await watermark_photos(photo_ids, photos, target_group)
+    metrics.observe("pipeline.prepare_media", time.time() - started_at)
+    return prepared
+
+async def publish_post(job, prepared=None):
+    if prepared is None:
+        prepared = await prepare_post(job)
+    print(f"DEBUG - Processing photo post: {job}, caption={job.caption}")
+    description = prepared['description']
+    photo_ids = prepared['photo_ids']
+    price = prepared['price']
+    currency = prepared['currency']
+    sizes = prepared['sizes']
+    original_percentage = prepared['original_percentage']
+    corrected_brand = prepared['corrected_brand']
     print(f"DEBUG - Processed photo IDs: {photo_ids}, count={len(photo_ids)}")
     if not photo_ids:
-        print(f"DEBUG - No valid photo IDs in handle_photo_post: message_id={message.message_id}")
-        await message.reply("Ошибка: Недействительные идентификаторы фото.")
-        return
+        print(f"DEBUG - No valid photo IDs in publish_post: message_id={job.message_id}")
+        await notify(job, "Ошибка: Недействительные идентификаторы фото.")
+        return None
 
-    existing_post = db.get_post_by_message_id(message.message_id)
+    existing_post = db.get_post_by_message_id(job.message_id)
     if existing_post:
-        print(f"DEBUG - Post with message_id={message.message_id} already exists, skipping")
-        return
-
-    brand_match = re.search(r'^\s*([A-Za-z\s&]+)(?:\s*[\W\s]*(?:\d+\.?\d*\s*[€$]|\s*$))?', description, re.IGNORECASE)
-    brand = brand_match.group(1).strip() if brand_match else "Unknown"
-    price_match = re.search(r'(\d+\.?\d*)\s*([€$])', description)
-    price = float(price_match.group(1)) if price_match else None
-    currency = price_match.group(2) if price_match else '€'
-    sizes = extract_sizes(description)
-    percentage_match = re.search(r'([-+]\d+%?)', description)
-    original_percentage = percentage_match.group(0) if percentage_match else None
-    print(f"DEBUG - Extracted: brand={brand}, price={price}, currency={currency}, sizes={sizes}, original_percentage={original_percentage}")
-    is_forwarded = message.forward_from is not None or message.forward_from_chat is not None or message.forward_from_message_id is not None
-    corrected_brand, target_groups, target_topic = db.get_corrected_brand(brand.lower())
-    if corrected_brand == "Unknown" and brand != "Unknown":
-        cleaned_brand = re.sub(r'[^\w\s]', '', brand.lower())
-        corrected_brand, target_groups, target_topic = db.get_corrected_brand(cleaned_brand)
-    print(f"DEBUG - Corrected brand: {corrected_brand}")
+        print(f"DEBUG - Post with message_id={job.message_id} already exists, skipping")
+        return None
 
     if contact_url == "https://t.me/your_contact":
         print("WARNING - Placeholder URL detected. Replace 'https://t.me/your_contact' with a valid Telegram link.")
@@ -481,33 +770,30 @@ async def handle_photo_post(message: Message):
         [InlineKeyboardButton(text="Написать", url=contact_url)]
     ])
 
-    if is_forwarded and message.forward_from_message_id:
-        db.clear_stale_forwarded_posts(message.from_user.id)
-        post = None
-        if message.forward_from_message_id:
-            post = db.get_post_by_forward_from_message_id(message.forward_from_message_id)
+    if job.forward_from_message_id:
+        post = db.get_post_by_forward_from_message_id(job.forward_from_message_id)
         if not post and price:
             post = db.get_post_by_caption(corrected_brand, price)
         if not post and photo_ids:
             post = db.get_post_by_photo_id(photo_ids[0], corrected_brand)
         if not post:
-            await message.reply("Исходный пост не найден.")
+            await notify(job, "Исходный пост не найден.")
             print(f"DEBUG - No post found for forwarded post")
-            return
+            return None
 
         brand, current_price, original_price, photo_ids_db, client_message_id, client_chat_id, client_topic_name, sizes_db = post
         print(f"DEBUG - Found post: client_message_id={client_message_id}")
         if not client_message_id or not client_chat_id:
-            await message.reply("В посте отсутствуют данные для обновления.")
-            return
+            await notify(job, "В посте отсутствуют данные для обновления.")
+            return None
         if not original_price:
-            await message.reply("Отсутствует исходная цена.")
-            return
+            await notify(job, "Отсутствует исходная цена.")
+            return None
 
         adjusted_price, percentage, adjusted_currency = adjust_price(description) if config["adjust_price"] else (original_price, None, currency)
         if not adjusted_price:
-            await message.reply("Не удалось определить цену.")
-            return
+            await notify(job, "Не удалось определить цену.")
+            return None
 
         client_percentage = f"{percentage}" if percentage else None
         client_caption = update_caption_price_and_percentage(description, adjusted_price, client_percentage, adjusted_currency, corrected_brand)
@@ -516,202 +802,110 @@ async def handle_photo_post(message: Message):
             client_caption = f"{client_caption}\n\nНаписать: {contact_url}"[:1024]
             print(f"DEBUG - Appended link to caption for forwarded media group post: caption={client_caption}")
 
-        print(f"DEBUG - Processing forwarded client post: client_message_id={client_message_id}")
-
-        try:
-            await bot.delete_message(chat_id=client_chat_id, message_id=client_message_id)
-            await asyncio.sleep(5)
-            if len(photo_ids) > 1:
-                media_group = [
-                    InputMediaPhoto(
-                        media=pid,
-                        caption=client_caption if i == 0 else None
-                    )
-                    for i, pid in enumerate(photo_ids)
-                ]
-                print(f"DEBUG - Sending media group to client with link in caption: photos={len(photo_ids)}, caption={client_caption}")
-                sent_messages = await send_with_retry(
-                    bot.send_media_group,
-                    chat_id=client_chat_id,
-                    media=media_group,
-                    message_thread_id=db.get_topic_thread_id(client_chat_id, client_topic_name)
-                )
-                new_client_message_id = sent_messages[0].message_id
-                print(f"DEBUG - Sent media group to client: new_message_id={new_client_message_id}")
-            else:
-                print(f"DEBUG - Sending single photo to client with keyboard: caption={client_caption}")
-                sent_message = await send_with_retry(
-                    bot.send_photo,
-                    chat_id=client_chat_id,
-                    photo=photo_ids[0],
-                    caption=client_caption,
-                    reply_markup=client_keyboard,
-                    message_thread_id=db.get_topic_thread_id(client_chat_id, client_topic_name)
+        async def apply_update(current_client_message_id):
+            print(f"DEBUG - Processing forwarded client post: client_message_id={current_client_message_id}")
+            try:
+                # An earlier update may have resent the album and moved the post to a new message id
+                current_post = db.get_post_by_client_message_id(current_client_message_id)
+                if not current_post:
+                    await notify(job, "Исходный пост не найден.")
+                    return
+                current_chat_id, current_topic_name = current_post[5], current_post[6]
+                new_client_message_id = await edit_or_resend_post(
+                    current_chat_id,
+                    current_client_message_id,
+                    photo_ids,
+                    client_caption,
+                    reply_markup=client_keyboard if len(photo_ids) == 1 else None,
+                    message_thread_id=db.get_topic_thread_id(current_chat_id, current_topic_name)
                 )
-                new_client_message_id = sent_message.message_id
-                print(f"DEBUG - Sent single photo to client: new_message_id={new_client_message_id}")
-
-            db.update_post_price(new_client_message_id, adjusted_price, percentage)
-            print(f"DEBUG - Replaced client post {client_message_id} with new message_id={new_client_message_id}")
-
-            post = db.get_post_by_client_message_id(client_message_id)
-            if post:
-                _, _, _, _, _, _, _, _, buyer_message_ids_str = post
-                if buyer_message_ids_str:
-                    buyer_message_ids = buyer_message_ids_str.split(',')
-                    buyer_price = int(original_price)  # Ensure integer price for buyers
-                    buyer_currency = adjusted_currency
-                    buyer_caption = update_caption_price_and_percentage(description, buyer_price, original_percentage, buyer_currency, corrected_brand)
-                    for idx, buyer_group in enumerate(config["forward_to_buyers"]):
-                        if idx < len(buyer_message_ids):
-                            buyer_message_id = buyer_message_ids[idx]
-                            buyer_chat_id = db.get_group_info(buyer_group)
-                            if buyer_chat_id:
-                                try:
-                                    await bot.delete_message(chat_id=buyer_chat_id, message_id=int(buyer_message_id))
-                                    await asyncio.sleep(5)
-                                    if len(photo_ids) > 1:
-                                        media_group = [
-                                            InputMediaPhoto(media=pid, caption=buyer_caption if i == 0 else None)
-                                            for i, pid in enumerate(photo_ids)
-                                        ]
-                                        sent_buyer = await send_with_retry(
-                                            bot.send_media_group,
-                                            chat_id=buyer_chat_id,
-                                            media=media_group
-                                        )
-                                        new_buyer_message_id = sent_buyer[0].message_id
-                                        print(f"DEBUG - Sent media group to buyer: group={buyer_group}, message_id={new_buyer_message_id}")
-                                    else:
-                                        sent_buyer_message = await send_with_retry(
-                                            bot.send_photo,
-                                            chat_id=buyer_chat_id,
-                                            photo=photo_ids[0],
-                                            caption=buyer_caption
-                                        )
-                                        new_buyer_message_id = sent_buyer_message.message_id
-                                        print(f"DEBUG - Sent single photo to buyer: group={buyer_group}, message_id={new_buyer_message_id}")
-                                    buyer_message_ids[idx] = str(new_buyer_message_id)
-                                    print(f"DEBUG - Replaced buyer post in {buyer_group}")
-                                    await asyncio.sleep(5)
-                                except TelegramBadRequest as e:
-                                    print(f"DEBUG - Error updating buyer post: {e}")
-                    buyer_message_ids_str = ','.join(buyer_message_ids)
-                    db.cursor.execute(
-                        "UPDATE posts SET buyer_message_ids = %s, client_message_id = %s WHERE client_message_id = %s",
-                        (buyer_message_ids_str, new_client_message_id, client_message_id)
+                db.update_post_price(current_client_message_id, adjusted_price, percentage)
+                print(f"DEBUG - Updated client post {current_client_message_id}, current message_id={new_client_message_id}")
+
+                buyer_price = int(original_price)  # Ensure integer price for buyers
+                buyer_caption = update_caption_price_and_percentage(description, buyer_price, original_percentage, adjusted_currency, corrected_brand)
+                updated_deliveries = await update_buyer_deliveries(current_chat_id, current_client_message_id, photo_ids, buyer_caption)
+                if new_client_message_id != current_client_message_id:
+                    db.update_post_client_message_id(current_client_message_id, new_client_message_id)
+                    db.rekey_deliveries(current_chat_id, current_client_message_id, new_client_message_id)
+                    db.rekey_photo_hashes(BOT_NAME, current_chat_id, current_client_message_id, new_client_message_id)
+                    photo_hash_index.rekey(current_chat_id, current_client_message_id, new_client_message_id)
+                    price_update_coalescer.rename(current_client_message_id, new_client_message_id)
+                await notify(job, f"Пост успешно обработан: {client_caption}")
+                if not updated_deliveries:
+                    # Buyers never received this post, so fan it out now
+                    await forward_to_buyers(
+                        job,
+                        photo_ids,
+                        corrected_brand,
+                        buyer_price,
+                        sizes,
+                        config["forward_to_buyers"],
+                        current_chat_id,
+                        new_client_message_id,
+                        buyer_caption
                     )
-                    db.conn.commit()
-            db.log_forwarded_post(
-                user_id=message.from_user.id,
-                bot_name=BOT_NAME,
-                message_id=message.message_id,
-                brand=corrected_brand,
-                photo_ids=photo_ids,
-                caption=client_caption,
-                forward_from_message_id=message.forward_from_message_id,
-                client_message_id=new_client_message_id
-            )
-            db.delete_forwarded_post(message.message_id)
-            await message.reply(f"Пост успешно обработан: {client_caption}")
-            await forward_to_buyers(
-                message,
-                photo_ids,
-                corrected_brand,
-                int(original_price),  # Ensure integer price for buyers
-                sizes,
-                config["forward_to_buyers"],
-                new_client_message_id,
-                buyer_caption
-            )
-        except TelegramBadRequest as e:
-            print(f"DEBUG - Telegram error updating post: {e}")
-            await message.reply(f"Ошибка при отправке поста: {str(e)}")
-            db.delete_forwarded_post(message.message_id)
-        return
+            except TelegramBadRequest as e:
+                print(f"DEBUG - Telegram error updating post: {e}")
+                await notify(job, f"Ошибка при отправке поста: {str(e)}")
+            finally:
+                forwarded_ledger.finish(job.message_id)
+
+        async def notify_superseded():
+            forwarded_ledger.finish(job.message_id)
+            await notify(job, "Обновление цены заменено более новым и не применено.")
+
+        forwarded_ledger.begin(
+            user_id=job.user_id,
+            message_id=job.message_id,
+            brand=corrected_brand,
+            photo_ids=photo_ids,
+            caption=client_caption,
+            forward_from_message_id=job.forward_from_message_id,
+            client_message_id=client_message_id
+        )
+        await price_update_coalescer.submit(client_message_id, apply_update, notify_superseded)
+        return None
 
-    if config["sort_by_brand"]:
-        if corrected_brand == "Unknown":
-            await message.reply("Не удалось определить бренд.")
-            return
-        if not target_groups or not target_topic:
-            await message.reply(f"Группа или тема не найдены для бренда: {corrected_brand}")
-            return
-        target_group = target_groups[0]
-    else:
-        target_group = config["target_group"]
-        target_topic = config["target_topic"]
-        if not target_group or not target_topic:
-            await message.reply("Отсутствует конфигурация группы или темы.")
-            return
+    target_group, target_topic, error = resolve_target(corrected_brand, prepared['target_groups'], prepared['target_topic'])
+    if error:
+        await notify(job, error)
+        return None
 
-    existing_posts = db.get_existing_posts(corrected_brand, photo_ids, price, message.message_id)
+    existing_posts = db.get_existing_posts(corrected_brand, photo_ids, price, job.message_id)
     if existing_posts:
-        for client_message_id, client_chat_id, client_topic_name, _, existing_sizes in existing_posts:
-            adjusted_price, percentage, adjusted_currency = adjust_price(description) if config["adjust_price"] else (price, None, currency)
-            if not adjusted_price:
-                await message.reply("Не удалось определить цену для обновления поста.")
-                return
-            client_percentage = f"{percentage}" if percentage else None
-            client_caption = update_caption_price_and_percentage(description, adjusted_price, client_percentage, adjusted_currency, corrected_brand)
-            try:
-                await bot.edit_message_caption(
-                    chat_id=client_chat_id,
-                    message_id=client_message_id,
-                    caption=client_caption
-                )
-                db.update_post_price(client_message_id, adjusted_price, percentage)
-                buyer_price = int(price)  # Ensure integer price for buyers
-                buyer_currency = currency
-                buyer_caption = update_caption_price_and_percentage(description, buyer_price, original_percentage, buyer_currency, corrected_brand)
-                await forward_to_buyers(
-                    message,
-                    photo_ids,
-                    corrected_brand,
-                    buyer_price,
-                    sizes,
-                    config["forward_to_buyers"],
-                    client_message_id,
-                    buyer_caption
-                )
-                print(f"DEBUG - Updated existing client post: message_id={client_message_id}")
-                return
-            except TelegramBadRequest as e:
-                if "message is not modified" in str(e):
-                    await message.reply("Описание поста не изменено.")
-                    print(f"DEBUG - Message not modified for client post: message_id={client_message_id}")
-                else:
-                    await message.reply(f"Ошибка при обновлении поста: {str(e)}")
-                    print(f"DEBUG - Error updating client post: {e}")
-                return
+        await update_existing_post(job, existing_posts[0], description, photo_ids, price, currency, original_percentage, sizes, corrected_brand)
+        return None
 
-    watermarked_photos = []
     watermarked_photo_ids = [None] * len(photo_ids)
+    photo_hashes = prepared['photo_hashes']
     if config.get("add_watermark"):
-        for i, photo_id in enumerate(photo_ids):
-            try:
-                photo_data = await download_photo(photo_id, bot)
-                watermarked_data = await add_watermark(photo_data, target_group)
-                watermarked_file = BufferedInputFile(watermarked_data, filename=f"photo_{i}.jpg")
-                watermarked_photos.append(watermarked_file)
-            except Exception as e:
-                print(f"ERROR - Failed watermarking photo {photo_id}: {e}")
-                watermarked_photos.append(photo_id)
+        if photo_hashes:
+            matched = photo_hash_index.find_match(photo_hashes)
+            if matched:
+                existing_post = db.get_existing_post_by_client_message_id(*matched)
+                if existing_post:
+                    print(f"DEBUG - Repost detected by image hash, updating existing post: client_chat_id={matched[0]}, client_message_id={matched[1]}")
+                    await update_existing_post(job, existing_post, description, photo_ids, price, currency, original_percentage, sizes, corrected_brand)
+                    return None
+        watermarked_photos = prepared['watermarked_photos']
+        if watermarked_photos is None:
+            watermarked_photos = await watermark_photos(photo_ids, prepared['photos'], target_group)
     else:
         watermarked_photos = photo_ids.copy()
 
     chat_id = db.get_group_info(target_group)
     if not chat_id:
-        await message.reply(f"Группа {target_group} не найдена.")
-        return
+        await notify(job, f"Группа {target_group} не найдена.")
+        return None
 
     message_thread_id = db.get_topic_thread_id(target_group, target_topic)
     print(f"DEBUG - Sending to client group: {target_group}, chat_id={chat_id}, topic={target_topic}, message_thread_id={message_thread_id}, photo_count={len(photo_ids)}")
 
     adjusted_price, percentage, adjusted_currency = adjust_price(description) if config["adjust_price"] else (price, None, currency)
     if not adjusted_price:
-        await message.reply("Не удалось определить цену для поста.")
-        return
+        await notify(job, "Не удалось определить цену для поста.")
+        return None
 
     client_percentage = f"{percentage}" if percentage else None
     client_caption = update_caption_price_and_percentage(description, adjusted_price, client_percentage, adjusted_currency, corrected_brand)
@@ -723,60 +917,47 @@ async def handle_photo_post(message: Message):
     print(f"DEBUG - Preparing to send new client post: caption={client_caption}")
 
     try:
-        await asyncio.sleep(5)
-        if len(watermarked_photos) > 1:
-            media_group = [
-                InputMediaPhoto(
-                    media=photo,
-                    caption=client_caption if i == 0 else None
+        await asyncio.sleep(PIPELINE_CONFIG["send_interval"])
+        with span("send_client", chat_id=chat_id, photos=len(watermarked_photos)):
+            if len(watermarked_photos) > 1:
+                media_group = [
+                    InputMediaPhoto(
+                        media=photo,
+                        caption=client_caption if i == 0 else None
+                    )
+                    for i, photo in enumerate(watermarked_photos)
+                ]
+                print(f"DEBUG - Sending media group to client with link in caption: photos={len(watermarked_photos)}, caption={client_caption}")
+                sent_messages = await send_with_retry(
+                    bot.send_media_group,
+                    chat_id=chat_id,
+                    media=media_group,
+                    message_thread_id=message_thread_id
                 )
-                for i, photo in enumerate(watermarked_photos)
-            ]
-            print(f"DEBUG - Sending media group to client with link in caption: photos={len(watermarked_photos)}, caption={client_caption}")
-            sent_messages = await send_with_retry(
-                bot.send_media_group,
-                chat_id=chat_id,
-                media=media_group,
-                message_thread_id=message_thread_id
-            )
-            sent_message = sent_messages[0]
-            print(f"DEBUG - Sent media group to client: message_id={sent_message.message_id}")
-            if config["add_watermark"]:
-                watermarked_photo_ids = [msg.photo[-1].file_id for msg in sent_messages if msg.photo]
-        else:
-            print(f"DEBUG - Sending single photo to client with keyboard: caption={client_caption}")
-            sent_message = await send_with_retry(
-                bot.send_photo,
-                chat_id=chat_id,
-                photo=watermarked_photos[0],
-                caption=client_caption,
-                reply_markup=client_keyboard,
-                message_thread_id=message_thread_id
-            )
-            print(f"DEBUG - Sent single photo to client: message_id={sent_message.message_id}")
-            if config["add_watermark"] and sent_message.photo:
-                watermarked_photo_ids[0] = sent_message.photo[-1].file_id
+                sent_message = sent_messages[0]
+                print(f"DEBUG - Sent media group to client: message_id={sent_message.message_id}")
+                if config["add_watermark"]:
+                    watermarked_photo_ids = [msg.photo[-1].file_id for msg in sent_messages if msg.photo]
+            else:
+                print(f"DEBUG - Sending single photo to client with keyboard: caption={client_caption}")
+                sent_message = await send_with_retry(
+                    bot.send_photo,
+                    chat_id=chat_id,
+                    photo=watermarked_photos[0],
+                    caption=client_caption,
+                    reply_markup=client_keyboard,
+                    message_thread_id=message_thread_id
+                )
+                print(f"DEBUG - Sent single photo to client: message_id={sent_message.message_id}")
+                if config["add_watermark"] and sent_message.photo:
+                    watermarked_photo_ids[0] = sent_message.photo[-1].file_id
 
+        tag_trace(client_message_id=sent_message.message_id)
         print(f"DEBUG - Successfully sent to client group {target_group}: message_id={sent_message.message_id}")
-        await asyncio.sleep(5)
-
-        buyer_price = int(price)  # Ensure integer price for buyers
-        buyer_currency = currency
-        buyer_caption = update_caption_price_and_percentage(description, buyer_price, original_percentage, buyer_currency, corrected_brand)
-        await forward_to_buyers(
-            message,
-            photo_ids,
-            corrected_brand,
-            buyer_price,
-            sizes,
-            config["forward_to_buyers"],
-            sent_message.message_id,
-            buyer_caption
-        )
-
+        # Logged before the buyer fan-out so the next post in the send stage already sees it as existing
         db.log_post(
             bot_name=BOT_NAME,
-            message_id=message.message_id,
+            message_id=job.message_id,
             brand=corrected_brand,
             price=int(adjusted_price) or int(price),
             adjusted_price=percentage,
@@ -785,26 +966,96 @@ async def handle_photo_post(message: Message):
             client_message_id=sent_message.message_id,
             client_chat_id=chat_id,
             client_topic_name=target_topic,
-            forward_from_message_id=message.forward_from_message_id,
-            watermarked_photo_ids=','.join([pid for pid in watermarked_photo_ids if pid])
+            forward_from_message_id=job.forward_from_message_id,
+            watermarked_photo_ids=','.join([pid for pid in watermarked_photo_ids if pid]),
+            caption=description
         )
+        if photo_hashes:
+            photo_hash_index.add_post(chat_id, sent_message.message_id, photo_hashes)
+
+        buyer_price = int(price)  # Ensure integer price for buyers
+        return {
+            'client_chat_id': chat_id,
+            'client_message_id': sent_message.message_id,
+            'photo_ids': photo_ids,
+            'corrected_brand': corrected_brand,
+            'buyer_price': buyer_price,
+            'sizes': sizes,
+            'buyer_caption': update_caption_price_and_percentage(description, buyer_price, original_percentage, currency, corrected_brand),
+            'photo_hashes': photo_hashes
+        }
 
     except Exception as e:
         print(f"DEBUG - Error sending to client group {target_group}: {e}")
-        await message.reply(f"Ошибка при отправке в пост: {str(e)}")
+        await notify(job, f"Ошибка при отправке в пост: {str(e)}")
         raise
 
-async def forward_to_buyers(message, photo_ids, corrected_brand, price, sizes, buyer_groups, client_message_id, full_caption=None):
-    buyer_message_ids = []
-    for buyer in buyer_groups:
-        buyer_chat_id = db.get_group_info(buyer)
-        if not buyer_chat_id:
-            print(f"DEBUG - Buyer group {buyer} not found")
-            continue
-        buyer_caption = full_caption.strip() if full_caption else ""
+async def update_existing_post(job, existing_post, description, photo_ids, price, currency, original_percentage, sizes, corrected_brand):
+    client_message_id, client_chat_id, client_topic_name, _, existing_sizes = existing_post
+    adjusted_price, percentage, adjusted_currency = adjust_price(description) if config["adjust_price"] else (price, None, currency)
+    if not adjusted_price:
+        await notify(job, "Не удалось определить цену для обновления поста.")
+        return
+    client_percentage = f"{percentage}" if percentage else None
+    client_caption = update_caption_price_and_percentage(description, adjusted_price, client_percentage, adjusted_currency, corrected_brand)
+    try:
+        await bot.edit_message_caption(
+            chat_id=client_chat_id,
+            message_id=client_message_id,
+            caption=client_caption
+        )
+        db.update_post_price(client_message_id, adjusted_price, percentage)
+        buyer_price = int(price)  # Ensure integer price for buyers
+        buyer_currency = currency
+        buyer_caption = update_caption_price_and_percentage(description, buyer_price, original_percentage, buyer_currency, corrected_brand)
+        if not await update_buyer_deliveries(client_chat_id, client_message_id, photo_ids, buyer_caption):
+            await forward_to_buyers(
+                job,
+                photo_ids,
+                corrected_brand,
+                buyer_price,
+                sizes,
+                config["forward_to_buyers"],
+                client_chat_id,
+                client_message_id,
+                buyer_caption
+            )
+        print(f"DEBUG - Updated existing client post: message_id={client_message_id}")
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            await notify(job, "Описание поста не изменено.")
+            print(f"DEBUG - Message not modified for client post: message_id={client_message_id}")
+        else:
+            await notify(job, f"Ошибка при обновлении поста: {str(e)}")
+            print(f"DEBUG - Error updating client post: {e}")
+
+async def update_buyer_deliveries(client_chat_id, client_message_id, photo_ids, buyer_caption):
+    deliveries = db.get_deliveries(client_chat_id, client_message_id)
+    if not deliveries:
+        return 0
+
+    async def update_delivery(delivery):
+        delivery_id, chat_id, buyer_group, buyer_message_id, album_size = delivery
+        try:
+            new_buyer_message_id = await edit_or_resend_post(chat_id, buyer_message_id, photo_ids, buyer_caption)
+            print(f"DEBUG - Updated buyer post in {buyer_group}: message_id={new_buyer_message_id}")
+            return new_buyer_message_id, len(photo_ids), 'sent', delivery_id
+        except TelegramBadRequest as e:
+            print(f"DEBUG - Error updating buyer post in {buyer_group}: {e}")
+            return buyer_message_id, album_size, 'failed', delivery_id
+
+    results = await asyncio.gather(*(update_delivery(delivery) for delivery in deliveries))
+    db.update_deliveries(results)
+    return len(deliveries)
+
+async def forward_to_buyers(job, photo_ids, corrected_brand, price, sizes, buyer_groups, client_chat_id, client_message_id, full_caption=None):
+    buyer_caption = full_caption.strip() if full_caption else ""
+
+    async def send_to_buyer(buyer, buyer_chat_id):
         print(f"DEBUG - Sending to buyer_group: {buyer}, chat_id={buyer_chat_id}, photo_count={len(photo_ids)}")
         try:
             await asyncio.sleep(5)
+            started = time.perf_counter()
             if len(photo_ids) > 1:
                 media_group = [
                     InputMediaPhoto(media=pid, caption=buyer_caption if i == 0 else None)
@@ -826,30 +1077,124 @@ async def forward_to_buyers(message, photo_ids, corrected_brand, price, sizes, b
                 )
                 buyer_message_id = sent_message.message_id
                 print(f"DEBUG - Sent single photo to buyer: group={buyer}, message_id={buyer_message_id}")
-            buyer_message_ids.append(buyer_message_id)
             print(f"DEBUG - Successfully sent to buyer group: {buyer}")
-            await asyncio.sleep(5)
+            record_span("send_buyer", started, time.perf_counter(), buyer=buyer, message_id=buyer_message_id)
+            return buyer_chat_id, buyer, buyer_message_id, len(photo_ids), 'sent'
         except Exception as e:
             print(f"DEBUG - Error sending to buyer group {buyer}: {e}")
+            return buyer_chat_id, buyer, None, len(photo_ids), 'failed'
+
+    targets = []
+    for buyer in buyer_groups:
+        buyer_chat_id = db.get_group_info(buyer)
+        if not buyer_chat_id:
+            print(f"DEBUG - Buyer group {buyer} not found")
             continue
+        targets.append((buyer, buyer_chat_id))
+    if not targets:
+        return
 
-    if buyer_message_ids:
-        try:
-            buyer_message_ids_str = ','.join(map(str, buyer_message_ids))
-            db.cursor.execute(
-                "UPDATE posts SET buyer_message_ids = %s WHERE client_message_id = %s",
-                (buyer_message_ids_str, client_message_id)
-            )
-            db.conn.commit()
-            print(f"DEBUG - Successfully updated buyer_message_ids for client_message_id={client_message_id}")
-        except Exception as e:
-            print(f"DEBUG - Error updating buyer_message_ids: {e}")
+    deliveries = await asyncio.gather(*(send_to_buyer(buyer, buyer_chat_id) for buyer, buyer_chat_id in targets))
+    try:
+        db.log_deliveries(client_chat_id, client_message_id, deliveries)
+        print(f"DEBUG - Logged buyer deliveries for client_message_id={client_message_id}: {len(deliveries)}")
+    except Exception as e:
+        print(f"DEBUG - Error logging buyer deliveries: {e}")
+
+def warm_up_database():
+    # Runs in a worker thread; nothing else touches the connection until warm-up is over
+    db.connect()
+    if MIGRATIONS_CONFIG["apply_on_startup"]:
+        apply_migrations(db)
+    if WARMUP_CONFIG["preload_caches"]:
+        db.warm_caches()
+    if PHASH_CONFIG["enabled"] and config.get("add_watermark"):
+        photo_hash_index.load(db, BOT_NAME)
+    if BLOOM_CONFIG["enabled"]:
+        db.rebuild_lookup_filters()
+
+async def warm_up():
+    # Database, Telegram, HTTP and Pillow are independent, so they load side by side
+    timings = {}
+
+    async def timed(name, awaitable):
+        started = time.perf_counter()
+        result = await awaitable
+        timings[name] = time.perf_counter() - started
+        return result
+
+    async def open_http():
+        http_session()
+
+    steps = [
+        timed("database", asyncio.to_thread(warm_up_database)),
+        timed("telegram", bot.get_me()),
+        timed("http", open_http())
+    ]
+    if config.get("add_watermark"):
+        steps.append(timed("watermark", asyncio.to_thread(preload_watermark)))
+    if post_queue is not db:
+        steps.append(timed("queue", asyncio.to_thread(post_queue.open)))
+    me = (await asyncio.gather(*steps))[1]
+    print(f"DEBUG - Warm-up steps: {', '.join(f'{name}={seconds * 1000:.0f}ms' for name, seconds in timings.items())}, username=@{me.username}")
 
 async def main():
-    print(f"Bot {BOT_NAME} started!")
+    global publish_pipeline, media_prefetcher, media_group_assembler
+    started = time.perf_counter()
+    print(f"Bot {BOT_NAME} starting...")
+    if WATCHDOG_CONFIG["enabled"]:
+        loop_watchdog.start()
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, start_signal_capture)
+    if hasattr(signal, "SIGUSR2"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, clear_post_cache)
+    await warm_up()
+    for user_id, message_id, client_message_id, caption in forwarded_ledger.recover():
+        try:
+            await bot.send_message(user_id, f"Обновление цены не применено из-за перезапуска бота, перешлите пост ещё раз: {caption}")
+        except Exception as e:
+            print(f"DEBUG - Error notifying about lost update: message_id={message_id}, error={e}")
+    if BLOOM_CONFIG["enabled"]:
+        asyncio.create_task(rebuild_lookup_filters())
+    if WARMUP_CONFIG["preload_caches"]:
+        asyncio.create_task(refresh_caches())
+    if PREFETCH_CONFIG["enabled"] and config.get("add_watermark") and not config["sort_by_brand"]:
+        media_prefetcher = MediaPrefetcher(render_photo, config["target_group"])
+        asyncio.create_task(media_prefetcher.run_expiry())
+    publish_pipeline = PublishPipeline(
+        prepare_stage,
+        [
+            Stage("send", send_stage, concurrency=1, maxsize=PIPELINE_CONFIG["prepare_concurrency"]),
+            Stage("buyers", buyers_stage, concurrency=PIPELINE_CONFIG["buyer_concurrency"], maxsize=PIPELINE_CONFIG["stage_queue_size"]),
+            Stage("persist", persist_stage, concurrency=PIPELINE_CONFIG["persist_concurrency"], maxsize=PIPELINE_CONFIG["stage_queue_size"])
+        ],
+        prepare_concurrency=PIPELINE_CONFIG["prepare_concurrency"],
+        on_error=publish_failed
+    )
+    publish_pipeline.start()
+    media_group_assembler = MediaGroupAssembler(process_media_group)
+    asyncio.create_task(media_group_assembler.run())
     asyncio.create_task(process_queue())
-    asyncio.create_task(cleanup_stale_media_groups())
-    await dp.start_polling(bot)
+    if DB_METRICS_CONFIG["report_interval"]:
+        asyncio.create_task(report_metrics())
+    if ARCHIVE_CONFIG["enabled"]:
+        asyncio.create_task(archive_posts())
+    # Updates and post_queue are only consumed from here on, once every cache is warm
+    time_to_ready = time.perf_counter() - started
+    metrics.set_gauge("startup.time_to_ready_ms", round(time_to_ready * 1000))
+    print(f"Bot {BOT_NAME} started! Ready in {time_to_ready:.2f}s")
+    try:
+        if WEBHOOK_CONFIG["enabled"]:
+            from webhook import run_webhook
+            await run_webhook(bot, dp, BOT_NAME)
+        else:
+            # A webhook left over from webhook mode makes getUpdates fail with a conflict
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await close_http_session()
+        if post_queue is not db:
+            post_queue.close()
 
 if __name__ == "__main__":
     try:
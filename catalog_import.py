@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from aiogram import Bot
+from aiogram.types import BufferedInputFile, InputMediaPhoto
+from aiogram.exceptions import TelegramRetryAfter
+from config import BOT_TOKENS, BOT_CONFIGS, CATALOG_IMPORT_CONFIG, QUEUE_CONFIG
+from database import Database
+from journal_queue import JournalQueue, journal_path
+from utils import parse_caption
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+ALBUM_LIMIT = 10
+
+def load_manifest(path):
+    # JSON lines: {"images": ["a.jpg", "b.jpg"], "caption": "Gucci 120€ -20% M L"}, paths relative to the manifest
+    base = os.path.dirname(os.path.abspath(path))
+    items = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            items.append({
+                'name': entry.get('name') or entry['images'][0],
+                'images': [os.path.join(base, image) for image in entry['images']],
+                'caption': entry.get('caption', '').strip()
+            })
+    return items
+
+def scan_directory(path):
+    # Either one sub-directory per item (images + a .txt caption) or loose files sharing a stem (item.jpg + item.txt)
+    items = []
+    loose = {}
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        if os.path.isdir(full):
+            files = sorted(os.listdir(full))
+            images = [os.path.join(full, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS)]
+            captions = [os.path.join(full, f) for f in files if f.lower().endswith('.txt')]
+            if images:
+                items.append({'name': name, 'images': images, 'caption': read_caption(captions[0]) if captions else ''})
+            continue
+        stem, ext = os.path.splitext(name)
+        # item_1.jpg, item_2.jpg and item.txt belong to the same item
+        key = re.sub(r'[_-]\d+$', '', stem) if ext.lower() in IMAGE_EXTENSIONS else stem
+        entry = loose.setdefault(key, {'name': key, 'images': [], 'caption': ''})
+        if ext.lower() in IMAGE_EXTENSIONS:
+            entry['images'].append(full)
+        elif ext.lower() == '.txt':
+            entry['caption'] = read_caption(full)
+    items.extend(entry for entry in loose.values() if entry['images'])
+    return items
+
+def read_caption(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read().strip()
+
+def load_file_id_cache(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_file_id_cache(path, cache):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+def validate_item(db, bot_name, item):
+    if not item['caption']:
+        return "нет подписи"
+    brand, price, currency, sizes, original_percentage = parse_caption(item['caption'])
+    if price is None:
+        return "не удалось определить цену"
+    if BOT_CONFIGS[bot_name]["sort_by_brand"]:
+        corrected_brand, target_groups, target_topic = db.get_corrected_brand(brand.lower())
+        if corrected_brand == "Unknown" and brand != "Unknown":
+            corrected_brand, target_groups, target_topic = db.get_corrected_brand(re.sub(r'[^\w\s]', '', brand.lower()))
+        if corrected_brand == "Unknown" or not target_groups:
+            return f"бренд не найден: {brand}"
+    return None
+
+async def send_paced(func, interval, **kwargs):
+    while True:
+        try:
+            result = await func(**kwargs)
+            await asyncio.sleep(interval)
+            return result
+        except TelegramRetryAfter as e:
+            print(f"DEBUG - Upload rate limited, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+
+async def upload_item(bot, chat_id, item, cache, interval, stats):
+    keys = []
+    blobs = {}
+    for path in item['images'][:ALBUM_LIMIT]:
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = hashlib.sha256(data).hexdigest()
+        keys.append(key)
+        if key not in cache:
+            blobs[key] = (os.path.basename(path), data)
+    stats['reused'] += len(keys) - len(blobs)
+    missing = [key for key in dict.fromkeys(keys) if key in blobs]
+    if len(missing) > 1:
+        sent_messages = await send_paced(
+            bot.send_media_group,
+            interval,
+            chat_id=chat_id,
+            media=[InputMediaPhoto(media=BufferedInputFile(blobs[key][1], filename=blobs[key][0])) for key in missing]
+        )
+    elif missing:
+        key = missing[0]
+        sent_messages = [await send_paced(bot.send_photo, interval, chat_id=chat_id, photo=BufferedInputFile(blobs[key][1], filename=blobs[key][0]))]
+    else:
+        sent_messages = []
+    for key, sent_message in zip(missing, sent_messages):
+        cache[key] = {'file_id': sent_message.photo[-1].file_id, 'message_id': sent_message.message_id}
+        stats['uploaded'] += 1
+    photo_ids = list(dict.fromkeys(cache[key]['file_id'] for key in keys))
+    return photo_ids, cache[keys[0]]['message_id']
+
+async def import_catalog(source, bot_name, user_id, upload_chat_id=None, dry_run=False):
+    items = load_manifest(source) if os.path.isfile(source) else scan_directory(source)
+    db = Database()
+    started = time.perf_counter()
+    stats = {'items': len(items), 'queued': 0, 'skipped': 0, 'duplicates': 0, 'uploaded': 0, 'reused': 0}
+    valid = []
+    for item in items:
+        error = validate_item(db, bot_name, item)
+        if error:
+            stats['skipped'] += 1
+            print(f"SKIP - {item['name']}: {error}")
+        else:
+            valid.append(item)
+    if dry_run:
+        print(f"Dry run: {len(valid)} of {len(items)} items would be queued")
+        db.close()
+        return stats
+
+    # The journal belongs to one bot process, so a journal-backed bot has to be stopped for the import
+    post_queue = JournalQueue(journal_path(bot_name)).open() if QUEUE_CONFIG["backend"] == "journal" else db
+    # Uploading to the owner's chat leaves a real message for process_queue to reply to
+    chat_id = upload_chat_id or user_id
+    cache_path = CATALOG_IMPORT_CONFIG["file_id_cache"]
+    cache = load_file_id_cache(cache_path)
+    bot = Bot(token=BOT_TOKENS[bot_name])
+    rows = []
+    upload_started = time.perf_counter()
+    try:
+        for index, item in enumerate(valid, 1):
+            try:
+                photo_ids, message_id = await upload_item(bot, chat_id, item, cache, CATALOG_IMPORT_CONFIG["upload_interval"], stats)
+            except Exception as e:
+                stats['skipped'] += 1
+                print(f"SKIP - {item['name']}: upload failed: {e}")
+                continue
+            if post_queue.check_queue_duplicate(user_id, photo_ids, len(photo_ids), item['caption']):
+                stats['duplicates'] += 1
+                continue
+            batch_id = f"import-{uuid.uuid4()}-{message_id}"
+            rows.append((user_id, ','.join(photo_ids), item['caption'], len(photo_ids), message_id, batch_id, None))
+            if index % 25 == 0:
+                save_file_id_cache(cache_path, cache)
+                print(f"Uploaded {index}/{len(valid)} items")
+    finally:
+        save_file_id_cache(cache_path, cache)
+        await bot.session.close()
+    upload_seconds = time.perf_counter() - upload_started
+
+    insert_started = time.perf_counter()
+    if rows:
+        post_queue.queue_posts(rows, CATALOG_IMPORT_CONFIG["insert_batch_size"])
+    if post_queue is not db:
+        post_queue.close()
+    stats['queued'] = len(rows)
+    insert_seconds = time.perf_counter() - insert_started
+    db.close()
+
+    total = time.perf_counter() - started
+    print(
+        f"Imported {stats['queued']}/{stats['items']} items in {total:.1f}s "
+        f"(skipped {stats['skipped']}, duplicates {stats['duplicates']})\n"
+        f"  upload: {upload_seconds:.1f}s, {stats['uploaded']} photos uploaded, {stats['reused']} reused, "
+        f"{len(valid) / upload_seconds if upload_seconds else 0:.2f} items/s\n"
+        f"  insert: {insert_seconds * 1000:.0f}ms, {stats['queued'] / insert_seconds if insert_seconds else 0:.0f} rows/s"
+    )
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Queue a supplier catalog for publishing")
+    parser.add_argument("source", help="directory of items or a JSON lines manifest")
+    parser.add_argument("--bot", default="bella", choices=list(BOT_TOKENS.keys()))
+    parser.add_argument("--user-id", type=int, required=True, help="Telegram user that owns the queued posts")
+    parser.add_argument("--upload-chat", type=int, default=None, help="chat used to upload images, defaults to --user-id")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(import_catalog(args.source, args.bot, args.user_id, args.upload_chat, args.dry_run))
@@ -0,0 +1,92 @@
+import asyncio
+from config import PRICE_UPDATE_CONFIG
+
+class UpdateCoalescer:
+    # apply(key) receives the post's current key; an apply that moves the post to a new key calls rename()
+    def __init__(self, window=None, max_delay=None):
+        self.window = PRICE_UPDATE_CONFIG["debounce_seconds"] if window is None else window
+        self.max_delay = PRICE_UPDATE_CONFIG["max_delay_seconds"] if max_delay is None else max_delay
+        self.pending = {}
+
+    async def submit(self, key, apply, on_superseded=None):
+        if self.window <= 0:
+            await apply(key)
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        entry = self.pending.get(key)
+        if entry and entry['running']:
+            # Chained behind the update being applied; it runs once that one finishes
+            waiting = entry['next']
+            entry['next'] = {
+                'apply': apply,
+                'on_superseded': on_superseded,
+                'first_seen': waiting['first_seen'] if waiting else now,
+                'deadline': now + self.window
+            }
+            print(f"DEBUG - Chained price update behind a running one: key={key}")
+            if waiting and waiting['on_superseded']:
+                asyncio.create_task(self._notify(key, waiting['on_superseded']))
+            return
+        if entry:
+            previous = entry['on_superseded']
+            entry['apply'] = apply
+            entry['on_superseded'] = on_superseded
+            entry['deadline'] = min(now + self.window, entry['first_seen'] + self.max_delay)
+            print(f"DEBUG - Coalesced price update: key={key}, deadline_in={entry['deadline'] - now:.1f}s")
+            if previous:
+                asyncio.create_task(self._notify(key, previous))
+            return
+        self.pending[key] = {
+            'apply': apply,
+            'on_superseded': on_superseded,
+            'first_seen': now,
+            'deadline': now + self.window,
+            'running': False,
+            'next': None,
+            'keys': [key]
+        }
+        asyncio.create_task(self._flush(key))
+        print(f"DEBUG - Scheduled price update: key={key}, window={self.window}s")
+
+    async def _notify(self, key, on_superseded):
+        try:
+            await on_superseded()
+        except Exception as e:
+            print(f"DEBUG - Error notifying superseded update: key={key}, error={e}")
+
+    def rename(self, key, new_key):
+        # Called in the same step as the database re-key, so forwards that find the post under
+        # its new id chain behind the running update instead of starting a second one
+        entry = self.pending.get(key)
+        if entry is None or new_key in self.pending:
+            return
+        self.pending[new_key] = entry
+        entry['keys'].append(new_key)
+
+    async def _flush(self, key):
+        loop = asyncio.get_running_loop()
+        entry = self.pending[key]
+        while True:
+            while True:
+                delay = entry['deadline'] - loop.time()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            # The key stays claimed while apply runs, so a forward arriving meanwhile waits instead of racing it
+            entry['running'] = True
+            current = entry['keys'][-1]
+            print(f"DEBUG - Applying coalesced price update: key={current}")
+            try:
+                await entry['apply'](current)
+            except Exception as e:
+                print(f"DEBUG - Error applying coalesced price update: key={current}, error={e}")
+            queued = entry['next']
+            if queued is None:
+                break
+            entry.update(queued)
+            entry['deadline'] = min(entry['deadline'], entry['first_seen'] + self.max_delay)
+            entry['running'] = False
+            entry['next'] = None
+        for claimed in entry['keys']:
+            self.pending.pop(claimed, None)
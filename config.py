@@ -1,3 +1,5 @@
+import os
+
 # Bot tokens and MySQL configuration
 
 contact_url = "https://t.me/Elena_2000"
@@ -16,6 +18,19 @@ MYSQL_CONFIG = {
     "database": "italy_db"
 }
 
+# Storage backend (storage.py): "mysql" or an embedded "sqlite" file for single-host deployments
+STORAGE_CONFIG = {
+    "backend": os.getenv("STORAGE_BACKEND", "mysql")
+}
+
+SQLITE_CONFIG = {
+    "path": os.getenv("SQLITE_PATH", "italy.db"),
+    "synchronous": "NORMAL",  # safe with WAL: a crash can lose the last commits, never corrupt the file
+    "busy_timeout": 5,  # seconds to wait for another process's write lock
+    "cache_size_kb": 20000,
+    "cached_statements": 256
+}
+
 # Bot configurations
 BOT_CONFIGS = {
     "lucia": {
@@ -52,6 +67,9 @@ BOT_CONFIGS = {
     }
 }
 
+# Telegram user ids allowed to run admin commands (/reprice)
+ADMIN_IDS = [int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()]
+
 PROJECT_BOT_IDS = [
     7432922492,  # Lucia
     8151632568,  # Luna
@@ -221,4 +239,190 @@ BRAND_ABBREVIATIONS = {
     'jc': 'Jimmy Choo',
     'cl': 'Christian Louboutin',
     'rv': 'Roger Vivier'
-}
\ No newline at end of file
+}
+# Webhook delivery mode (alternative to long polling)
+WEBHOOK_CONFIG = {
+    "enabled": os.getenv("WEBHOOK_ENABLED", "0") == "1",
+    "host": "0.0.0.0",
+    # WEBHOOK_PORT overrides the per-bot port below, e.g. when one bot runs per container
+    "port": int(os.getenv("WEBHOOK_PORT")) if os.getenv("WEBHOOK_PORT") else None,
+    # One local port per bot; a reverse proxy routes /webhook/<bot_name> to it
+    "ports": {
+        "lucia": 8081,
+        "luna": 8082,
+        "leo": 8083,
+        "bella": 8084
+    },
+    "base_url": os.getenv("WEBHOOK_BASE_URL", "https://bots.example.com"),
+    "path": "/webhook/{bot_name}",
+    "secret": os.getenv("WEBHOOK_SECRET", "change-me"),
+    "set_webhook": True,
+    "drop_pending_updates": False
+}
+
+# Post queue scheduling: per-user FIFO, deficit round-robin across users
+SCHEDULER_CONFIG = {
+    "quantum": 10,  # photos a user may publish per round before yielding to the next user
+    "prioritize_updates": True,  # forwarded price updates jump ahead of new listings
+    "default_post_seconds": 20  # initial estimate for one post, refined from measured durations
+}
+
+# Coalescing of repeated price updates that target the same client post
+PRICE_UPDATE_CONFIG = {
+    "debounce_seconds": 15,  # 0 applies every update immediately
+    "max_delay_seconds": 60  # upper bound on how long a stream of updates can be held back
+}
+
+# Perceptual-hash duplicate detection for incoming photos
+PHASH_CONFIG = {
+    "enabled": True,
+    "max_distance": 6,  # Hamming distance (out of 64 bits) at which two photos count as the same
+    "match_ratio": 0.5,  # share of an album's photos that must match one post
+    "recent_days": 30,  # only posts this recent are considered reposts
+    "backfill_concurrency": 8
+}
+
+# Photo variant selection and JPEG encoding for the watermark/publish path
+PHOTO_CONFIG = {
+    "target_resolution": 1280,  # longest side Telegram displays; smallest variant at least this big is used
+    "jpeg_quality": 87,
+    "min_jpeg_quality": 70,
+    "max_bytes": 350000,  # quality is stepped down until the encoded photo fits
+    "progressive": True
+}
+
+# Schema migrations
+MIGRATIONS_CONFIG = {
+    "apply_on_startup": True
+}
+
+# Database instrumentation
+DB_METRICS_CONFIG = {
+    "slow_query_ms": 250,  # statements slower than this are logged with their EXPLAIN plan
+    "slow_query_log_size": 100,
+    "prepared_statements": True,  # prepare hot statements once per connection
+    "statement_cache_size": 64,
+    "report_interval": 600  # seconds between metrics reports in the bot log, 0 disables
+}
+
+# Hot/archive split of the posts table
+ARCHIVE_CONFIG = {
+    "enabled": True,
+    "hot_days": 60,  # posts older than this move to posts_archive
+    "batch_size": 500,
+    "interval": 3600  # seconds between archival runs
+}
+
+# In-memory write-through cache of recently created posts
+POST_CACHE_CONFIG = {
+    "enabled": True,
+    "max_size": 5000,
+    "ttl": 6 * 3600  # seconds
+}
+
+# Bloom filter over published photo sets that lets definite misses skip the repost lookup
+BLOOM_CONFIG = {
+    "enabled": True,
+    "capacity": 200000,
+    "false_positive_rate": 0.01,
+    "rebuild_interval": 3600  # seconds; rebuilding drops deleted keys and resizes for growth
+}
+
+# In-flight ledger of forwarded price updates
+FORWARDED_POSTS_CONFIG = {
+    "persist": False  # mirror in-flight updates to forwarded_posts so a restart can report the ones it lost
+}
+
+# Staged publishing: prepare media -> send to client -> fan out to buyers -> persist
+PIPELINE_CONFIG = {
+    "prepare_concurrency": 2,  # posts whose media may be downloaded/watermarked ahead of the send stage
+    "buyer_concurrency": 2,
+    "persist_concurrency": 1,
+    "stage_queue_size": 4,
+    "send_interval": 5  # seconds to wait before each client send
+}
+
+# Speculative download/watermarking of photos that are still waiting for a caption (fixed-routing bots only)
+PREFETCH_CONFIG = {
+    "enabled": False,
+    "max_entries": 100,  # prefetched photos kept in memory
+    "ttl": 600,  # seconds before an uncaptioned prefetch is cancelled
+    "concurrency": 2
+}
+
+# Album assembly: an album is flushed once no new photo arrived for the adaptive quiet period
+MEDIA_GROUP_CONFIG = {
+    "quiet_min": 0.8,  # seconds
+    "quiet_max": 3.0,
+    "quiet_factor": 4,  # quiet period = factor * average gap between photos of one album
+    "max_wait": 10,  # seconds after the first photo
+    "album_limit": 10,
+    "max_groups": 1000
+}
+
+# Bulk catalog import (catalog_import.py)
+CATALOG_IMPORT_CONFIG = {
+    "file_id_cache": "catalog_file_ids.json",  # image sha256 -> uploaded file_id, reused across runs
+    "upload_interval": 1.0,  # seconds between upload calls
+    "insert_batch_size": 500
+}
+
+# Brand-wide repricing campaigns (repricing.py, /reprice)
+REPRICE_CONFIG = {
+    "per_chat_rate": 20 / 60,  # caption edits per second in one chat
+    "global_rate": 25,  # caption edits per second across all chats
+    "burst": 3,
+    "batch_size": 50,  # posts per database transaction and checkpoint
+    "checkpoint_dir": "reprice_checkpoints"
+}
+
+# Event-loop lag monitor (watchdog.py)
+WATCHDOG_CONFIG = {
+    "enabled": True,
+    "threshold_ms": 100,  # loop stalls longer than this are attributed to a call site
+    "interval": 0.05,  # heartbeat period in seconds
+    "sample_interval": 0.02,  # how often the sampling thread checks for a stalled loop
+    "attribute_files": ["database.py", "utils.py", "bot.py"],  # innermost frame from these files names the site
+    "log_stacks": True,
+    "stack_depth": 12
+}
+
+# Per-post trace timelines (tracing.py)
+TRACING_CONFIG = {
+    "enabled": True,
+    "sample_rate": 0.1,  # share of posts that get a trace
+    "path": "traces.jsonl",
+    "max_bytes": 10 * 1024 * 1024,
+    "backup_count": 5,
+    "max_parked": 5000  # posts waiting in post_queue whose sampling decision is remembered
+}
+
+# On-demand profiling of a running bot (profiler.py): /profile or kill -USR1 <pid>
+PROFILER_CONFIG = {
+    "output_dir": "profiles",
+    "default_seconds": 30,
+    "max_seconds": 600,  # also caps captures that wait for N posts
+    "sample_interval": 0.005,  # loop thread stack sampling period
+    "task_sample_interval": 0.05,  # awaiting task stack sampling period
+    "stack_depth": 40,
+    "tracemalloc_frames": 10,
+    "top": 15,
+    "signal_memory": True  # SIGUSR1 captures also diff tracemalloc snapshots
+}
+
+# Startup warm-up (bot.py warm_up): updates and post_queue are consumed only once it finishes
+WARMUP_CONFIG = {
+    "preload_caches": True,  # load brands, groups and topics into memory and answer lookups from there
+    "cache_refresh_interval": 600  # seconds between reloads, picks up brands added in the database
+}
+
+# post_queue storage: "database" keeps it in the post_queue table, "journal" in a local append-only file
+# (journal_queue.py) owned by one bot process
+QUEUE_CONFIG = {
+    "backend": os.getenv("QUEUE_BACKEND", "database"),
+    "path": "queue/{bot_name}.journal",
+    "fsync": "batch",  # "always" fsyncs every write, "batch" every fsync_interval, "never" leaves it to the OS
+    "fsync_interval": 0.05,
+    "compact_min_records": 1000,
+    "compact_ratio": 2  # compact once the journal holds this many lines per live entry
+}
@@ -1,18 +1,251 @@
 import re
-import mysql.connector
+import asyncio
+import functools
+import importlib
+import time
 import uuid
 import unicodedata
-from config import MYSQL_CONFIG, KNOWN_BRANDS, BRAND_ABBREVIATIONS
+from collections import OrderedDict, deque
+from config import KNOWN_BRANDS, BRAND_ABBREVIATIONS, DB_METRICS_CONFIG, POST_CACHE_CONFIG, BLOOM_CONFIG
+from metrics import metrics
+from storage import DatabaseError, create_backend
+from tracing import record_span
+from post_cache import PostCache, POST_COLUMNS, project
+from bloom import LookupFilters
+
+PREPARABLE_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE")
+EXPLAINABLE_STATEMENTS = ("SELECT", "UPDATE", "DELETE")
+
+class InstrumentedCursor:
+    def __init__(self, conn, backend):
+        self.conn = conn
+        self.backend = backend
+        self.plain = conn.cursor()
+        self.statements = OrderedDict()  # sql -> prepared cursor, least recently used first
+        self.slow_queries = deque(maxlen=DB_METRICS_CONFIG["slow_query_log_size"])
+        self.rows_total = 0
+        self.rowcount = -1
+        self.lastrowid = None
+        self.column_names = ()
+        self._rows = []
+        self._pos = 0
+
+    def _cursor_for(self, sql, params):
+        if not (self.backend.prepared_statements and DB_METRICS_CONFIG["prepared_statements"] and params is not None
+                and sql.lstrip().upper().startswith(PREPARABLE_STATEMENTS)):
+            return self.plain
+        cursor = self.statements.get(sql)
+        if cursor is not None:
+            self.statements.move_to_end(sql)
+            metrics.incr("db.statement_cache.hits")
+            return cursor
+        metrics.incr("db.statement_cache.misses")
+        cursor = self.conn.cursor(prepared=True)
+        self.statements[sql] = cursor
+        if len(self.statements) > DB_METRICS_CONFIG["statement_cache_size"]:
+            _, evicted = self.statements.popitem(last=False)
+            evicted.close()
+        return cursor
+
+    def _finish(self, cursor, sql, params, started):
+        # Results are buffered so interleaved statements never leave unread rows on the connection
+        if cursor.description is not None:
+            self._rows = cursor.fetchall()
+            self.column_names = tuple(column[0] for column in cursor.description)
+            self.rowcount = len(self._rows)
+        else:
+            self._rows = []
+            self.rowcount = cursor.rowcount
+        self._pos = 0
+        self.lastrowid = cursor.lastrowid
+        self.rows_total += max(self.rowcount, 0)
+        elapsed = time.perf_counter() - started
+        metrics.observe("db.statements", elapsed)
+        if elapsed * 1000 >= DB_METRICS_CONFIG["slow_query_ms"]:
+            self._log_slow_query(sql, params, elapsed)
+
+    def _log_slow_query(self, sql, params, elapsed):
+        plan = None
+        if sql.lstrip().upper().startswith(EXPLAINABLE_STATEMENTS):
+            try:
+                self.plain.execute(self.backend.explain_prefix + self.backend.translate(sql), params)
+                plan = self.plain.fetchall()
+            except DatabaseError as e:
+                plan = f"EXPLAIN failed: {e}"
+        metrics.incr("db.slow_queries")
+        self.slow_queries.append({"sql": sql, "params": params, "ms": elapsed * 1000, "plan": plan, "at": time.time()})
+        print(f"SLOW QUERY - {elapsed * 1000:.0f}ms: sql={sql}, params={params}, plan={plan}")
+
+    def execute(self, sql, params=None):
+        cursor = self._cursor_for(sql, params)
+        started = time.perf_counter()
+        if params is None:
+            cursor.execute(self.backend.translate(sql))
+        else:
+            cursor.execute(self.backend.translate(sql), params)
+        self._finish(cursor, sql, params, started)
+
+    def executemany(self, sql, seq_params):
+        started = time.perf_counter()
+        self.plain.executemany(self.backend.translate(sql), seq_params)
+        self._finish(self.plain, sql, None, started)
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def close(self):
+        for cursor in self.statements.values():
+            cursor.close()
+        self.statements.clear()
+        self.plain.close()
+
+def _instrument(name, func):
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(self, *args, **kwargs):
+            rows_before = self.cursor.rows_total
+            started = time.perf_counter()
+            try:
+                return await func(self, *args, **kwargs)
+            finally:
+                ended = time.perf_counter()
+                metrics.observe(f"db.{name}", ended - started)
+                metrics.incr(f"db.{name}.rows", self.cursor.rows_total - rows_before)
+                record_span(f"db.{name}", started, ended)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        rows_before = self.cursor.rows_total
+        started = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            ended = time.perf_counter()
+            metrics.observe(f"db.{name}", ended - started)
+            metrics.incr(f"db.{name}.rows", self.cursor.rows_total - rows_before)
+            record_span(f"db.{name}", started, ended)
+    return wrapper
 
 class Database:
-    def __init__(self):
+    def __init__(self, connect=True, backend=None):
+        self.backend = backend or create_backend()
+        self.conn = None
+        self.cursor = None
+        self.post_cache = PostCache() if POST_CACHE_CONFIG["enabled"] else None
+        self.lookup_filters = None
+        # Filled by warm_caches(); while loaded they answer brand, group and topic lookups without a query
+        self.brand_cache = None
+        self.group_cache = None
+        self.topic_cache = None
+        if connect:
+            self.connect()
+
+    def connect(self):
         try:
-            self.conn = mysql.connector.connect(**MYSQL_CONFIG)
-            self.cursor = self.conn.cursor()
-        except mysql.connector.Error as e:
+            self.conn = self.backend.connect()
+            self.cursor = InstrumentedCursor(self.conn, self.backend)
+        except DatabaseError as e:
             print(f"Error connecting to database: {e}")
             raise
 
+    def warm_caches(self):
+        try:
+            self.cursor.execute("SELECT input_name, corrected_name, target_groups, target_topic FROM brands")
+            brand_rows = self.cursor.fetchall()
+            self.cursor.execute("SELECT group_name, group_id FROM groupss")
+            group_rows = self.cursor.fetchall()
+            self.cursor.execute("SELECT group_name, target_topic, message_thread_id FROM topics")
+            topic_rows = self.cursor.fetchall()
+            self.conn.commit()
+        except DatabaseError as e:
+            print(f"Error warming caches: {e}")
+            raise
+        by_input, by_corrected = {}, {}
+        for input_name, corrected_name, target_groups, target_topic in brand_rows:
+            entry = (corrected_name, target_groups.split(',') if target_groups else [], target_topic)
+            if input_name:
+                by_input.setdefault(input_name.lower(), entry)
+            if corrected_name:
+                by_corrected.setdefault(corrected_name.lower(), entry)
+        # Keys are lowercased to match the case-insensitive collation the queries relied on
+        self.brand_cache = (by_input, by_corrected)
+        self.group_cache = {str(group_name).lower(): group_id for group_name, group_id in group_rows}
+        self.topic_cache = {(str(group_name).lower(), str(target_topic).lower()): thread_id for group_name, target_topic, thread_id in topic_rows}
+        # The fuzzy matcher is only imported on the first unknown brand otherwise
+        importlib.import_module("fuzzywuzzy.fuzz")
+        print(f"Debug - Warmed caches: brands={len(brand_rows)}, groups={len(group_rows)}, topics={len(topic_rows)}")
+
+    def _find_brand(self, name, match_input=True):
+        if self.brand_cache is not None:
+            by_input, by_corrected = self.brand_cache
+            return (by_input.get(name.lower()) if match_input else None) or by_corrected.get(name.lower())
+        if match_input:
+            self.cursor.execute(
+                "SELECT corrected_name, target_groups, target_topic FROM brands WHERE input_name = %s OR corrected_name = %s",
+                (name, name)
+            )
+        else:
+            self.cursor.execute(
+                "SELECT corrected_name, target_groups, target_topic FROM brands WHERE corrected_name = %s",
+                (name,)
+            )
+        result = self.cursor.fetchone()
+        if result:
+            return result[0], result[1].split(',') if result[1] else [], result[2]
+        return None
+
+    def rebuild_lookup_filters(self):
+        try:
+            self.cursor.execute(
+                "SELECT photo_ids, watermarked_photo_ids FROM posts "
+                "UNION ALL "
+                "SELECT photo_ids, watermarked_photo_ids FROM posts_archive"
+            )
+            post_rows = self.cursor.fetchall()
+            self.conn.commit()
+        except DatabaseError as e:
+            print(f"Error rebuilding lookup filters: {e}")
+            raise
+        # Each post contributes up to two keys; leave room to grow until the next rebuild
+        filters = LookupFilters(capacity=max(BLOOM_CONFIG["capacity"], 4 * len(post_rows)))
+        for row in post_rows:
+            filters.add_post(*row)
+        self.lookup_filters = filters
+        print(f"Debug - Rebuilt lookup filters: posts={len(post_rows)}, bits={filters.posts.size}")
+
+    def archive_old_posts(self, hot_days, batch_size):
+        moved = 0
+        try:
+            while True:
+                self.cursor.execute(
+                    "SELECT id FROM posts WHERE timestamp < NOW() - INTERVAL %s DAY ORDER BY id LIMIT %s",
+                    (hot_days, batch_size)
+                )
+                ids = [row[0] for row in self.cursor.fetchall()]
+                if not ids:
+                    break
+                placeholders = ', '.join(['%s'] * len(ids))
+                self.cursor.execute(f"INSERT IGNORE INTO posts_archive SELECT * FROM posts WHERE id IN ({placeholders})", ids)
+                self.cursor.execute(f"DELETE FROM posts WHERE id IN ({placeholders})", ids)
+                self.conn.commit()
+                moved += len(ids)
+            print(f"Debug - Archived posts older than {hot_days} days: moved={moved}")
+            return moved
+        except DatabaseError as e:
+            print(f"Error archiving posts: {e}")
+            self.conn.rollback()
+            raise
+
     def is_valid_file_id(self, file_id):
         return bool(file_id and isinstance(file_id, str) and len(file_id) > 20 and re.match(r'^[A-Za-z0-9_-]+$', file_id))
 
@@ -23,54 +256,34 @@ class Database:
 
         if input_brand == 'man':
             print(f"Debug - Input is 'man', returning unchanged")
-            self.cursor.execute(
-                "SELECT corrected_name, target_groups, target_topic FROM brands WHERE input_name = %s OR corrected_name = %s",
-                (input_brand, input_brand)
-            )
-            result = self.cursor.fetchone()
+            result = self._find_brand(input_brand)
             if result:
                 print(f"Debug - Found match in database for 'man': {result}")
-                target_groups = result[1].split(',') if result[1] else []
-                return result[0], target_groups, result[2]
+                return result
             return 'Man', [], None
 
         try:
             if input_brand in BRAND_ABBREVIATIONS:
                 corrected_brand = BRAND_ABBREVIATIONS[input_brand].lower()
                 print(f"Debug - Matched abbreviation: {input_brand} → {corrected_brand}")
-                self.cursor.execute(
-                    "SELECT corrected_name, target_groups, target_topic FROM brands WHERE input_name = %s OR corrected_name = %s",
-                    (corrected_brand, corrected_brand)
-                )
-                result = self.cursor.fetchone()
+                result = self._find_brand(corrected_brand)
                 if result:
                     print(f"Debug - Found match in database for abbreviation: {result}")
-                    target_groups = result[1].split(',') if result[1] else []
-                    return result[0], target_groups, result[2]
+                    return result
                 return corrected_brand, [], None
 
-            self.cursor.execute(
-                "SELECT corrected_name, target_groups, target_topic FROM brands WHERE input_name = %s OR corrected_name = %s",
-                (input_brand, input_brand)
-            )
-            result = self.cursor.fetchone()
+            result = self._find_brand(input_brand)
             if result:
                 print(f"Debug - Found exact match in database: {input_brand} → {result[0]}")
-                target_groups = result[1].split(',') if result[1] else []
-                return result[0], target_groups, result[2]
+                return result
 
             for brand in KNOWN_BRANDS:
                 if brand.lower().startswith(input_brand):
                     print(f"Debug - Prefix match: input={input_brand}, brand={brand}")
-                    self.cursor.execute(
-                        "SELECT corrected_name, target_groups, target_topic FROM brands WHERE corrected_name = %s",
-                        (brand,)
-                    )
-                    result = self.cursor.fetchone()
+                    result = self._find_brand(brand, match_input=False)
                     if result:
                         print(f"Debug - Found in database after prefix match: {result}")
-                        target_groups = result[1].split(',') if result[1] else []
-                        return result[0], target_groups, result[2]
+                        return result
                     return brand, [], None
 
             from fuzzywuzzy import fuzz
@@ -78,23 +291,20 @@ class Database:
             match_score = fuzz.partial_ratio(input_brand, best_match.lower()) if best_match != "Unknown" else 0
             print(f"Debug - Fuzzy match: input={input_brand}, best_match={best_match}, score={match_score}")
             if best_match != "Unknown" and match_score > 80:
-                self.cursor.execute(
-                    "SELECT corrected_name, target_groups, target_topic FROM brands WHERE corrected_name = %s",
-                    (best_match,)
-                )
-                result = self.cursor.fetchone()
+                result = self._find_brand(best_match, match_input=False)
                 if result:
                     print(f"Debug - Found in database after fuzzy match: {result}")
-                    target_groups = result[1].split(',') if result[1] else []
-                    return result[0], target_groups, result[2]
+                    return result
                 return best_match, [], None
 
             return "Unknown", [], None
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error in get_corrected_brand: {e}")
             raise
 
     def get_group_info(self, group_name):
+        if self.group_cache is not None:
+            return self.group_cache.get(str(group_name).lower())
         try:
             self.cursor.execute(
                 "SELECT group_id FROM groupss WHERE group_name = %s",
@@ -103,11 +313,13 @@ class Database:
             result = self.cursor.fetchone()
             print(f"Group info for {group_name}: {result}")
             return result[0] if result else None
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error fetching group info for {group_name}: {e}")
             raise
 
     def get_topic_thread_id(self, group_name, target_topic):
+        if self.topic_cache is not None:
+            return self.topic_cache.get((str(group_name).lower(), str(target_topic).lower()))
         try:
             self.cursor.execute(
                 "SELECT message_thread_id FROM topics WHERE group_name = %s AND target_topic = %s",
@@ -116,129 +328,173 @@ class Database:
             result = self.cursor.fetchone()
             print(f"Topic thread ID for {group_name}, {target_topic}: {result}")
             return result[0] if result else None
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error fetching topic thread ID for {group_name}, {target_topic}: {e}")
             raise
 
+    def _fetch_posts(self, sql, params, fetch_all=False):
+        # Recent posts live in the hot table; the archive is only searched on a miss
+        result = None
+        for table in ('posts', 'posts_archive'):
+            self.cursor.execute(sql.format(posts=table), params)
+            result = self.cursor.fetchall() if fetch_all else self.cursor.fetchone()
+            if result:
+                if table != 'posts':
+                    metrics.incr("db.posts_archive_hits")
+                return result
+        return result
+
+    def _update_posts(self, sql, params):
+        for table in ('posts', 'posts_archive'):
+            self.cursor.execute(sql.format(posts=table), params)
+            if self.cursor.rowcount:
+                break
+        self.conn.commit()
+
+    def _cached_post(self, field, value, sql, params, client_chat_id=None):
+        # Look a post up through the write-through cache, filling it from the database on a miss
+        if self.post_cache is not None:
+            record = self.post_cache.get(field, value)
+            # Message ids repeat across chats, so a cached post from another chat is a miss
+            if record is not None and (client_chat_id is None or record["client_chat_id"] == client_chat_id):
+                return record
+        row = self._fetch_posts(sql, params)
+        if not row:
+            return None
+        if self.post_cache is not None:
+            self.post_cache.put_row(row)
+        return dict(zip(POST_COLUMNS, row))
+
     def get_post_by_message_id(self, message_id):
         try:
-            self.cursor.execute(
-                "SELECT brand, price, original_price, photo_ids, client_message_id, client_chat_id, client_topic_name, sizes "
-                "FROM posts WHERE message_id = %s",
+            post = self._cached_post(
+                "message_id", message_id,
+                "SELECT brand, price, original_price, photo_ids, client_message_id, client_chat_id, client_topic_name, sizes, buyer_message_ids, message_id, forward_from_message_id, adjusted_price "
+                "FROM {posts} WHERE message_id = %s",
                 (message_id,)
             )
-            return self.cursor.fetchone()
-        except mysql.connector.Error as e:
+            return project(post, POST_COLUMNS[:8]) if post else None
+        except DatabaseError as e:
             print(f"Error in get_post_by_message_id: {e}")
             raise
 
     def get_post_by_client_message_id(self, client_message_id):
         try:
-            self.cursor.execute(
-                "SELECT brand, price, original_price, photo_ids, client_message_id, client_chat_id, client_topic_name, sizes, buyer_message_ids "
-                "FROM posts WHERE client_message_id = %s",
+            post = self._cached_post(
+                "client_message_id", client_message_id,
+                "SELECT brand, price, original_price, photo_ids, client_message_id, client_chat_id, client_topic_name, sizes, buyer_message_ids, message_id, forward_from_message_id, adjusted_price "
+                "FROM {posts} WHERE client_message_id = %s",
                 (client_message_id,)
             )
-            return self.cursor.fetchone()
-        except mysql.connector.Error as e:
+            return project(post, POST_COLUMNS[:9]) if post else None
+        except DatabaseError as e:
             print(f"Error in get_post_by_client_message_id: {e}")
             raise
 
     def get_post_by_forward_from_message_id(self, forward_from_message_id):
         try:
-            self.cursor.execute(
-                "SELECT brand, price, original_price, photo_ids, client_message_id, client_chat_id, client_topic_name, sizes "
-                "FROM posts WHERE forward_from_message_id = %s OR client_message_id = %s",
+            post = None
+            if self.post_cache is not None:
+                post = self.post_cache.get("client_message_id", forward_from_message_id)
+            post = post or self._cached_post(
+                "forward_from_message_id", forward_from_message_id,
+                "SELECT brand, price, original_price, photo_ids, client_message_id, client_chat_id, client_topic_name, sizes, buyer_message_ids, message_id, forward_from_message_id, adjusted_price "
+                "FROM {posts} WHERE forward_from_message_id = %s OR client_message_id = %s",
                 (forward_from_message_id, forward_from_message_id)
             )
-            return self.cursor.fetchone()
-        except mysql.connector.Error as e:
+            return project(post, POST_COLUMNS[:8]) if post else None
+        except DatabaseError as e:
             print(f"Error in get_post_by_forward_from_message_id: {e}")
             raise
 
     def get_post_by_photo_id(self, photo_id, brand):
         try:
-            self.cursor.execute(
+            return self._fetch_posts(
                 "SELECT brand, price, original_price, photo_ids, client_message_id, client_chat_id, client_topic_name, sizes "
-                "FROM posts WHERE (photo_ids LIKE %s OR watermarked_photo_ids LIKE %s) AND brand = %s AND client_message_id IS NOT NULL "
+                "FROM {posts} WHERE (photo_ids LIKE %s OR watermarked_photo_ids LIKE %s) AND brand = %s AND client_message_id IS NOT NULL "
                 "ORDER BY timestamp DESC LIMIT 1",
                 (f'%{photo_id}%', f'%{photo_id}%', brand)
             )
-            return self.cursor.fetchone()
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error in get_post_by_photo_id: {e}")
             raise
 
     def get_client_message_id_by_photo_id(self, photo_id, brand):
         try:
-            self.cursor.execute(
+            result = self._fetch_posts(
                 "SELECT client_message_id "
-                "FROM posts WHERE (photo_ids LIKE %s OR watermarked_photo_ids LIKE %s) AND brand = %s AND client_message_id IS NOT NULL "
+                "FROM {posts} WHERE (photo_ids LIKE %s OR watermarked_photo_ids LIKE %s) AND brand = %s AND client_message_id IS NOT NULL "
                 "ORDER BY timestamp DESC LIMIT 1",
                 (f'%{photo_id}%', f'%{photo_id}%', brand)
             )
-            result = self.cursor.fetchone()
             return result[0] if result else None
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error in get_client_message_id_by_photo_id: {e}")
             raise
 
     def get_post_by_caption(self, brand, price):
         try:
-            self.cursor.execute(
+            return self._fetch_posts(
                 "SELECT brand, price, original_price, photo_ids, client_message_id, client_chat_id, client_topic_name, sizes "
-                "FROM posts WHERE brand = %s AND (original_price = %s OR price = %s) AND client_message_id IS NOT NULL "
+                "FROM {posts} WHERE brand = %s AND (original_price = %s OR price = %s) AND client_message_id IS NOT NULL "
                 "ORDER BY timestamp DESC LIMIT 1",
                 (brand, price, price)
             )
-            return self.cursor.fetchone()
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error in get_post_by_caption: {e}")
             raise
 
     def get_post_by_photo_ids_and_brand(self, photo_ids, brand):
         photo_ids_str = ','.join(photo_ids)
         try:
-            self.cursor.execute(
+            return self._fetch_posts(
                 "SELECT brand, price, original_price, photo_ids, client_message_id, client_chat_id, client_topic_name, sizes "
-                "FROM posts WHERE brand = %s AND photo_ids = %s AND client_message_id IS NOT NULL "
+                "FROM {posts} WHERE brand = %s AND photo_ids = %s AND client_message_id IS NOT NULL "
                 "ORDER BY timestamp DESC LIMIT 1",
                 (brand, photo_ids_str)
             )
-            return self.cursor.fetchone()
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error in get_post_by_photo_ids_and_brand: {e}")
             raise
 
     def get_post_by_brand_and(self, brand):
         try:
-            self.cursor.execute(
+            return self._fetch_posts(
                 "SELECT brand, price, original_price, photo_ids, client_message_id, client_chat_id, client_topic_name, sizes "
-                "FROM posts WHERE brand = %s AND client_message_id IS NOT NULL "
+                "FROM {posts} WHERE brand = %s AND client_message_id IS NOT NULL "
                 "ORDER BY timestamp DESC LIMIT 1",
                 (brand,)
             )
-            return self.cursor.fetchone()
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error in get_post_by_brand_and: {e}")
             raise
 
     def log_post(self, bot_name, message_id, brand, price, adjusted_price, sizes, photo_ids, client_message_id=None,
                  client_chat_id=None, client_topic_name=None, forward_from_message_id=None, watermarked_photo_ids=None,
-                 buyer_message_ids=None):
+                 buyer_message_ids=None, caption=None):
         try:
             original_price = float(price) / (1 + int(float(adjusted_price.strip('%'))) / 100) if adjusted_price else float(
                 price)
             buyer_message_ids_str = ','.join(map(str, buyer_message_ids)) if buyer_message_ids else None
             self.cursor.execute(
-                "INSERT INTO posts (bot_name, message_id, brand, price, original_price, adjusted_price, sizes, photo_ids, client_message_id, client_chat_id, client_topic_name, forward_from_message_id, watermarked_photo_ids, buyer_message_ids) "
-                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                "INSERT INTO posts (bot_name, message_id, brand, price, original_price, adjusted_price, sizes, photo_ids, client_message_id, client_chat_id, client_topic_name, forward_from_message_id, watermarked_photo_ids, buyer_message_ids, caption) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
                 (bot_name, message_id, brand, float(price), original_price, adjusted_price, sizes, photo_ids,
                  client_message_id, client_chat_id, client_topic_name, forward_from_message_id, watermarked_photo_ids,
-                 buyer_message_ids_str)
+                 buyer_message_ids_str, caption)
             )
             self.conn.commit()
-        except mysql.connector.Error as e:
+            if self.lookup_filters:
+                self.lookup_filters.add_post(photo_ids, watermarked_photo_ids)
+            if self.post_cache is not None:
+                self.post_cache.put({
+                    "brand": brand, "price": float(price), "original_price": original_price, "photo_ids": photo_ids,
+                    "client_message_id": client_message_id, "client_chat_id": client_chat_id,
+                    "client_topic_name": client_topic_name, "sizes": sizes, "buyer_message_ids": buyer_message_ids_str,
+                    "message_id": message_id, "forward_from_message_id": forward_from_message_id,
+                    "adjusted_price": adjusted_price
+                })
+        except DatabaseError as e:
             print(f"Error logging post: {e}")
             self.conn.rollback()
             raise
@@ -246,29 +502,33 @@ class Database:
     def get_existing_posts(self, brand, photo_ids, price=None, forward_from_message_id=None):
         photo_ids_str = ','.join(photo_ids)
         try:
+            if self.lookup_filters and not forward_from_message_id and not self.lookup_filters.might_have_post(f"p:{photo_ids_str}"):
+                return []
             if forward_from_message_id:
-                self.cursor.execute(
+                return self._fetch_posts(
                     "SELECT client_message_id, client_chat_id, client_topic_name, adjusted_price, sizes "
-                    "FROM posts WHERE (forward_from_message_id = %s OR client_message_id = %s) AND client_message_id IS NOT NULL "
+                    "FROM {posts} WHERE (forward_from_message_id = %s OR client_message_id = %s) AND client_message_id IS NOT NULL "
                     "ORDER BY timestamp DESC LIMIT 1",
-                    (forward_from_message_id, forward_from_message_id)
+                    (forward_from_message_id, forward_from_message_id),
+                    fetch_all=True
                 )
             elif price:
-                self.cursor.execute(
+                return self._fetch_posts(
                     "SELECT client_message_id, client_chat_id, client_topic_name, adjusted_price, sizes "
-                    "FROM posts WHERE brand = %s AND (photo_ids = %s OR watermarked_photo_ids = %s) AND (price = %s OR original_price = %s) AND client_message_id IS NOT NULL "
+                    "FROM {posts} WHERE brand = %s AND (photo_ids = %s OR watermarked_photo_ids = %s) AND (price = %s OR original_price = %s) AND client_message_id IS NOT NULL "
                     "ORDER BY timestamp DESC LIMIT 1",
-                    (brand, photo_ids_str, photo_ids_str, price, price)
+                    (brand, photo_ids_str, photo_ids_str, price, price),
+                    fetch_all=True
                 )
             else:
-                self.cursor.execute(
+                return self._fetch_posts(
                     "SELECT client_message_id, client_chat_id, client_topic_name, adjusted_price, sizes "
-                    "FROM posts WHERE brand = %s AND (photo_ids = %s OR watermarked_photo_ids = %s) AND client_message_id IS NOT NULL "
+                    "FROM {posts} WHERE brand = %s AND (photo_ids = %s OR watermarked_photo_ids = %s) AND client_message_id IS NOT NULL "
                     "ORDER BY timestamp DESC LIMIT 1",
-                    (brand, photo_ids_str, photo_ids_str)
+                    (brand, photo_ids_str, photo_ids_str),
+                    fetch_all=True
                 )
-            return self.cursor.fetchall()
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error in get_existing_posts: {e}")
             raise
 
@@ -297,7 +557,7 @@ class Database:
             self.conn.commit()
             print(
                 f"Debug - Logged photo: user_id={user_id}, message_id={message_id}, batch_id={batch_id}, photos={photo_ids_str}, media_group_id={media_group_id}, forward_from_message_id={forward_from_message_id}")
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Debug - Database error logging pending photos: {e}")
             self.conn.rollback()
             raise
@@ -333,7 +593,7 @@ class Database:
             results = self.cursor.fetchall()
             print(f"Debug - Fetched pending photos for user_id={user_id}: count={len(results)}")
             return results
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Debug - Error fetching pending photos: {e}")
             return []
 
@@ -354,7 +614,7 @@ class Database:
             self.conn.commit()
             print(
                 f"Debug - Cleared pending photos: user_id={user_id}, batch_id={batch_id}, message_id={message_id}, media_group_id={media_group_id}")
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Debug - Error clearing pending_photos: {e}")
             self.conn.rollback()
             raise
@@ -380,7 +640,7 @@ class Database:
             )
             self.conn.commit()
             print(f"Debug - Queued post: user_id={user_id}, message_id={message_id}, batch_id={batch_id}, photo_count={photo_count}")
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error queuing post: {e}")
             self.conn.rollback()
             raise
@@ -388,6 +648,25 @@ class Database:
             print(f"Error queuing post: {e}")
             raise
 
+    def queue_posts(self, rows, batch_size=500):
+        # rows: (user_id, photo_ids_str, description, photo_count, message_id, batch_id, forward_from_message_id);
+        # the plain cursor turns executemany INSERTs into multi-row statements
+        try:
+            for start in range(0, len(rows), batch_size):
+                chunk = rows[start:start + batch_size]
+                self.cursor.executemany(
+                    "INSERT INTO post_queue (user_id, photo_ids, photo_ids_str, description, photo_count, message_id, status, batch_id, forward_from_message_id) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, 'pending', %s, %s)",
+                    [(user_id, photo_ids_str, photo_ids_str, description, photo_count, message_id, batch_id, forward_from_message_id)
+                     for user_id, photo_ids_str, description, photo_count, message_id, batch_id, forward_from_message_id in chunk]
+                )
+                self.conn.commit()
+            print(f"Debug - Bulk queued posts: {len(rows)}")
+        except DatabaseError as e:
+            print(f"Error bulk queuing posts: {e}")
+            self.conn.rollback()
+            raise
+
     def check_queue_duplicate(self, user_id, photo_ids, photo_count, description):
         try:
             photo_ids_str = ','.join(photo_ids)
@@ -397,7 +676,7 @@ class Database:
             )
             result = self.cursor.fetchone()
             return result is not None
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error in check_queue_duplicate: {e}")
             raise
 
@@ -408,7 +687,7 @@ class Database:
                 (user_id, message_id)
             )
             return self.cursor.fetchone()
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error in check_queue_by_message_id: {e}")
             raise
 
@@ -419,10 +698,21 @@ class Database:
                 "FROM post_queue WHERE status = 'pending' ORDER BY timestamp ASC LIMIT 1"
             )
             return self.cursor.fetchone()
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error in get_next_queued_post: {e}")
             raise
 
+    def get_pending_queue_posts(self):
+        try:
+            self.cursor.execute(
+                "SELECT id, user_id, photo_ids_str, photo_count, description, message_id, forward_from_message_id, batch_id "
+                "FROM post_queue WHERE status = 'pending' ORDER BY timestamp ASC, id ASC"
+            )
+            return self.cursor.fetchall()
+        except DatabaseError as e:
+            print(f"Error in get_pending_queue_posts: {e}")
+            raise
+
     def update_queue_status(self, post_id, status):
         try:
             self.cursor.execute(
@@ -430,7 +720,7 @@ class Database:
                 (status, post_id)
             )
             self.conn.commit()
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error updating queue status for post_id={post_id}: {e}")
             self.conn.rollback()
             raise
@@ -440,23 +730,153 @@ class Database:
             self.cursor.execute("DELETE FROM post_queue")
             self.conn.commit()
             print(f"Debug - Cleared all posts from post_queue")
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error clearing post_queue: {e}")
             self.conn.rollback()
             raise
 
-    def update_post_price(self, client_message_id, price, adjusted_price):
+    def clear_stale_pending_photos(self, user_id):
         try:
             self.cursor.execute(
-                "UPDATE posts SET price = %s, adjusted_price = %s WHERE client_message_id = %s",
-                (price, adjusted_price, client_message_id)
+                "DELETE FROM pending_photos WHERE user_id = %s AND created_at < NOW() - INTERVAL 1 HOUR",
+                (user_id,)
+            )
+            self.conn.commit()
+        except DatabaseError as e:
+            print(f"Error clearing stale pending photos: {e}")
+            self.conn.rollback()
+            raise
+
+    def count_pending_photos(self, user_id):
+        try:
+            self.cursor.execute("SELECT COUNT(*) FROM pending_photos WHERE user_id = %s", (user_id,))
+            count = self.cursor.fetchone()[0]
+            self.conn.commit()
+            return count
+        except DatabaseError as e:
+            print(f"Error in count_pending_photos: {e}")
+            raise
+
+    def count_queued_posts(self, user_id):
+        try:
+            self.cursor.execute("SELECT COUNT(*) FROM post_queue WHERE user_id = %s", (user_id,))
+            count = self.cursor.fetchone()[0]
+            self.conn.commit()
+            return count
+        except DatabaseError as e:
+            print(f"Error in count_queued_posts: {e}")
+            raise
+
+    def update_post_client_message_id(self, client_message_id, new_client_message_id):
+        try:
+            self._update_posts(
+                "UPDATE {posts} SET client_message_id = %s WHERE client_message_id = %s",
+                (new_client_message_id, client_message_id)
+            )
+            if self.post_cache is not None:
+                self.post_cache.update("client_message_id", client_message_id, client_message_id=new_client_message_id)
+        except DatabaseError as e:
+            print(f"Error updating client_message_id: {e}")
+            self.conn.rollback()
+            raise
+
+    def log_deliveries(self, client_chat_id, client_message_id, deliveries):
+        # Telegram message ids are only unique within a chat, so deliveries are keyed by the client chat as well
+        try:
+            self.cursor.executemany(
+                "INSERT INTO post_deliveries (client_chat_id, client_message_id, chat_id, buyer_group, message_id, album_size, status) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                [(client_chat_id, client_message_id) + tuple(delivery) for delivery in deliveries]
+            )
+            self.conn.commit()
+        except DatabaseError as e:
+            print(f"Error logging deliveries: {e}")
+            self.conn.rollback()
+            raise
+
+    def get_deliveries(self, client_chat_id, client_message_id, status='sent'):
+        try:
+            self.cursor.execute(
+                "SELECT id, chat_id, buyer_group, message_id, album_size FROM post_deliveries "
+                "WHERE client_chat_id = %s AND client_message_id = %s AND status = %s AND message_id IS NOT NULL",
+                (client_chat_id, client_message_id, status)
+            )
+            return self.cursor.fetchall()
+        except DatabaseError as e:
+            print(f"Error in get_deliveries: {e}")
+            raise
+
+    def update_deliveries(self, updates):
+        try:
+            self.cursor.executemany(
+                "UPDATE post_deliveries SET message_id = %s, album_size = %s, status = %s WHERE id = %s",
+                list(updates)
             )
             self.conn.commit()
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
+            print(f"Error updating deliveries: {e}")
+            self.conn.rollback()
+            raise
+
+    def rekey_deliveries(self, client_chat_id, client_message_id, new_client_message_id):
+        try:
+            self.cursor.execute(
+                "UPDATE post_deliveries SET client_message_id = %s WHERE client_chat_id = %s AND client_message_id = %s",
+                (new_client_message_id, client_chat_id, client_message_id)
+            )
+            self.conn.commit()
+        except DatabaseError as e:
+            print(f"Error rekeying deliveries: {e}")
+            self.conn.rollback()
+            raise
+
+    def update_post_price(self, client_message_id, price, adjusted_price):
+        try:
+            self._update_posts(
+                "UPDATE {posts} SET price = %s, adjusted_price = %s WHERE client_message_id = %s",
+                (price, adjusted_price, client_message_id)
+            )
+            if self.post_cache is not None:
+                self.post_cache.update("client_message_id", client_message_id, price=price, adjusted_price=adjusted_price)
+        except DatabaseError as e:
             print(f"Error updating post_price: {e}")
             self.conn.rollback()
             raise
 
+    def get_reprice_candidates(self, table, bot_name, brand=None, since=None, until=None, after_id=0, limit=200):
+        try:
+            self.cursor.execute(
+                "SELECT id, brand, original_price, photo_ids, client_message_id, client_chat_id, caption FROM {posts} "
+                "WHERE bot_name = %s AND id > %s AND client_message_id IS NOT NULL "
+                "AND (%s IS NULL OR brand = %s) AND (%s IS NULL OR timestamp >= %s) AND (%s IS NULL OR timestamp < %s) "
+                "ORDER BY id LIMIT %s".format(posts=table),
+                (bot_name, after_id, brand, brand, since, since, until, until, limit)
+            )
+            return self.cursor.fetchall()
+        except DatabaseError as e:
+            print(f"Error in get_reprice_candidates: {e}")
+            raise
+
+    def update_post_prices(self, updates):
+        # updates: (price, adjusted_price, client_chat_id, client_message_id), applied in one transaction per call
+        try:
+            for table in ('posts', 'posts_archive'):
+                self.cursor.executemany(
+                    "UPDATE {posts} SET price = %s, adjusted_price = %s WHERE client_chat_id = %s AND client_message_id = %s".format(posts=table),
+                    updates
+                )
+            self.conn.commit()
+            if self.post_cache is not None:
+                for price, adjusted_price, client_chat_id, client_message_id in updates:
+                    self.post_cache.update(
+                        "client_message_id", client_message_id, where={"client_chat_id": client_chat_id},
+                        price=price, adjusted_price=adjusted_price
+                    )
+        except DatabaseError as e:
+            print(f"Error updating post prices: {e}")
+            self.conn.rollback()
+            raise
+
     def log_forwarded_post(self, user_id, bot_name, message_id, brand, photo_ids, caption, forward_from_message_id,
                            client_message_id):
         try:
@@ -467,7 +887,7 @@ class Database:
                 (user_id, bot_name, message_id, brand, photo_ids_str, caption, forward_from_message_id, client_message_id)
             )
             self.conn.commit()
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error logging forwarded_post: {e}")
             self.conn.rollback()
             raise
@@ -479,26 +899,111 @@ class Database:
                 (message_id,)
             )
             self.conn.commit()
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error deleting forwarded_post: {e}")
             self.conn.rollback()
             raise
 
-    def clear_stale_forwarded_posts(self, user_id):
+    def get_forwarded_posts(self, bot_name):
         try:
             self.cursor.execute(
-                "DELETE FROM forwarded_posts WHERE user_id = %s AND timestamp < NOW() - INTERVAL 1 DAY",
-                (user_id,)
+                "SELECT user_id, message_id, client_message_id, caption FROM forwarded_posts WHERE bot_name = %s",
+                (bot_name,)
+            )
+            return self.cursor.fetchall()
+        except DatabaseError as e:
+            print(f"Error in get_forwarded_posts: {e}")
+            raise
+
+    def clear_forwarded_posts(self, bot_name):
+        try:
+            self.cursor.execute(
+                "DELETE FROM forwarded_posts WHERE bot_name = %s",
+                (bot_name,)
+            )
+            self.conn.commit()
+        except DatabaseError as e:
+            print(f"Error clearing forwarded_posts: {e}")
+            self.conn.rollback()
+            raise
+
+    def log_photo_hashes(self, bot_name, client_chat_id, client_message_id, hashes):
+        try:
+            self.cursor.executemany(
+                "INSERT INTO photo_hashes (bot_name, client_chat_id, client_message_id, phash) VALUES (%s, %s, %s, %s)",
+                [(bot_name, client_chat_id, client_message_id, f"{value:016x}") for value in hashes]
+            )
+            self.conn.commit()
+        except DatabaseError as e:
+            print(f"Error logging photo hashes: {e}")
+            self.conn.rollback()
+            raise
+
+    def rekey_photo_hashes(self, bot_name, client_chat_id, client_message_id, new_client_message_id):
+        try:
+            self.cursor.execute(
+                "UPDATE photo_hashes SET client_message_id = %s WHERE bot_name = %s AND client_chat_id = %s AND client_message_id = %s",
+                (new_client_message_id, bot_name, client_chat_id, client_message_id)
             )
             self.conn.commit()
-        except mysql.connector.Error as e:
-            print(f"Error clearing stale forwarded_posts: {e}")
+        except DatabaseError as e:
+            print(f"Error rekeying photo hashes: {e}")
             self.conn.rollback()
             raise
 
+    def get_recent_photo_hashes(self, bot_name, days):
+        try:
+            self.cursor.execute(
+                "SELECT phash, client_chat_id, client_message_id, created_at FROM photo_hashes "
+                "WHERE bot_name = %s AND created_at >= NOW() - INTERVAL %s DAY",
+                (bot_name, days)
+            )
+            return self.cursor.fetchall()
+        except DatabaseError as e:
+            print(f"Error in get_recent_photo_hashes: {e}")
+            raise
+
+    def get_posts_without_hashes(self, bot_name, limit=None):
+        try:
+            query = (
+                "SELECT p.client_chat_id, p.client_message_id, p.photo_ids FROM posts p "
+                "LEFT JOIN photo_hashes h ON h.client_chat_id = p.client_chat_id AND h.client_message_id = p.client_message_id AND h.bot_name = p.bot_name "
+                "WHERE p.bot_name = %s AND p.client_message_id IS NOT NULL AND h.id IS NULL "
+                "ORDER BY p.timestamp DESC"
+            )
+            params = [bot_name]
+            if limit:
+                query += " LIMIT %s"
+                params.append(limit)
+            self.cursor.execute(query, params)
+            return self.cursor.fetchall()
+        except DatabaseError as e:
+            print(f"Error in get_posts_without_hashes: {e}")
+            raise
+
+    def get_existing_post_by_client_message_id(self, client_chat_id, client_message_id):
+        try:
+            post = self._cached_post(
+                "client_message_id", client_message_id,
+                "SELECT brand, price, original_price, photo_ids, client_message_id, client_chat_id, client_topic_name, sizes, buyer_message_ids, message_id, forward_from_message_id, adjusted_price "
+                "FROM {posts} WHERE client_chat_id = %s AND client_message_id = %s",
+                (client_chat_id, client_message_id),
+                client_chat_id=client_chat_id
+            )
+            return project(post, ("client_message_id", "client_chat_id", "client_topic_name", "adjusted_price", "sizes")) if post else None
+        except DatabaseError as e:
+            print(f"Error in get_existing_post_by_client_message_id: {e}")
+            raise
+
     def close(self):
+        if self.conn is None:
+            return
         try:
             self.cursor.close()
             self.conn.close()
-        except mysql.connector.Error as e:
-            print(f"Error closing database: {e}")
\ No newline at end of file
+        except DatabaseError as e:
+            print(f"Error closing database: {e}")
+
+for _name, _func in list(vars(Database).items()):
+    if callable(_func) and not _name.startswith('_') and _name not in ('is_valid_file_id', 'connect', 'close'):
+        setattr(Database, _name, _instrument(_name, _func))
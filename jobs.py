@@ -0,0 +1,20 @@
+class PostJob:
+    __slots__ = ('post_id', 'user_id', 'message_id', 'photo_ids', 'caption', 'forward_from_message_id', 'batch_id', 'trace')
+
+    def __init__(self, post_id, user_id, message_id, photo_ids, caption, forward_from_message_id=None, batch_id=None):
+        self.post_id = post_id
+        self.user_id = user_id
+        self.message_id = message_id
+        self.photo_ids = photo_ids
+        self.caption = caption or ""
+        self.forward_from_message_id = forward_from_message_id
+        self.batch_id = batch_id
+        self.trace = None
+
+    @classmethod
+    def from_queue_row(cls, row, photo_ids):
+        post_id, user_id, photo_ids_str, photo_count, description, message_id, forward_from_message_id, batch_id = row
+        return cls(post_id, user_id, message_id, photo_ids, description, forward_from_message_id, batch_id)
+
+    def __repr__(self):
+        return f"PostJob(post_id={self.post_id}, user_id={self.user_id}, message_id={self.message_id}, photos={len(self.photo_ids)})"
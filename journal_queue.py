@@ -0,0 +1,318 @@
+import argparse
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from config import QUEUE_CONFIG
+from metrics import metrics
+
+# Rows come back in the post_queue column order used by bot.py and the scheduler:
+# (id, user_id, photo_ids_str, photo_count, description, message_id, forward_from_message_id, batch_id)
+FIELDS = ('id', 'user_id', 'photo_ids', 'photo_count', 'description', 'message_id', 'forward_from_message_id', 'batch_id')
+
+def journal_path(bot_name):
+    return QUEUE_CONFIG["path"].format(bot_name=bot_name)
+
+class JournalQueue:
+    # Drop-in for the post_queue methods of Database. Every change is appended to the journal as one
+    # CRC-framed JSON line and flushed to the OS right away; fsync is batched by a background thread, so a
+    # process crash loses nothing and a power loss at most the last fsync_interval of changes
+    def __init__(self, path, config=None):
+        self.config = config or QUEUE_CONFIG
+        self.path = path
+        self.lock = threading.RLock()
+        self.file = None
+        self.lock_file = None
+        self.entries = {}  # id -> {field: value, 'status', 'ts'}
+        self.pending = OrderedDict()  # ids in claim order
+        self.by_batch = {}
+        self.by_content = {}
+        self.by_message = {}
+        self.per_user = Counter()
+        self.next_id = 1
+        self.records = 0  # lines in the journal since the last compaction
+        self.dirty = False
+        self.stopped = threading.Event()
+
+    def open(self):
+        started = time.perf_counter()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.lock_file = open(self.path + '.lock', 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            raise RuntimeError(f"Queue journal {self.path} is in use by another process")
+        valid_bytes, torn = self._replay()
+        self.file = open(self.path, 'ab')
+        if torn:
+            # A write cut short by a crash; everything before it was complete
+            print(f"DEBUG - Truncating torn journal tail: path={self.path}, valid_bytes={valid_bytes}")
+            self.file.truncate(valid_bytes)
+        recovered = [post_id for post_id, entry in self.entries.items() if entry['status'] == 'processing']
+        for post_id in recovered:
+            # The crash interrupted these posts; publish_post's duplicate check handles ones already sent
+            self.update_queue_status(post_id, 'pending')
+        self._sync()
+        if self.config["fsync"] == "batch":
+            threading.Thread(target=self._fsync_loop, name="queue-fsync", daemon=True).start()
+        print(f"DEBUG - Opened queue journal: path={self.path}, entries={len(self.entries)}, pending={len(self.pending)}, recovered={len(recovered)}, in {(time.perf_counter() - started) * 1000:.0f}ms")
+        return self
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            if self.file:
+                self._sync()
+                self.file.close()
+                self.file = None
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return 0, False
+        valid_bytes = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                record = self._decode(line)
+                if record is None:
+                    return valid_bytes, True
+                self._apply(record)
+                self.records += 1
+                valid_bytes += len(line)
+        return valid_bytes, False
+
+    @staticmethod
+    def _encode(record):
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return b'%08x ' % zlib.crc32(payload) + payload + b'\n'
+
+    @staticmethod
+    def _decode(line):
+        if not line.endswith(b'\n') or len(line) < 10:
+            return None
+        payload = line[9:-1]
+        try:
+            if int(line[:8], 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def _apply(self, record):
+        op = record['op']
+        if op == 'add':
+            entry = {field: record[field] for field in FIELDS}
+            entry['status'] = record.get('status', 'pending')
+            entry['ts'] = record['ts']
+            post_id = entry['id']
+            self.entries[post_id] = entry
+            if entry['status'] == 'pending':
+                self.pending[post_id] = None
+            self.by_batch[(entry['user_id'], entry['batch_id'])] = post_id
+            self.by_content[(entry['user_id'], entry['photo_ids'], entry['photo_count'], entry['description'])] = post_id
+            self.by_message[(entry['user_id'], entry['message_id'])] = post_id
+            self.per_user[entry['user_id']] += 1
+            self.next_id = max(self.next_id, post_id + 1)
+        elif op == 'status':
+            entry = self.entries.get(record['id'])
+            if entry is None:
+                return
+            entry['status'] = record['status']
+            if record['status'] == 'pending':
+                last = next(reversed(self.pending), None)
+                self.pending[record['id']] = None
+                if last is not None and record['id'] < last:
+                    # Requeued posts keep their original place, like ORDER BY timestamp, id on the table
+                    self.pending = OrderedDict((post_id, None) for post_id in sorted(self.pending))
+            else:
+                self.pending.pop(record['id'], None)
+        elif op == 'meta':
+            self.next_id = max(self.next_id, record['next_id'])
+
+    def _reset(self):
+        self.entries.clear()
+        self.pending.clear()
+        self.by_batch.clear()
+        self.by_content.clear()
+        self.by_message.clear()
+        self.per_user.clear()
+
+    def _append(self, records):
+        with self.lock:
+            self.file.write(b''.join(self._encode(record) for record in records))
+            self.file.flush()
+            self.records += len(records)
+            for record in records:
+                self._apply(record)
+            if self.config["fsync"] == "always":
+                os.fsync(self.file.fileno())
+            else:
+                self.dirty = True
+            if self.records >= self.config["compact_min_records"] and self.records > self.config["compact_ratio"] * len(self.entries):
+                self.compact()
+
+    def _sync(self):
+        with self.lock:
+            if self.file and self.config["fsync"] != "never":
+                os.fsync(self.file.fileno())
+                metrics.incr("queue.fsyncs")
+            self.dirty = False
+
+    def _fsync_loop(self):
+        while not self.stopped.wait(self.config["fsync_interval"]):
+            if not self.dirty:
+                continue
+            # fsync on a duplicate descriptor outside the lock, so writers on the loop thread never wait for the disk
+            with self.lock:
+                if self.file is None:
+                    continue
+                fd = os.dup(self.file.fileno())
+                self.dirty = False
+            try:
+                os.fsync(fd)
+                metrics.incr("queue.fsyncs")
+            finally:
+                os.close(fd)
+
+    def compact(self):
+        # Rewrites the journal as one add line per live entry, so status changes and cleared posts stop taking space
+        with self.lock:
+            started = time.perf_counter()
+            records = [{'op': 'meta', 'next_id': self.next_id}]
+            records.extend(dict(entry, op='add') for entry in self.entries.values())
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.path), dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(b''.join(self._encode(record) for record in records))
+                f.flush()
+                os.fsync(f.fileno())
+            self.file.close()
+            os.replace(tmp, self.path)
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            self.file = open(self.path, 'ab')
+            self.records = len(records)
+            self.dirty = False
+            metrics.incr("queue.compactions")
+            metrics.set_gauge("queue.journal_bytes", os.path.getsize(self.path))
+            print(f"DEBUG - Compacted queue journal: entries={len(self.entries)}, in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    def _add_record(self, post_id, user_id, photo_ids_str, description, photo_count, message_id, batch_id, forward_from_message_id):
+        return {
+            'op': 'add', 'id': post_id, 'user_id': user_id, 'photo_ids': photo_ids_str, 'photo_count': photo_count,
+            'description': description, 'message_id': message_id, 'forward_from_message_id': forward_from_message_id,
+            'batch_id': batch_id, 'ts': time.time()
+        }
+
+    def queue_post(self, user_id, photo_ids, description, message_id, photo_count, batch_id=None,
+                   forward_from_message_id=None):
+        if not photo_ids:
+            raise ValueError("photo_ids cannot be empty")
+        with self.lock:
+            if (user_id, batch_id) in self.by_batch:
+                print(f"Debug - Duplicate batch_id detected: user_id={user_id}, batch_id={batch_id}")
+                raise ValueError("Duplicate batch_id in post_queue")
+            self._append([self._add_record(self.next_id, user_id, ','.join(photo_ids), description, photo_count, message_id,
+                                           batch_id, forward_from_message_id)])
+        print(f"Debug - Queued post: user_id={user_id}, message_id={message_id}, batch_id={batch_id}, photo_count={photo_count}")
+
+    def queue_posts(self, rows, batch_size=500):
+        # Same rows as Database.queue_posts; each chunk is one write
+        for start in range(0, len(rows), batch_size):
+            with self.lock:
+                records = []
+                for user_id, photo_ids_str, description, photo_count, message_id, batch_id, forward_from_message_id in rows[start:start + batch_size]:
+                    records.append(self._add_record(self.next_id + len(records), user_id, photo_ids_str, description, photo_count,
+                                                    message_id, batch_id, forward_from_message_id))
+                self._append(records)
+        self._sync()
+
+    def check_queue_duplicate(self, user_id, photo_ids, photo_count, description):
+        return (user_id, ','.join(photo_ids), photo_count, description) in self.by_content
+
+    def check_queue_by_message_id(self, user_id, message_id):
+        post_id = self.by_message.get((user_id, message_id))
+        return (post_id,) if post_id is not None else None
+
+    def _row(self, post_id):
+        entry = self.entries[post_id]
+        return tuple(entry[field] for field in FIELDS)
+
+    def get_next_queued_post(self):
+        with self.lock:
+            for post_id in self.pending:
+                return self._row(post_id)
+        return None
+
+    def get_pending_queue_posts(self):
+        with self.lock:
+            return [self._row(post_id) for post_id in self.pending]
+
+    def update_queue_status(self, post_id, status):
+        if post_id not in self.entries:
+            print(f"Error updating queue status for post_id={post_id}: not in queue")
+            return
+        self._append([{'op': 'status', 'id': post_id, 'status': status}])
+
+    def clear_post_queue(self):
+        with self.lock:
+            self._reset()
+            self.compact()
+        print("Debug - Cleared all posts from post_queue")
+
+    def count_queued_posts(self, user_id):
+        return self.per_user[user_id]
+
+def bench(posts):
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = JournalQueue(os.path.join(tmp, "bench.journal")).open()
+        timings = {}
+        started = time.perf_counter()
+        for n in range(posts):
+            photo_ids = [f"bench{n}_{i}".ljust(40, 'x') for i in range(3)]
+            if not queue.check_queue_duplicate(1, photo_ids, 3, f"Bench {n}"):
+                queue.queue_post(1, photo_ids, f"Bench {n}", n, 3, f"bench-{n}")
+        timings["enqueue"] = time.perf_counter() - started
+        started = time.perf_counter()
+        while True:
+            post = queue.get_next_queued_post()
+            if not post:
+                break
+            queue.update_queue_status(post[0], 'processing')
+            queue.update_queue_status(post[0], 'sent')
+        timings["claim + status"] = time.perf_counter() - started
+        started = time.perf_counter()
+        queue.clear_post_queue()
+        timings["clear"] = time.perf_counter() - started
+        queue.close()
+    for name, seconds in timings.items():
+        per = seconds / posts if name != "clear" else seconds
+        print(f"{name:16} {per * 1e6:10.1f}us{' per post' if name != 'clear' else ''}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Journal-backed post queue tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    stats = sub.add_parser("stats", help="replay a journal and print its state")
+    stats.add_argument("--bot", default=os.getenv("BOT_NAME", "bella"))
+    run_bench = sub.add_parser("bench", help="time queue operations on a temporary journal")
+    run_bench.add_argument("--posts", type=int, default=10000)
+    args = parser.parse_args()
+    if args.command == "stats":
+        # Read-only replay, safe while the bot holds the journal
+        path = journal_path(args.bot)
+        queue = JournalQueue(path)
+        _, torn = queue._replay()
+        statuses = Counter(entry['status'] for entry in queue.entries.values())
+        print(f"{path}: records={queue.records}, entries={len(queue.entries)}, next_id={queue.next_id}, statuses={dict(statuses)}, torn_tail={torn}")
+    else:
+        bench(args.posts)
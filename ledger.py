@@ -0,0 +1,53 @@
+import time
+from config import FORWARDED_POSTS_CONFIG
+
+class ForwardedLedger:
+    def __init__(self, db, bot_name, persist=None):
+        self.db = db
+        self.bot_name = bot_name
+        self.persist = FORWARDED_POSTS_CONFIG["persist"] if persist is None else persist
+        self.in_flight = {}  # message_id -> entry of an update that has not been applied yet
+
+    def begin(self, user_id, message_id, brand, photo_ids, caption, forward_from_message_id, client_message_id):
+        self.in_flight[message_id] = {
+            'user_id': user_id,
+            'brand': brand,
+            'photo_ids': photo_ids,
+            'caption': caption,
+            'forward_from_message_id': forward_from_message_id,
+            'client_message_id': client_message_id,
+            'started': time.time()
+        }
+        if self.persist:
+            try:
+                self.db.log_forwarded_post(
+                    user_id=user_id,
+                    bot_name=self.bot_name,
+                    message_id=message_id,
+                    brand=brand,
+                    photo_ids=photo_ids,
+                    caption=caption,
+                    forward_from_message_id=forward_from_message_id,
+                    client_message_id=client_message_id
+                )
+            except Exception as e:
+                print(f"DEBUG - Error persisting forwarded update: message_id={message_id}, error={e}")
+
+    def finish(self, message_id):
+        entry = self.in_flight.pop(message_id, None)
+        if entry and self.persist:
+            try:
+                self.db.delete_forwarded_post(message_id)
+            except Exception as e:
+                print(f"DEBUG - Error clearing forwarded update: message_id={message_id}, error={e}")
+        return entry
+
+    def recover(self):
+        # Rows left behind belong to updates that were in flight when the previous process died
+        if not self.persist:
+            return []
+        lost = self.db.get_forwarded_posts(self.bot_name)
+        if lost:
+            self.db.clear_forwarded_posts(self.bot_name)
+        print(f"DEBUG - Recovered forwarded updates lost on restart: {len(lost)}")
+        return lost
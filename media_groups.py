@@ -0,0 +1,93 @@
+import asyncio
+import heapq
+import time
+from metrics import metrics
+from config import MEDIA_GROUP_CONFIG
+
+class MediaGroup:
+    __slots__ = ('media_group_id', 'user_id', 'message_id', 'photo_ids', 'caption', 'forward_from_message_id',
+                 'batch_id', 'first_seen', 'last_seen', 'deadline')
+
+    def __init__(self, media_group_id, user_id, message_id, caption, forward_from_message_id, batch_id, now):
+        self.media_group_id = media_group_id
+        self.user_id = user_id
+        self.message_id = message_id
+        self.photo_ids = []
+        self.caption = caption or ''
+        self.forward_from_message_id = forward_from_message_id
+        self.batch_id = batch_id
+        self.first_seen = now
+        self.last_seen = now
+        self.deadline = now
+
+class MediaGroupAssembler:
+    # One loop drives every album: deadlines live in a heap with lazy deletion, so a new photo only pushes a
+    # fresh (deadline, media_group_id) entry and stale entries are skipped when they surface
+    def __init__(self, on_complete, config=None):
+        self.on_complete = on_complete
+        self.config = config or MEDIA_GROUP_CONFIG
+        self.groups = {}
+        self.heap = []
+        self.gap = self.config["quiet_min"] / self.config["quiet_factor"]  # EWMA of the gap between album photos
+        self.wakeup = asyncio.Event()
+
+    def quiet_period(self):
+        return min(max(self.gap * self.config["quiet_factor"], self.config["quiet_min"]), self.config["quiet_max"])
+
+    def add(self, media_group_id, user_id, message_id, photo_ids, caption, forward_from_message_id, batch_id):
+        now = time.monotonic()
+        group = self.groups.get(media_group_id)
+        if group is None:
+            if len(self.groups) >= self.config["max_groups"]:
+                oldest = min(self.groups.values(), key=lambda g: g.first_seen)
+                print(f"DEBUG - Too many open media groups, flushing oldest: media_group_id={oldest.media_group_id}")
+                self._flush(oldest)
+            group = MediaGroup(media_group_id, user_id, message_id, caption, forward_from_message_id, batch_id, now)
+            self.groups[media_group_id] = group
+        else:
+            self.gap = 0.8 * self.gap + 0.2 * min(now - group.last_seen, self.config["quiet_max"])
+            group.last_seen = now
+            if caption:
+                group.caption = caption
+        for photo_id in photo_ids:
+            if photo_id not in group.photo_ids:
+                group.photo_ids.append(photo_id)
+        print(f"DEBUG - Added to media group: media_group_id={media_group_id}, batch_id={group.batch_id}, photo_count={len(group.photo_ids)}")
+
+        if len(group.photo_ids) >= self.config["album_limit"]:
+            # Telegram albums hold at most 10 items, nothing else can arrive
+            self._flush(group)
+            return
+        group.deadline = min(now + self.quiet_period(), group.first_seen + self.config["max_wait"])
+        heapq.heappush(self.heap, (group.deadline, media_group_id))
+        if self.heap[0][1] == media_group_id:
+            self.wakeup.set()
+        metrics.set_gauge("media_groups.open", len(self.groups))
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, media_group_id = heapq.heappop(self.heap)
+                group = self.groups.get(media_group_id)
+                if group is not None and group.deadline == deadline:
+                    self._flush(group)
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _flush(self, group):
+        self.groups.pop(group.media_group_id, None)
+        metrics.set_gauge("media_groups.open", len(self.groups))
+        metrics.observe("media_groups.assembly", time.monotonic() - group.first_seen)
+        print(f"DEBUG - Media group complete: media_group_id={group.media_group_id}, photo_count={len(group.photo_ids)}, quiet={self.quiet_period():.2f}s")
+        asyncio.create_task(self._complete(group))
+
+    async def _complete(self, group):
+        try:
+            await self.on_complete(group)
+        except Exception as e:
+            print(f"DEBUG - Error completing media group {group.media_group_id}: {e}")
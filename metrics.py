@@ -0,0 +1,45 @@
+import time
+
+class Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters = {}
+        self.timers = {}  # name -> [count, total_seconds, max_seconds]
+        self.gauges = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self):
+        return {
+            "uptime": time.time() - self.started_at,
+            "counters": dict(self.counters),
+            "timers": {name: {"count": t[0], "total": t[1], "avg": t[1] / t[0], "max": t[2]} for name, t in self.timers.items()},
+            "gauges": dict(self.gauges)
+        }
+
+    def format_report(self, top=15):
+        lines = [f"Metrics report (uptime {int(time.time() - self.started_at)}s)"]
+        timers = sorted(self.timers.items(), key=lambda kv: kv[1][1], reverse=True)[:top]
+        for name, (count, total, longest) in timers:
+            lines.append(f"  {name}: calls={count}, total={total * 1000:.0f}ms, avg={total / count * 1000:.1f}ms, max={longest * 1000:.1f}ms")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"  {name}: {value}")
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"  {name}: {value}")
+        return '\n'.join(lines)
+
+metrics = Metrics()
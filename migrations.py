@@ -0,0 +1,304 @@
+import argparse
+import ast
+import inspect
+import database
+from config import ARCHIVE_CONFIG, BOT_CONFIGS
+
+# Each step is a SQL statement, ("index", table, index_name, columns), ("column", table, column, definition),
+# ("table_like", table, source_table) or a callable taking the Database. SQL is written for MySQL and
+# translated by the storage backend
+MIGRATIONS = [
+    (1, "initial schema", [
+        "CREATE TABLE IF NOT EXISTS brands ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "input_name VARCHAR(255) NOT NULL, "
+        "corrected_name VARCHAR(255) NOT NULL, "
+        "target_groups VARCHAR(512), "
+        "target_topic VARCHAR(255))",
+        "CREATE TABLE IF NOT EXISTS groupss ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "group_name VARCHAR(255) NOT NULL, "
+        "group_id BIGINT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS topics ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "group_name VARCHAR(255) NOT NULL, "
+        "target_topic VARCHAR(255) NOT NULL, "
+        "message_thread_id BIGINT)",
+        "CREATE TABLE IF NOT EXISTS posts ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "bot_name VARCHAR(32), "
+        "message_id BIGINT, "
+        "brand VARCHAR(255), "
+        "price DOUBLE, "
+        "original_price DOUBLE, "
+        "adjusted_price VARCHAR(16), "
+        "sizes VARCHAR(255), "
+        "photo_ids TEXT, "
+        "client_message_id BIGINT, "
+        "client_chat_id BIGINT, "
+        "client_topic_name VARCHAR(255), "
+        "forward_from_message_id BIGINT, "
+        "watermarked_photo_ids TEXT, "
+        "buyer_message_ids VARCHAR(255), "
+        "timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS pending_photos ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "user_id BIGINT NOT NULL, "
+        "message_id BIGINT, "
+        "photo_ids TEXT, "
+        "batch_id VARCHAR(64), "
+        "media_group_id VARCHAR(64), "
+        "forward_from_message_id BIGINT, "
+        "created_at DATETIME)",
+        "CREATE TABLE IF NOT EXISTS post_queue ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "user_id BIGINT NOT NULL, "
+        "photo_ids TEXT, "
+        "photo_ids_str TEXT, "
+        "description TEXT, "
+        "photo_count INT, "
+        "message_id BIGINT, "
+        "status VARCHAR(16) DEFAULT 'pending', "
+        "batch_id VARCHAR(64), "
+        "forward_from_message_id BIGINT, "
+        "timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS forwarded_posts ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "user_id BIGINT, "
+        "bot_name VARCHAR(32), "
+        "message_id BIGINT, "
+        "brand VARCHAR(255), "
+        "photo_ids TEXT, "
+        "caption TEXT, "
+        "forward_from_message_id BIGINT, "
+        "client_message_id BIGINT, "
+        "timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE TABLE IF NOT EXISTS photo_hashes ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "bot_name VARCHAR(32) NOT NULL, "
+        "client_message_id BIGINT NOT NULL, "
+        "phash CHAR(16) NOT NULL, "
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+    ]),
+    (2, "indexes for database.py lookups", [
+        ("index", "brands", "idx_brands_input_name", ["input_name"]),
+        ("index", "brands", "idx_brands_corrected_name", ["corrected_name"]),
+        ("index", "groupss", "idx_groupss_group_name", ["group_name"]),
+        ("index", "topics", "idx_topics_group_topic", ["group_name", "target_topic"]),
+        ("index", "posts", "idx_posts_message_id", ["message_id"]),
+        ("index", "posts", "idx_posts_client_message_id", ["client_message_id"]),
+        ("index", "posts", "idx_posts_forward_from_message_id", ["forward_from_message_id"]),
+        ("index", "posts", "idx_posts_brand_timestamp", ["brand", "timestamp"]),
+        ("index", "post_queue", "idx_post_queue_status_timestamp", ["status", "timestamp"]),
+        ("index", "post_queue", "idx_post_queue_user_batch", ["user_id", "batch_id"]),
+        ("index", "post_queue", "idx_post_queue_user_message", ["user_id", "message_id"]),
+        ("index", "pending_photos", "idx_pending_photos_user_created", ["user_id", "created_at"]),
+        ("index", "pending_photos", "idx_pending_photos_user_batch", ["user_id", "batch_id"]),
+        ("index", "forwarded_posts", "idx_forwarded_posts_message_id", ["message_id"]),
+        ("index", "forwarded_posts", "idx_forwarded_posts_user_timestamp", ["user_id", "timestamp"]),
+        ("index", "photo_hashes", "idx_photo_hashes_bot_created", ["bot_name", "created_at"]),
+        ("index", "photo_hashes", "idx_photo_hashes_client_message", ["client_message_id"])
+    ]),
+    (3, "posts archive table", [
+        ("table_like", "posts_archive", "posts"),
+        ("index", "posts", "idx_posts_timestamp", ["timestamp"])
+    ]),
+    (4, "post_deliveries", [
+        "CREATE TABLE IF NOT EXISTS post_deliveries ("
+        "id INT AUTO_INCREMENT PRIMARY KEY, "
+        "client_message_id BIGINT NOT NULL, "
+        "chat_id BIGINT NOT NULL, "
+        "buyer_group VARCHAR(255), "
+        "message_id BIGINT, "
+        "album_size INT NOT NULL DEFAULT 1, "
+        "status VARCHAR(16) NOT NULL DEFAULT 'sent', "
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        ("index", "post_deliveries", "idx_post_deliveries_client_message", ["client_message_id", "status"]),
+        ("index", "post_deliveries", "idx_post_deliveries_chat_message", ["chat_id", "message_id"]),
+        lambda db: _backfill_post_deliveries(db)
+    ]),
+    (5, "posts caption", [
+        ("column", "posts", "caption", "TEXT"),
+        ("column", "posts_archive", "caption", "TEXT"),
+        ("index", "posts", "idx_posts_bot_brand", ["bot_name", "brand"])
+    ]),
+    (6, "post_deliveries keyed by client chat", [
+        ("column", "post_deliveries", "client_chat_id", "BIGINT"),
+        # Rows logged before this migration only carry the message id; where two chats reused it the rows were already mixed
+        "UPDATE post_deliveries SET client_chat_id = COALESCE("
+        "(SELECT MAX(p.client_chat_id) FROM posts p WHERE p.client_message_id = post_deliveries.client_message_id), "
+        "(SELECT MAX(a.client_chat_id) FROM posts_archive a WHERE a.client_message_id = post_deliveries.client_message_id)) "
+        "WHERE client_chat_id IS NULL",
+        ("index", "post_deliveries", "idx_post_deliveries_client_chat_message", ["client_chat_id", "client_message_id", "status"])
+    ]),
+    (7, "photo_hashes keyed by client chat", [
+        ("column", "photo_hashes", "client_chat_id", "BIGINT"),
+        "UPDATE photo_hashes SET client_chat_id = COALESCE("
+        "(SELECT MAX(p.client_chat_id) FROM posts p WHERE p.bot_name = photo_hashes.bot_name AND p.client_message_id = photo_hashes.client_message_id), "
+        "(SELECT MAX(a.client_chat_id) FROM posts_archive a WHERE a.bot_name = photo_hashes.bot_name AND a.client_message_id = photo_hashes.client_message_id)) "
+        "WHERE client_chat_id IS NULL",
+        ("index", "photo_hashes", "idx_photo_hashes_client_chat_message", ["client_chat_id", "client_message_id"])
+    ])
+]
+
+def _ensure_migrations_table(db):
+    db.cursor.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INT PRIMARY KEY, "
+        "name VARCHAR(255) NOT NULL, "
+        "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+    )
+    db.conn.commit()
+
+def applied_versions(db):
+    _ensure_migrations_table(db)
+    db.cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in db.cursor.fetchall()}
+
+def _index_exists(db, table, index_name):
+    return db.backend.index_exists(db.cursor, table, index_name)
+
+def _column_exists(db, table, column):
+    return db.backend.column_exists(db.cursor, table, column)
+
+def _backfill_post_deliveries(db):
+    # Legacy buyer_message_ids are positional in the bot's forward_to_buyers list; that order is the best mapping we have
+    moved = 0
+    for table in ("posts", "posts_archive"):
+        db.cursor.execute(
+            f"SELECT bot_name, client_message_id, buyer_message_ids, photo_ids FROM {table} "
+            "WHERE buyer_message_ids IS NOT NULL AND buyer_message_ids <> '' AND client_message_id IS NOT NULL"
+        )
+        for bot_name, client_message_id, buyer_message_ids, photo_ids in db.cursor.fetchall():
+            buyer_groups = BOT_CONFIGS.get(bot_name, {}).get("forward_to_buyers", [])
+            album_size = len([pid for pid in (photo_ids or '').split(',') if pid])
+            deliveries = []
+            for buyer_group, buyer_message_id in zip(buyer_groups, buyer_message_ids.split(',')):
+                chat_id = db.get_group_info(buyer_group)
+                if chat_id and buyer_message_id.strip().isdigit():
+                    deliveries.append((client_message_id, chat_id, buyer_group, int(buyer_message_id), album_size, 'sent'))
+            if deliveries:
+                # Written in the version 4 table shape; migration 6 adds and fills client_chat_id
+                db.cursor.executemany(
+                    "INSERT INTO post_deliveries (client_message_id, chat_id, buyer_group, message_id, album_size, status) "
+                    "VALUES (%s, %s, %s, %s, %s, %s)",
+                    deliveries
+                )
+                moved += len(deliveries)
+    db.conn.commit()
+    print(f"DEBUG - Backfilled post_deliveries from buyer_message_ids: {moved}")
+
+def _apply_step(db, step):
+    if callable(step):
+        step(db)
+    elif isinstance(step, tuple) and step[0] == "index":
+        _, table, index_name, columns = step
+        if _index_exists(db, table, index_name):
+            print(f"DEBUG - Index already exists: {table}.{index_name}")
+            return
+        db.cursor.execute(f"CREATE INDEX {index_name} ON {table} ({', '.join(columns)})")
+    elif isinstance(step, tuple) and step[0] == "column":
+        _, table, column, definition = step
+        if _column_exists(db, table, column):
+            print(f"DEBUG - Column already exists: {table}.{column}")
+            return
+        db.cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    elif isinstance(step, tuple) and step[0] == "table_like":
+        _, table, source = step
+        db.backend.create_table_like(db.cursor, table, source)
+    else:
+        db.cursor.execute(step)
+
+def apply_migrations(db):
+    done = applied_versions(db)
+    applied = []
+    for version, name, steps in MIGRATIONS:
+        if version in done:
+            continue
+        print(f"DEBUG - Applying migration {version}: {name}")
+        for step in steps:
+            _apply_step(db, step)
+        db.cursor.execute(
+            "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+            (version, name)
+        )
+        db.conn.commit()
+        applied.append(version)
+    print(f"DEBUG - Schema up to date: applied={applied}")
+    return applied
+
+SQL_PREFIXES = ("SELECT", "INSERT", "UPDATE", "DELETE")
+
+def database_statements():
+    # Collect every literal SQL statement passed to a call inside a Database method
+    tree = ast.parse(inspect.getsource(database.Database))
+    statements = []
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        assigned = {}
+        for child in ast.walk(node):
+            if isinstance(child, ast.Assign) and isinstance(child.value, ast.Constant) and isinstance(child.value.value, str):
+                for target in child.targets:
+                    if isinstance(target, ast.Name):
+                        assigned[target.id] = child.value.value
+        for child in ast.walk(node):
+            if not isinstance(child, ast.Call):
+                continue
+            for arg in child.args:
+                if (isinstance(arg, ast.Call) and isinstance(arg.func, ast.Attribute) and arg.func.attr == "format"):
+                    arg = arg.func.value  # "... FROM {posts} ...".format(posts=table)
+                if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+                    sql = arg.value
+                elif isinstance(arg, ast.Name) and arg.id in assigned:
+                    sql = assigned[arg.id]
+                else:
+                    continue
+                if sql.lstrip().upper().startswith(SQL_PREFIXES):
+                    statements.append((node.name, sql))
+    return statements
+
+def audit_queries(db):
+    full_scans = 0
+    for method, sql in database_statements():
+        if not sql.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            continue
+        sql = sql.replace("{posts}", "posts")
+        params = tuple(0 for _ in range(sql.count('%s')))
+        try:
+            db.cursor.execute(db.backend.explain_prefix + sql, params)
+            columns = db.cursor.column_names
+            plan = [dict(zip(columns, row)) for row in db.cursor.fetchall()]
+        except Exception as e:
+            print(f"{method}: EXPLAIN failed: {e}")
+            continue
+        for row in plan:
+            if 'detail' in row:
+                # SQLite: "SCAN posts" reads the whole table, "SEARCH posts USING INDEX ..." does not
+                scan = str(row['detail']).startswith('SCAN')
+                print(f"{'FULL SCAN' if scan else 'ok':9} {method}: {row['detail']}")
+            else:
+                scan = row.get('type') in ('ALL', 'index')
+                print(f"{'FULL SCAN' if scan else 'ok':9} {method}: table={row.get('table')}, type={row.get('type')}, key={row.get('key')}, rows={row.get('rows')}")
+            full_scans += scan
+    print(f"Audit finished: {full_scans} full scans")
+    return full_scans
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    parser.add_argument("command", choices=["migrate", "status", "audit", "archive"])
+    args = parser.parse_args()
+    db = database.Database()
+    try:
+        if args.command == "migrate":
+            apply_migrations(db)
+        elif args.command == "status":
+            done = applied_versions(db)
+            for version, name, _ in MIGRATIONS:
+                print(f"{version:4} {'applied' if version in done else 'pending':8} {name}")
+        elif args.command == "archive":
+            db.archive_old_posts(ARCHIVE_CONFIG["hot_days"], ARCHIVE_CONFIG["batch_size"])
+        else:
+            audit_queries(db)
+    finally:
+        db.close()
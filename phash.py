@@ -0,0 +1,178 @@
+import asyncio
+import argparse
+import io
+import os
+import time
+from config import PHASH_CONFIG
+
+HASH_SIZE = 8
+
+def dhash(image_data):
+    from PIL import Image
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        # Let the JPEG decoder downscale while decoding; we only need a 9x8 thumbnail
+        image.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+        image = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+        pixels = list(image.getdata())
+        value = 0
+        for row in range(HASH_SIZE):
+            for col in range(HASH_SIZE):
+                left = pixels[row * (HASH_SIZE + 1) + col]
+                right = pixels[row * (HASH_SIZE + 1) + col + 1]
+                value = (value << 1) | (1 if left > right else 0)
+        return value
+    except Exception as e:
+        print(f"Debug - Error computing dhash: {e}")
+        return None
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def hash_to_hex(value):
+    return f"{value:016x}"
+
+def hex_to_hash(value):
+    return int(value, 16)
+
+class BKTree:
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        results = []
+        if self.root is None:
+            return results
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return results
+
+class PhotoHashIndex:
+    def __init__(self, max_distance=None, match_ratio=None, recent_days=None):
+        self.max_distance = max_distance if max_distance is not None else PHASH_CONFIG["max_distance"]
+        self.match_ratio = match_ratio if match_ratio is not None else PHASH_CONFIG["match_ratio"]
+        self.recent_seconds = (recent_days if recent_days is not None else PHASH_CONFIG["recent_days"]) * 86400
+        self.tree = BKTree()
+
+    def load(self, db, bot_name):
+        count = 0
+        for phash_hex, client_chat_id, client_message_id, created_at in db.get_recent_photo_hashes(bot_name, PHASH_CONFIG["recent_days"]):
+            added_at = created_at.timestamp() if hasattr(created_at, 'timestamp') else time.time()
+            self.tree.add(hex_to_hash(phash_hex), ((client_chat_id, client_message_id), added_at))
+            count += 1
+        print(f"DEBUG - Loaded photo hash index: bot_name={bot_name}, hashes={count}")
+
+    # Items are keyed by (client_chat_id, client_message_id): message ids are only unique within a chat
+    def add_post(self, client_chat_id, client_message_id, hashes):
+        now = time.time()
+        for value in hashes:
+            self.tree.add(value, ((client_chat_id, client_message_id), now))
+
+    def rekey(self, client_chat_id, client_message_id, new_client_message_id):
+        # Resending an album moves the post to a new message id; resends are rare, so a full walk is fine
+        moved = 0
+        stack = [self.tree.root] if self.tree.root else []
+        while stack:
+            node = stack.pop()
+            for i, (item_id, added_at) in enumerate(node[1]):
+                if item_id == (client_chat_id, client_message_id):
+                    node[1][i] = ((client_chat_id, new_client_message_id), added_at)
+                    moved += 1
+            stack.extend(node[2].values())
+        print(f"DEBUG - Rekeyed photo hashes: client_chat_id={client_chat_id}, client_message_id={client_message_id} -> {new_client_message_id}, hashes={moved}")
+        return moved
+
+    def find_match(self, hashes):
+        if not hashes:
+            return None
+        cutoff = time.time() - self.recent_seconds
+        votes = {}
+        for value in hashes:
+            matched = {item[0] for distance, item in self.tree.search(value, self.max_distance) if item[1] >= cutoff}
+            for post_key in matched:
+                votes[post_key] = votes.get(post_key, 0) + 1
+        if not votes:
+            return None
+        post_key, matched_count = max(votes.items(), key=lambda kv: kv[1])
+        if matched_count / len(hashes) >= self.match_ratio:
+            print(f"DEBUG - Perceptual hash match: client_chat_id={post_key[0]}, client_message_id={post_key[1]}, matched={matched_count}/{len(hashes)}")
+            return post_key
+        return None
+
+async def backfill(bot_name, concurrency=None, limit=None):
+    from aiogram import Bot
+    from config import BOT_TOKENS
+    from database import Database
+    from utils import download_photo, close_http_session
+
+    bot = Bot(token=BOT_TOKENS[bot_name])
+    db = Database()
+    semaphore = asyncio.Semaphore(concurrency or PHASH_CONFIG["backfill_concurrency"])
+    loop = asyncio.get_running_loop()
+
+    async def hash_photo(photo_id):
+        async with semaphore:
+            photo_data = await download_photo(photo_id, bot)
+        if not photo_data:
+            return None
+        return await loop.run_in_executor(None, dhash, photo_data)
+
+    async def hash_post(client_chat_id, client_message_id, photo_ids_str):
+        photo_ids = [pid for pid in (photo_ids_str or '').split(',') if db.is_valid_file_id(pid)]
+        hashes = await asyncio.gather(*(hash_photo(pid) for pid in photo_ids))
+        return client_chat_id, client_message_id, [h for h in hashes if h is not None]
+
+    started = time.time()
+    posts = db.get_posts_without_hashes(bot_name, limit)
+    print(f"Backfilling photo hashes: bot_name={bot_name}, posts={len(posts)}")
+    done = 0
+    chunk_size = 100
+    try:
+        for i in range(0, len(posts), chunk_size):
+            results = await asyncio.gather(*(hash_post(*post) for post in posts[i:i + chunk_size]))
+            for client_chat_id, client_message_id, hashes in results:
+                if hashes:
+                    db.log_photo_hashes(bot_name, client_chat_id, client_message_id, hashes)
+            done += len(results)
+            print(f"Backfilled {done}/{len(posts)} posts ({done / (time.time() - started):.1f} posts/s)")
+    finally:
+        await bot.session.close()
+        await close_http_session()
+        db.close()
+    print(f"Backfill finished: {done} posts in {time.time() - started:.1f}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Perceptual-hash index tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    fill = sub.add_parser("backfill", help="Compute hashes for existing posts")
+    fill.add_argument("--bot", default=os.getenv("BOT_NAME", "bella"))
+    fill.add_argument("--concurrency", type=int, default=None)
+    fill.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+    if args.command == "backfill":
+        asyncio.run(backfill(args.bot, args.concurrency, args.limit))
@@ -0,0 +1,92 @@
+import asyncio
+from metrics import metrics
+
+class Stage:
+    def __init__(self, name, handler, concurrency=1, maxsize=1):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue(maxsize)
+        self.active = 0
+        self.next_stage = None
+
+class PublishPipeline:
+    # prepare runs ahead as tasks; the first stage receives items in submission order and awaits their prepare task,
+    # so media for later posts is downloaded and rendered while earlier posts are still being sent
+    def __init__(self, prepare, stages, prepare_concurrency=2, on_error=None):
+        self.prepare = prepare
+        self.prepare_slots = asyncio.Semaphore(prepare_concurrency)
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+        self.on_error = on_error
+        self.in_flight = 0
+        self.preparing = 0
+        self.workers = []
+
+    @property
+    def idle(self):
+        return self.in_flight == 0
+
+    def start(self):
+        for stage in self.stages:
+            for _ in range(stage.concurrency):
+                self.workers.append(asyncio.create_task(self._work(stage)))
+        print(f"DEBUG - Publish pipeline started: stages={[(stage.name, stage.concurrency) for stage in self.stages]}")
+
+    async def submit(self, job):
+        self.in_flight += 1
+        await self.prepare_slots.acquire()
+        item = {'job': job, 'prepared': asyncio.create_task(self._prepare(job))}
+        await self._put(self.stages[0], item)
+
+    def depths(self):
+        depths = {stage.name: stage.queue.qsize() for stage in self.stages}
+        depths['preparing'] = self.preparing
+        return depths
+
+    async def _prepare(self, job):
+        self.preparing += 1
+        self._report()
+        try:
+            return await self.prepare(job)
+        finally:
+            self.preparing -= 1
+            self.prepare_slots.release()
+            self._report()
+
+    async def _put(self, stage, item):
+        await stage.queue.put(item)
+        self._report()
+
+    async def _work(self, stage):
+        while True:
+            item = await stage.queue.get()
+            self._report()
+            stage.active += 1
+            try:
+                result = await stage.handler(item)
+            except Exception as e:
+                print(f"DEBUG - Error in publish stage {stage.name}: {item['job']}, error={e}")
+                metrics.incr(f"pipeline.{stage.name}.errors")
+                result = None
+                if self.on_error:
+                    try:
+                        await self.on_error(item, e)
+                    except Exception as e:
+                        print(f"DEBUG - Error handling publish failure: {e}")
+            finally:
+                stage.active -= 1
+                stage.queue.task_done()
+            if result is not None and stage.next_stage:
+                await self._put(stage.next_stage, result)
+            else:
+                self.in_flight -= 1
+                self._report()
+
+    def _report(self):
+        for stage in self.stages:
+            metrics.set_gauge(f"pipeline.{stage.name}.depth", stage.queue.qsize())
+            metrics.set_gauge(f"pipeline.{stage.name}.active", stage.active)
+        metrics.set_gauge("pipeline.preparing", self.preparing)
+        metrics.set_gauge("pipeline.in_flight", self.in_flight)
@@ -0,0 +1,91 @@
+import time
+from collections import OrderedDict
+from config import POST_CACHE_CONFIG
+from metrics import metrics
+
+POST_COLUMNS = (
+    "brand", "price", "original_price", "photo_ids", "client_message_id", "client_chat_id", "client_topic_name",
+    "sizes", "buyer_message_ids", "message_id", "forward_from_message_id", "adjusted_price"
+)
+INDEXED_FIELDS = ("message_id", "client_message_id", "forward_from_message_id")
+
+class PostCache:
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size or POST_CACHE_CONFIG["max_size"]
+        self.ttl = ttl or POST_CACHE_CONFIG["ttl"]
+        self.records = OrderedDict()  # token -> (expires_at, record), least recently used first
+        self.index = {}  # (field, value) -> token
+        self._next_token = 0
+
+    def _unindex(self, token, record):
+        for field in INDEXED_FIELDS:
+            key = (field, record.get(field))
+            if self.index.get(key) == token:
+                del self.index[key]
+
+    def _drop(self, token):
+        entry = self.records.pop(token, None)
+        if entry:
+            self._unindex(token, entry[1])
+
+    def put(self, record):
+        for field in INDEXED_FIELDS:
+            if record.get(field) is not None:
+                old_token = self.index.get((field, record[field]))
+                if old_token is not None:
+                    self._drop(old_token)
+        token = self._next_token
+        self._next_token += 1
+        self.records[token] = (time.monotonic() + self.ttl, record)
+        for field in INDEXED_FIELDS:
+            if record.get(field) is not None:
+                self.index[(field, record[field])] = token
+        while len(self.records) > self.max_size:
+            oldest, _ = next(iter(self.records.items()))
+            self._drop(oldest)
+            metrics.incr("post_cache.evictions")
+        metrics.set_gauge("post_cache.size", len(self.records))
+
+    def put_row(self, row):
+        if row:
+            self.put(dict(zip(POST_COLUMNS, row)))
+
+    def get(self, field, value):
+        token = self.index.get((field, value))
+        entry = self.records.get(token) if token is not None else None
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._drop(token)
+            metrics.incr("post_cache.misses")
+            return None
+        self.records.move_to_end(token)
+        metrics.incr("post_cache.hits")
+        return entry[1]
+
+    def update(self, field, value, where=None, **changes):
+        # where: extra fields the cached record must match, e.g. the chat a message id belongs to
+        token = self.index.get((field, value))
+        entry = self.records.get(token) if token is not None else None
+        if entry is None:
+            return
+        record = entry[1]
+        if where and any(record.get(key) != expected for key, expected in where.items()):
+            return
+        self._unindex(token, record)
+        record.update(changes)
+        for indexed in INDEXED_FIELDS:
+            if record.get(indexed) is not None:
+                self.index[(indexed, record[indexed])] = token
+
+    def clear(self):
+        self.records.clear()
+        self.index.clear()
+        metrics.set_gauge("post_cache.size", 0)
+
+    def hit_rate(self):
+        hits = metrics.counters.get("post_cache.hits", 0)
+        total = hits + metrics.counters.get("post_cache.misses", 0)
+        return hits / total if total else 0.0
+
+def project(record, columns):
+    return tuple(record.get(column) for column in columns)
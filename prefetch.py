@@ -0,0 +1,72 @@
+import asyncio
+import time
+from collections import OrderedDict
+from metrics import metrics
+from config import PREFETCH_CONFIG
+
+class MediaPrefetcher:
+    def __init__(self, render, watermark_text, max_entries=None, ttl=None, concurrency=None):
+        self.render = render
+        self.watermark_text = watermark_text
+        self.max_entries = max_entries or PREFETCH_CONFIG["max_entries"]
+        self.ttl = ttl or PREFETCH_CONFIG["ttl"]
+        self.slots = asyncio.Semaphore(concurrency or PREFETCH_CONFIG["concurrency"])
+        self.entries = OrderedDict()  # photo_id -> (task, created_at)
+
+    def prefetch(self, photo_ids):
+        for photo_id in photo_ids:
+            if photo_id in self.entries:
+                continue
+            self.entries[photo_id] = (asyncio.create_task(self._render(photo_id)), time.time())
+            metrics.incr("prefetch.started")
+        while len(self.entries) > self.max_entries:
+            photo_id, (task, _) = self.entries.popitem(last=False)
+            task.cancel()
+            metrics.incr("prefetch.evicted")
+        metrics.set_gauge("prefetch.entries", len(self.entries))
+
+    async def take(self, photo_id, watermark_text):
+        if watermark_text != self.watermark_text:
+            return None
+        entry = self.entries.pop(photo_id, None)
+        metrics.set_gauge("prefetch.entries", len(self.entries))
+        if not entry:
+            metrics.incr("prefetch.miss")
+            return None
+        try:
+            result = await entry[0]
+        except (asyncio.CancelledError, Exception) as e:
+            print(f"DEBUG - Prefetch unusable: photo_id={photo_id}, error={e!r}")
+            metrics.incr("prefetch.miss")
+            return None
+        metrics.incr("prefetch.hit")
+        return result
+
+    def expire(self):
+        # Photos that never got a caption are dropped once they outlive the TTL
+        cutoff = time.time() - self.ttl
+        expired = [photo_id for photo_id, (_, created_at) in self.entries.items() if created_at < cutoff]
+        for photo_id in expired:
+            task, _ = self.entries.pop(photo_id)
+            task.cancel()
+        if expired:
+            metrics.incr("prefetch.expired", len(expired))
+            metrics.set_gauge("prefetch.entries", len(self.entries))
+            print(f"DEBUG - Expired prefetched photos: {len(expired)}")
+        return len(expired)
+
+    async def run_expiry(self):
+        while True:
+            await asyncio.sleep(min(self.ttl, 60))
+            self.expire()
+
+    async def _render(self, photo_id):
+        async with self.slots:
+            render = asyncio.ensure_future(self.render(photo_id, self.watermark_text))
+            try:
+                return await asyncio.shield(render)
+            except asyncio.CancelledError:
+                # Rendering runs on a worker thread that cancellation can't stop; keep the slot until it
+                # finishes so evicted prefetches don't pile extra renders onto the executor
+                await asyncio.wait([render])
+                raise
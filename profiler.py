@@ -0,0 +1,178 @@
+import asyncio
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from config import PROFILER_CONFIG
+
+class ProfileCapture:
+    # Nothing is hooked while idle: the sampler thread, the task sampler and tracemalloc only exist for the
+    # duration of a capture, and post_done() is a single attribute check on the hot path
+    def __init__(self, config=None):
+        self.config = config or PROFILER_CONFIG
+        self.active = False
+        self.posts_left = None
+        self.done = None
+        self.loop_thread_id = None
+
+    def busy(self):
+        return self.active
+
+    def post_done(self):
+        if self.active and self.posts_left is not None:
+            self.posts_left -= 1
+            if self.posts_left <= 0:
+                self.done.set()
+
+    async def run(self, seconds=None, posts=None, mode="sample", memory=False, label="manual"):
+        if self.active:
+            raise RuntimeError("profile capture already running")
+        self.active = True
+        try:
+            return await self._capture(seconds, posts, mode, memory, label)
+        finally:
+            # Also reached when setup fails (output dir, tracemalloc), so the next capture is not refused forever
+            self.active = False
+            self.posts_left = None
+
+    async def _capture(self, seconds, posts, mode, memory, label):
+        self.posts_left = posts
+        self.done = asyncio.Event()
+        self.loop_thread_id = threading.get_ident()
+        seconds = min(seconds or self.config["default_seconds"], self.config["max_seconds"])
+        os.makedirs(self.config["output_dir"], exist_ok=True)
+        base = os.path.join(self.config["output_dir"], f"{time.strftime('%Y%m%d-%H%M%S')}-{label}")
+        cpu_stacks, task_stacks = Counter(), Counter()
+        stopped = threading.Event()
+        profile = None
+        sampler = None
+        tracing_memory = memory and not tracemalloc.is_tracing()
+        if tracing_memory:
+            tracemalloc.start(self.config["tracemalloc_frames"])
+        before = tracemalloc.take_snapshot() if memory else None
+        if mode == "cprofile":
+            # Deterministic profiling of everything running on the loop thread, higher overhead than sampling
+            profile = cProfile.Profile()
+            profile.enable()
+        else:
+            sampler = threading.Thread(target=self._sample_loop_thread, args=(cpu_stacks, stopped), name="profile-sampler", daemon=True)
+            sampler.start()
+        task_sampler = asyncio.create_task(self._sample_tasks(task_stacks))
+        print(f"DEBUG - Profile capture started: mode={mode}, seconds={seconds}, posts={posts}, memory={memory}")
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.done.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            elapsed = time.perf_counter() - started
+            task_sampler.cancel()
+            stopped.set()
+            if profile:
+                profile.disable()
+            if sampler:
+                sampler.join()
+            after = tracemalloc.take_snapshot() if memory else None
+            if tracing_memory:
+                tracemalloc.stop()
+            self.posts_left = None
+
+        files = []
+        if profile:
+            profile.dump_stats(base + ".pstats")
+            files.append(base + ".pstats")
+        if cpu_stacks:
+            files.append(self._write_collapsed(base + ".cpu.collapsed", cpu_stacks))
+        if task_stacks:
+            files.append(self._write_collapsed(base + ".tasks.collapsed", task_stacks))
+        lines = [f"Profile {label}: {elapsed:.1f}s, mode={mode}"]
+        if profile:
+            lines.extend(self._top_functions(profile))
+        elif cpu_stacks:
+            lines.extend(self._top_frames(cpu_stacks, "on-CPU (loop thread)"))
+        if task_stacks:
+            lines.extend(self._top_frames(task_stacks, "awaiting (tasks)"))
+        if memory:
+            memory_lines = self._memory_diff(before, after)
+            with open(base + ".memory.txt", 'w', encoding='utf-8') as f:
+                f.write('\n'.join(memory_lines) + '\n')
+            files.append(base + ".memory.txt")
+            lines.extend(memory_lines[:self.config["top"] + 1])
+        lines.append("Files: " + ', '.join(files) if files else "Files: none")
+        report = '\n'.join(lines)
+        print(report)
+        return report
+
+    def _sample_loop_thread(self, stacks, stopped):
+        interval = self.config["sample_interval"]
+        while not stopped.wait(interval):
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                stacks[self._collapse(frame)] += 1
+
+    async def _sample_tasks(self, stacks):
+        # Where each pending task is suspended, i.e. wall-clock time spent waiting rather than on CPU
+        current = asyncio.current_task()
+        while True:
+            await asyncio.sleep(self.config["task_sample_interval"])
+            for task in asyncio.all_tasks():
+                if task is current or task.done():
+                    continue
+                frames = task.get_stack(limit=self.config["stack_depth"])
+                if frames:
+                    stacks[task.get_coro().__qualname__ + ';' + ';'.join(self._frame_name(f) for f in frames)] += 1
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None and len(names) < self.config["stack_depth"]:
+            names.append(self._frame_name(frame))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    @staticmethod
+    def _frame_name(frame):
+        return f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+
+    @staticmethod
+    def _write_collapsed(path, stacks):
+        # Brendan Gregg's folded format, consumable by flamegraph.pl and speedscope
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def _top_frames(self, stacks, title):
+        total = sum(stacks.values())
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        lines = [f"Top {title}, {total} samples:"]
+        for name, count in leaves.most_common(self.config["top"]):
+            lines.append(f"  {count / total:6.1%} {name}")
+        return lines
+
+    def _top_functions(self, profile):
+        stats = pstats.Stats(profile)
+        rows = sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)[:self.config["top"]]
+        lines = ["Top functions by cumulative time:"]
+        for (filename, lineno, name), (_, calls, tottime, cumtime, _) in rows:
+            lines.append(f"  {cumtime:8.3f}s cum {tottime:8.3f}s own {calls:>7} calls {name} ({os.path.basename(filename)}:{lineno})")
+        return lines
+
+    def _memory_diff(self, before, after):
+        own = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        diff = after.filter_traces(own).compare_to(before.filter_traces(own), 'traceback')
+        growth = sum(stat.size_diff for stat in diff)
+        lines = [f"Memory growth: {growth / 1024:+.1f} KiB"]
+        for stat in diff[:self.config["top"]]:
+            if stat.size_diff == 0:
+                break
+            frame = stat.traceback[0]
+            lines.append(f"  {stat.size_diff / 1024:+9.1f} KiB {stat.count_diff:+6} blocks {os.path.basename(frame.filename)}:{frame.lineno}")
+        return lines
+
+profile_capture = ProfileCapture()
@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from datetime import datetime
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from config import BOT_TOKENS, REPRICE_CONFIG, contact_url
+from database import Database
+from utils import adjust_price, parse_caption, update_caption_price_and_percentage
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class RepricingCampaign:
+    def __init__(self, bot, db, bot_name, percentage, brand=None, since=None, until=None, include_archive=False,
+                 allow_bare_captions=False, checkpoint_path=None):
+        if not re.fullmatch(r'[-+]\d+%', percentage):
+            raise ValueError(f"Invalid percentage: {percentage}")
+        self.bot = bot
+        self.db = db
+        self.bot_name = bot_name
+        self.percentage = percentage
+        self.brand = brand
+        self.since = since
+        self.until = until
+        self.tables = ['posts', 'posts_archive'] if include_archive else ['posts']
+        self.allow_bare_captions = allow_bare_captions
+        self.checkpoint_path = checkpoint_path or self.default_checkpoint_path()
+        self.global_bucket = TokenBucket(REPRICE_CONFIG["global_rate"], REPRICE_CONFIG["burst"])
+        self.chat_buckets = {}
+        self.keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Написать", url=contact_url)]])
+        self.state = self.load_checkpoint()
+
+    def params(self):
+        return {
+            "bot": self.bot_name, "percentage": self.percentage, "brand": self.brand,
+            "since": str(self.since) if self.since else None, "until": str(self.until) if self.until else None,
+            "tables": self.tables
+        }
+
+    def default_checkpoint_path(self):
+        key = hashlib.sha1(json.dumps(self.params(), sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(REPRICE_CONFIG["checkpoint_dir"], f"{self.bot_name}-{key}.json")
+
+    def load_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get("params") == self.params():
+                print(f"DEBUG - Resuming repricing from checkpoint: {self.checkpoint_path}, cursor={state['cursor']}")
+                return state
+            print(f"DEBUG - Checkpoint parameters differ, starting over: {self.checkpoint_path}")
+        return {
+            "params": self.params(),
+            "cursor": {table: 0 for table in self.tables},
+            "edited": 0, "failed": 0, "skipped": 0, "buyer_edits": 0, "buyer_failed": 0,
+            "done": False, "started_at": time.time()
+        }
+
+    def save_checkpoint(self):
+        self.state["updated_at"] = time.time()
+        os.makedirs(os.path.dirname(self.checkpoint_path) or '.', exist_ok=True)
+        tmp = self.checkpoint_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.checkpoint_path)
+
+    async def edit_caption(self, chat_id, message_id, caption, reply_markup=None):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(REPRICE_CONFIG["per_chat_rate"], REPRICE_CONFIG["burst"])
+        await bucket.acquire()
+        await self.global_bucket.acquire()
+        for attempt in range(3):
+            try:
+                await self.bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=caption, reply_markup=reply_markup)
+                return True
+            except TelegramRetryAfter as e:
+                print(f"DEBUG - Repricing rate limited, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e).lower():
+                    return True
+                print(f"DEBUG - Repricing edit failed: chat_id={chat_id}, message_id={message_id}, error={e}")
+                return False
+        return False
+
+    async def reprice_post(self, row):
+        post_id, brand, original_price, photo_ids, client_message_id, client_chat_id, caption = row
+        if not original_price or (not caption and not self.allow_bare_captions):
+            self.state["skipped"] += 1
+            return None
+        currency = parse_caption(caption)[2] if caption else '€'
+        client_price, client_percentage, currency = adjust_price(f"{original_price}{currency} {self.percentage}")
+        buyer_price = int(original_price)
+        client_caption = update_caption_price_and_percentage(caption, client_price, client_percentage, currency, brand)
+        album = len([pid for pid in (photo_ids or '').split(',') if pid]) > 1
+        if album:
+            client_caption = f"{client_caption}\nНаписать: {contact_url}"[:1024]
+        if not await self.edit_caption(client_chat_id, client_message_id, client_caption, None if album else self.keyboard):
+            self.state["failed"] += 1
+            return None
+
+        buyer_caption = update_caption_price_and_percentage(caption, buyer_price, self.percentage, currency, brand)
+        deliveries = self.db.get_deliveries(client_chat_id, client_message_id)
+        results = await asyncio.gather(*(
+            self.edit_caption(chat_id, buyer_message_id, buyer_caption)
+            for _, chat_id, _, buyer_message_id, _ in deliveries
+        ))
+        self.state["buyer_edits"] += sum(1 for ok in results if ok)
+        self.state["buyer_failed"] += sum(1 for ok in results if not ok)
+        self.state["edited"] += 1
+        return client_price, client_percentage, client_chat_id, client_message_id
+
+    async def run(self, progress=None):
+        if self.state["done"]:
+            print(f"DEBUG - Repricing campaign already finished: {self.checkpoint_path}")
+            return self.state
+        started = time.perf_counter()
+        for table in self.tables:
+            while True:
+                rows = self.db.get_reprice_candidates(
+                    table, self.bot_name, self.brand, self.since, self.until,
+                    self.state["cursor"][table], REPRICE_CONFIG["batch_size"]
+                )
+                if not rows:
+                    break
+                updates = [update for update in await asyncio.gather(*(self.reprice_post(row) for row in rows)) if update]
+                if updates:
+                    self.db.update_post_prices(updates)
+                # The cursor only moves after the batch is committed, so a crash repeats at most one batch of edits
+                self.state["cursor"][table] = rows[-1][0]
+                self.save_checkpoint()
+                print(f"DEBUG - Repricing progress: table={table}, cursor={rows[-1][0]}, edited={self.state['edited']}, failed={self.state['failed']}, skipped={self.state['skipped']}")
+                if progress:
+                    await progress(self.state)
+        self.state["done"] = True
+        self.save_checkpoint()
+        elapsed = time.perf_counter() - started
+        print(f"Repricing finished in {elapsed:.1f}s: edited={self.state['edited']}, failed={self.state['failed']}, skipped={self.state['skipped']}, buyer_edits={self.state['buyer_edits']}, buyer_failed={self.state['buyer_failed']}")
+        return self.state
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d") if value else None
+
+async def main(args):
+    db = Database()
+    bot = Bot(token=BOT_TOKENS[args.bot])
+    brand = None
+    if args.brand:
+        brand, _, _ = db.get_corrected_brand(args.brand.lower())
+        if brand == "Unknown":
+            print(f"Unknown brand: {args.brand}")
+            return
+    try:
+        campaign = RepricingCampaign(
+            bot, db, args.bot, args.percent, brand=brand, since=parse_date(args.since), until=parse_date(args.until),
+            include_archive=args.include_archive, allow_bare_captions=args.allow_bare_captions, checkpoint_path=args.checkpoint
+        )
+        state = await campaign.run()
+        if state["edited"]:
+            # This process has its own post cache; a running bot keeps serving the old prices until it drops them
+            print(f"Note: restart the running {args.bot} bot or send it SIGUSR2 to drop cached posts with old prices (/reprice in the bot avoids this)")
+    finally:
+        await bot.session.close()
+        db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Reprice published posts by brand and/or date range",
+        epilog="A running bot caches posts for hours: restart it or send it SIGUSR2 afterwards, or use /reprice in the bot instead"
+    )
+    parser.add_argument("--bot", default="bella", choices=list(BOT_TOKENS.keys()))
+    parser.add_argument("--percent", required=True, help="new percentage relative to the original price, e.g. -30%%")
+    parser.add_argument("--brand", default=None)
+    parser.add_argument("--since", default=None, help="YYYY-MM-DD")
+    parser.add_argument("--until", default=None, help="YYYY-MM-DD")
+    parser.add_argument("--include-archive", action="store_true")
+    parser.add_argument("--allow-bare-captions", action="store_true", help="rebuild captions of posts logged without one from brand and price")
+    parser.add_argument("--checkpoint", default=None)
+    asyncio.run(main(parser.parse_args()))
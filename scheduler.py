@@ -0,0 +1,103 @@
+from collections import deque
+from config import SCHEDULER_CONFIG
+
+PRIORITY_UPDATE = 0
+PRIORITY_NEW = 1
+
+class FairScheduler:
+    def __init__(self, db, quantum=None, default_post_seconds=None):
+        self.db = db
+        self.quantum = quantum or SCHEDULER_CONFIG["quantum"]
+        self.avg_post_seconds = float(default_post_seconds or SCHEDULER_CONFIG["default_post_seconds"])
+        self.rings = {}  # priority -> deque of active user_ids
+        self.deficits = {}  # (priority, user_id) -> remaining deficit
+        self.granted = set()  # (priority, user_id) that already received a quantum on this visit
+
+    @staticmethod
+    def priority_of(post):
+        forward_from_message_id = post[6]
+        if SCHEDULER_CONFIG["prioritize_updates"] and forward_from_message_id:
+            return PRIORITY_UPDATE
+        return PRIORITY_NEW
+
+    @staticmethod
+    def cost_of(post):
+        return max(post[3] or 1, 1)
+
+    def _snapshot(self):
+        pending = {}
+        for post in self.db.get_pending_queue_posts():
+            users = pending.setdefault(self.priority_of(post), {})
+            users.setdefault(post[1], []).append(post)
+        return pending
+
+    def _sync_ring(self, priority, users, rings, deficits, granted):
+        ring = rings.setdefault(priority, deque())
+        for user_id in list(ring):
+            if user_id not in users:
+                ring.remove(user_id)
+                deficits.pop((priority, user_id), None)
+                granted.discard((priority, user_id))
+        for user_id in users:
+            if user_id not in ring:
+                ring.append(user_id)
+                deficits[(priority, user_id)] = 0
+        return ring
+
+    def _pick(self, pending, rings, deficits, granted):
+        for priority in sorted(pending):
+            users = pending[priority]
+            if not users:
+                continue
+            ring = self._sync_ring(priority, users, rings, deficits, granted)
+            while True:
+                user_id = ring[0]
+                key = (priority, user_id)
+                post = users[user_id][0]
+                if key not in granted:
+                    deficits[key] += self.quantum
+                    granted.add(key)
+                if deficits[key] >= self.cost_of(post):
+                    deficits[key] -= self.cost_of(post)
+                    users[user_id].pop(0)
+                    if not users[user_id]:
+                        del users[user_id]
+                        ring.popleft()
+                        deficits.pop(key, None)
+                        granted.discard(key)
+                    return post
+                granted.discard(key)
+                ring.rotate(-1)
+        return None
+
+    def next_post(self):
+        post = self._pick(self._snapshot(), self.rings, self.deficits, self.granted)
+        if post:
+            print(f"DEBUG - Scheduler picked post: post_id={post[0]}, user_id={post[1]}, priority={self.priority_of(post)}")
+        return post
+
+    def record_duration(self, seconds):
+        # Exponential moving average of the time one post occupies the worker
+        self.avg_post_seconds = 0.8 * self.avg_post_seconds + 0.2 * seconds
+
+    def queue_positions(self, user_id=None):
+        pending = self._snapshot()
+        rings = {priority: deque(ring) for priority, ring in self.rings.items()}
+        deficits = dict(self.deficits)
+        granted = set(self.granted)
+        positions = []
+        position = 0
+        while True:
+            post = self._pick(pending, rings, deficits, granted)
+            if not post:
+                break
+            if user_id is None or post[1] == user_id:
+                positions.append((post[0], position, position * self.avg_post_seconds))
+            position += 1
+        return positions
+
+    def queue_position(self, post_id):
+        for queued_post_id, position, wait_seconds in self.queue_positions():
+            if queued_post_id == post_id:
+                return position, wait_seconds
+        return None
@@ -0,0 +1,137 @@
+import os
+import re
+import sqlite3
+from config import STORAGE_CONFIG, MYSQL_CONFIG, SQLITE_CONFIG
+
+try:
+    import mysql.connector
+except ImportError:  # SQLite-only deployments don't need the MySQL driver
+    mysql = None
+
+# Database methods catch this instead of a driver-specific exception class
+DatabaseError = (sqlite3.Error,) + ((mysql.connector.Error,) if mysql else ())
+
+class MySQLBackend:
+    name = "mysql"
+    prepared_statements = True
+    explain_prefix = "EXPLAIN "
+
+    def __init__(self, config=None):
+        self.config = config or MYSQL_CONFIG
+
+    def connect(self):
+        if mysql is None:
+            raise RuntimeError("mysql-connector-python is not installed, set STORAGE_BACKEND=sqlite or install it")
+        return mysql.connector.connect(**self.config)
+
+    def translate(self, sql):
+        return sql
+
+    def index_exists(self, cursor, table, index_name):
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s",
+            (table, index_name)
+        )
+        return cursor.fetchone()[0] > 0
+
+    def column_exists(self, cursor, table, column):
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.columns "
+            "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s",
+            (table, column)
+        )
+        return cursor.fetchone()[0] > 0
+
+    def create_table_like(self, cursor, table, source):
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} LIKE {source}")
+
+# Applied in order; the statements in database.py and migrations.py are written for MySQL
+SQLITE_REWRITES = [
+    (re.compile(r'\bINT AUTO_INCREMENT PRIMARY KEY\b', re.I), 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+    (re.compile(r'\bDATETIME\b'), 'TIMESTAMP'),
+    (re.compile(r'\bDEFAULT CURRENT_TIMESTAMP\b', re.I), "DEFAULT (datetime('now', 'localtime'))"),
+    # MySQL's default collation compares names case-insensitively
+    (re.compile(r'\b((?:VAR)?CHAR\(\d+\))(?! COLLATE)', re.I), r'\1 COLLATE NOCASE'),
+    (re.compile(r'\bNOW\(\) - INTERVAL %s (DAY|HOUR|MINUTE|SECOND)\b', re.I),
+     lambda m: f"datetime('now', 'localtime', '-' || %s || ' {m.group(1).lower()}s')"),
+    (re.compile(r'\bNOW\(\) - INTERVAL (\d+) (DAY|HOUR|MINUTE|SECOND)\b', re.I),
+     lambda m: f"datetime('now', 'localtime', '-{m.group(1)} {m.group(2).lower()}s')"),
+    (re.compile(r'\bNOW\(\)', re.I), "datetime('now', 'localtime')"),
+    (re.compile(r'\bINSERT IGNORE\b', re.I), 'INSERT OR IGNORE'),
+    (re.compile(r'%s'), '?')
+]
+
+class SQLiteBackend:
+    name = "sqlite"
+    prepared_statements = False  # sqlite3 keeps its own per-connection statement cache
+    explain_prefix = "EXPLAIN QUERY PLAN "
+
+    def __init__(self, config=None):
+        self.config = config or SQLITE_CONFIG
+        self.translated = {}
+
+    def connect(self):
+        path = self.config["path"]
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(
+            path,
+            timeout=self.config["busy_timeout"],
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=self.config["cached_statements"]
+        )
+        # WAL lets the CLI tools read while the bot writes; NORMAL only fsyncs at checkpoints
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.config['synchronous']}")
+        conn.execute(f"PRAGMA cache_size=-{self.config['cache_size_kb']}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        print(f"DEBUG - Opened SQLite database: path={path}, journal_mode=WAL, synchronous={self.config['synchronous']}")
+        return conn
+
+    def translate(self, sql):
+        translated = self.translated.get(sql)
+        if translated is None:
+            translated = sql
+            for pattern, replacement in SQLITE_REWRITES:
+                translated = pattern.sub(replacement, translated)
+            self.translated[sql] = translated
+        return translated
+
+    def index_exists(self, cursor, table, index_name):
+        cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s",
+            (table, index_name)
+        )
+        return cursor.fetchone()[0] > 0
+
+    def column_exists(self, cursor, table, column):
+        cursor.execute("SELECT COUNT(*) FROM pragma_table_info(%s) WHERE name = %s", (table, column))
+        return cursor.fetchone()[0] > 0
+
+    def create_table_like(self, cursor, table, source):
+        # Same columns, keys and indexes as the source, like MySQL's CREATE TABLE ... LIKE
+        cursor.execute("SELECT type, name, sql FROM sqlite_master WHERE tbl_name = %s AND sql IS NOT NULL", (source,))
+        objects = cursor.fetchall()
+        for kind, name, sql in objects:
+            if kind == "table":
+                cursor.execute(re.sub(
+                    r'^CREATE TABLE (IF NOT EXISTS )?["`]?\w+["`]?', f"CREATE TABLE IF NOT EXISTS {table}", sql, flags=re.I
+                ))
+        for kind, name, sql in objects:
+            if kind == "index":
+                cursor.execute(re.sub(
+                    r'^CREATE (UNIQUE )?INDEX (IF NOT EXISTS )?["`]?\w+["`]? ON ["`]?\w+["`]?',
+                    lambda m: f"CREATE {m.group(1) or ''}INDEX IF NOT EXISTS {table}_{name} ON {table}", sql, flags=re.I
+                ))
+
+BACKENDS = {
+    "mysql": MySQLBackend,
+    "sqlite": SQLiteBackend
+}
+
+def create_backend(name=None):
+    name = name or STORAGE_CONFIG["backend"]
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown storage backend: {name}. Must be one of {list(BACKENDS.keys())}")
+    return BACKENDS[name]()
@@ -0,0 +1,205 @@
+import argparse
+import contextvars
+import glob
+import json
+import logging
+import random
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from config import TRACING_CONFIG
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+# Passed where no sampling decision has been made yet; None already means "decided not to sample"
+UNDECIDED = object()
+
+class Trace:
+    __slots__ = ('trace_id', 'started', 'started_at', 'spans', 'tags', 'last_id')
+
+    def __init__(self, tags):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self.tags = tags
+        self.last_id = 0
+
+    def reserve(self):
+        self.last_id += 1
+        return self.last_id
+
+    def add_span(self, name, started, ended, parent=None, span_id=None, **tags):
+        self.spans.append({
+            "id": span_id or self.reserve(),
+            "parent": parent,
+            "name": name,
+            "start_ms": round((started - self.started) * 1000, 2),
+            "duration_ms": round((ended - started) * 1000, 2),
+            "tags": tags
+        })
+
+    def tag(self, **tags):
+        self.tags.update({key: value for key, value in tags.items() if value is not None})
+
+class Tracer:
+    def __init__(self, config=None):
+        self.config = config or TRACING_CONFIG
+        self.sample_rate = self.config["sample_rate"]
+        self.parked = OrderedDict()  # batch_id -> (trace or None if not sampled, parked_at) while the post waits in post_queue
+        self.logger = None
+
+    def start(self, **tags):
+        if not self.config["enabled"] or random.random() >= self.sample_rate:
+            return None
+        return Trace({key: value for key, value in tags.items() if value is not None})
+
+    def park(self, key, trace):
+        # Unsampled posts are parked too, so resume() does not roll the dice a second time for them
+        if not self.config["enabled"]:
+            return
+        self.parked[key] = (trace, time.perf_counter())
+        while len(self.parked) > self.config["max_parked"]:
+            _, (dropped, _) = self.parked.popitem(last=False)
+            self.finish(dropped, status="dropped")
+
+    def resume(self, key, **tags):
+        entry = self.parked.pop(key, None)
+        if entry is None:
+            # Never went through queue_post in this process, e.g. a row recovered after a restart
+            return self.start(**tags)
+        trace, parked_at = entry
+        if trace is not None:
+            trace.add_span("queue_wait", parked_at, time.perf_counter(), batch_id=key)
+        return trace
+
+    def finish(self, trace, status="ok"):
+        if trace is None:
+            return
+        record = {
+            "trace_id": trace.trace_id,
+            "started_at": trace.started_at,
+            "duration_ms": round((time.perf_counter() - trace.started) * 1000, 2),
+            "status": status,
+            "tags": trace.tags,
+            "spans": trace.spans
+        }
+        try:
+            self._logger().info(json.dumps(record, ensure_ascii=False, default=str))
+        except Exception as e:
+            print(f"DEBUG - Error writing trace {trace.trace_id}: {e}")
+
+    def _logger(self):
+        if self.logger is None:
+            self.logger = logging.getLogger("post_traces")
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            handler = RotatingFileHandler(
+                self.config["path"], maxBytes=self.config["max_bytes"], backupCount=self.config["backup_count"], encoding='utf-8'
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+        return self.logger
+
+tracer = Tracer()
+
+@contextmanager
+def activate(trace):
+    trace_token = current_trace.set(trace)
+    span_token = current_span.set(None)
+    try:
+        yield trace
+    finally:
+        current_span.reset(span_token)
+        current_trace.reset(trace_token)
+
+@contextmanager
+def span(name, **tags):
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = current_span.get()
+    span_id = trace.reserve()
+    token = current_span.set(span_id)
+    started = time.perf_counter()
+    try:
+        yield span_id
+    finally:
+        current_span.reset(token)
+        trace.add_span(name, started, time.perf_counter(), parent=parent, span_id=span_id, **tags)
+
+def record_span(name, started, ended, **tags):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(name, started, ended, parent=current_span.get(), **tags)
+
+def tag_trace(**tags):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.tag(**tags)
+
+def load_traces(path):
+    traces = []
+    for file in sorted(glob.glob(path + '*')):
+        with open(file, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    traces.append(json.loads(line))
+    return traces
+
+def critical_path(spans, duration_ms):
+    # Walk backwards from the end: at each level the span that finishes last is the one the rest waited on
+    children = defaultdict(list)
+    for s in spans:
+        children[s["parent"]].append(s)
+
+    def walk(parent, start, end):
+        path = []
+        t = end
+        while True:
+            candidates = [s for s in children[parent]
+                          if s["start_ms"] >= start - 0.01 and s["start_ms"] + s["duration_ms"] <= t + 0.01 and s not in path]
+            if not candidates:
+                return path
+            s = max(candidates, key=lambda s: s["start_ms"] + s["duration_ms"])
+            path = [s] + walk(s["id"], s["start_ms"], s["start_ms"] + s["duration_ms"]) + path
+            t = s["start_ms"]
+
+    return walk(None, 0, duration_ms)
+
+def format_trace(trace, width=40):
+    duration = trace["duration_ms"] or 1
+    tags = ', '.join(f"{key}={value}" for key, value in trace["tags"].items())
+    lines = [f"Trace {trace['trace_id']} {trace['duration_ms'] / 1000:.2f}s status={trace['status']} {tags}"]
+    depth = {None: -1}
+    for s in sorted(trace["spans"], key=lambda s: (s["start_ms"], s["id"])):
+        depth[s["id"]] = depth.get(s["parent"], -1) + 1
+    for s in sorted(trace["spans"], key=lambda s: (s["start_ms"], s["id"])):
+        offset = int(s["start_ms"] / duration * width)
+        length = max(int(s["duration_ms"] / duration * width), 1)
+        bar = ' ' * offset + '#' * min(length, width - offset)
+        name = '  ' * depth[s["id"]] + s["name"]
+        span_tags = ' '.join(f"{key}={value}" for key, value in s["tags"].items())
+        lines.append(f"  {name:<32} |{bar:<{width}}| {s['start_ms']:>9.0f}ms +{s['duration_ms']:.0f}ms {span_tags}")
+    path = critical_path(trace["spans"], trace["duration_ms"])
+    lines.append("  critical path: " + " -> ".join(f"{s['name']} ({s['duration_ms']:.0f}ms)" for s in path))
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect per-post traces")
+    sub = parser.add_subparsers(dest="command", required=True)
+    slowest = sub.add_parser("slowest", help="print the slowest traces as waterfalls with their critical path")
+    slowest.add_argument("--file", default=TRACING_CONFIG["path"])
+    slowest.add_argument("--top", type=int, default=5)
+    slowest.add_argument("--status", default=None)
+    args = parser.parse_args()
+    if args.command == "slowest":
+        traces = [t for t in load_traces(args.file) if not args.status or t["status"] == args.status]
+        for trace in sorted(traces, key=lambda t: t["duration_ms"], reverse=True)[:args.top]:
+            print(format_trace(trace))
+            print()
+        print(f"{len(traces)} traces read from {args.file}*")
@@ -1,63 +1,115 @@
 import re
 import io
-from PIL import Image, ImageDraw, ImageFont
+import asyncio
+import importlib
+import threading
 import aiohttp
 from aiogram.types import BufferedInputFile
+from config import PHOTO_CONFIG
+
+# Pillow is imported on first use so bots that never watermark don't pay for it
+_watermark_font = None
+# Watermarks render on worker threads; FreeType faces are not safe to share between them
+_font_lock = threading.Lock()
+_http_session = None
+
+def http_session():
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession()
+    return _http_session
+
+async def close_http_session():
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+def watermark_font():
+    global _watermark_font
+    if _watermark_font is None:
+        from PIL import ImageFont
+        try:
+            _watermark_font = ImageFont.truetype("arial.ttf", 40)
+        except:
+            _watermark_font = ImageFont.load_default()
+    return _watermark_font
+
+def preload_watermark():
+    # Loads the modules add_watermark needs (and the JPEG decoder plugin) ahead of the first post
+    for module in ("PIL.Image", "PIL.ImageDraw", "PIL.JpegImagePlugin"):
+        importlib.import_module(module)
+    watermark_font()
 
 async def download_photo(file_id, bot):
     try:
         file = await bot.get_file(file_id)
         file_url = f"https://api.telegram.org/file/bot{bot.token}/{file.file_path}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as response:
-                if response.status == 200:
-                    return await response.read()
-                else:
-                    print(f"Debug - Failed to download photo: file_id={file_id}, status={response.status}")
-                    return None
+        async with http_session().get(file_url) as response:
+            if response.status == 200:
+                return await response.read()
+            else:
+                print(f"Debug - Failed to download photo: file_id={file_id}, status={response.status}")
+                return None
     except Exception as e:
         print(f"Debug - Error downloading photo: file_id={file_id}, error={e}")
         return None
 
 async def add_watermark(image_data, watermark_text):
+    # Decoding, compositing and JPEG encoding take tens of milliseconds per photo; keep them off the event loop
+    return await asyncio.to_thread(render_watermark, image_data, watermark_text)
+
+def render_watermark(image_data, watermark_text):
+    from PIL import Image, ImageDraw
     try:
-        image = Image.open(io.BytesIO(image_data)).convert("RGBA")
+        image = Image.open(io.BytesIO(image_data))
+        target = PHOTO_CONFIG["target_resolution"]
+        if max(image.size) > target:
+            image.draft('RGB', (target, target))
+            image.thumbnail((target, target), Image.LANCZOS)
+        image = image.convert("RGBA")
         txt = Image.new("RGBA", image.size, (255, 255, 255, 0))
         draw = ImageDraw.Draw(txt)
-        try:
-            font = ImageFont.truetype("arial.ttf", 40)
-        except:
-            font = ImageFont.load_default()
 
         width, height = image.size
-        text_bbox = draw.textbbox((0, 0), watermark_text, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
+        # The nine stamps are identical, so the text is drawn once and pasted at each position
+        with _font_lock:
+            font = watermark_font()
+            text_bbox = draw.textbbox((0, 0), watermark_text, font=font)
+            text_width = text_bbox[2] - text_bbox[0]
+            text_height = text_bbox[3] - text_bbox[1]
+            text_img = Image.new("RGBA", (text_width * 2, text_height * 2), (255, 255, 255, 0))
+            text_draw = ImageDraw.Draw(text_img)
+            text_draw.text((text_width // 2, text_height // 2), watermark_text, font=font, fill=(255, 255, 255, 110))
         step_x = width // 3
         step_y = height // 3
         rotation_angle = 45
+        rotated_text = text_img.rotate(rotation_angle, expand=True)
+        rotated_width, rotated_height = rotated_text.size
 
         for i in range(3):
             for j in range(3):
                 x = step_x * i + step_x // 2 - text_width // 2
                 y = step_y * j + step_y // 2 - text_height // 2
-                text_img = Image.new("RGBA", (text_width * 2, text_height * 2), (255, 255, 255, 0))
-                text_draw = ImageDraw.Draw(text_img)
-                text_draw.text((text_width // 2, text_height // 2), watermark_text, font=font, fill=(255, 255, 255, 110))
-                rotated_text = text_img.rotate(rotation_angle, expand=True)
-                rotated_width, rotated_height = rotated_text.size
                 paste_x = x + (text_width - rotated_width) // 2
                 paste_y = y + (text_height - rotated_height) // 2
                 txt.paste(rotated_text, (paste_x, paste_y), rotated_text)
 
         combined = Image.alpha_composite(image, txt)
-        output = io.BytesIO()
-        combined.convert('RGB').save(output, format="JPEG", quality=95)
-        return output.getvalue()
+        return encode_jpeg(combined.convert('RGB'))
     except Exception as e:
         print(f"Debug - Error adding watermark: {e}")
         return image_data
 
+def encode_jpeg(image):
+    quality = PHOTO_CONFIG["jpeg_quality"]
+    while True:
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True, progressive=PHOTO_CONFIG["progressive"])
+        size = output.tell()
+        if size <= PHOTO_CONFIG["max_bytes"] or quality <= PHOTO_CONFIG["min_jpeg_quality"]:
+            print(f"Debug - Encoded JPEG: size={image.size}, quality={quality}, bytes={size}")
+            return output.getvalue()
+        quality = max(quality - 5, PHOTO_CONFIG["min_jpeg_quality"])
+
 def adjust_price(description):
     print(f"Debug - Adjusting price for description: {description}")
     price_match = re.search(r'(\d+\.?\d*)\s*([€$])', description)
@@ -83,6 +135,55 @@ def adjust_price(description):
     print("Debug - No percentage, using original price")
     return original_price, None, currency
 
+def update_caption_price_and_percentage(caption, new_price, new_percentage, currency, brand=None):
+    if not caption:
+        return f"{brand or 'Unknown'} {new_price}{currency} {new_percentage}" if new_percentage else f"{brand or 'Unknown'} {new_price}{currency}"
+
+    price_pattern = r'(\d+\.?\d*)\s*([€$])'
+    percentage_pattern = r'([-+]\d+%?)'
+
+    brand_match = re.search(r'^\s*([A-Za-z\s&]+)(?:\s*[\W\s]*(?:\d+\.?\d*\s*[€$]|\s*$))?', caption, re.IGNORECASE)
+    original_brand = brand_match.group(1).strip() if brand_match else None
+
+    updated_caption = caption
+    price_match = re.search(price_pattern, caption)
+    if price_match:
+        old_price = price_match.group(1)
+        updated_caption = re.sub(
+            r'\b' + re.escape(old_price) + r'\s*' + re.escape(price_match.group(2)),
+            f"{new_price}{currency}",
+            updated_caption
+        )
+    else:
+        updated_caption = f"{updated_caption.strip()} {new_price}{currency}"
+
+    percentage_match = re.search(percentage_pattern, caption)
+    if percentage_match and new_percentage:
+        updated_caption = re.sub(
+            re.escape(percentage_match.group(0)),
+            new_percentage,
+            updated_caption
+        )
+    elif new_percentage:
+        updated_caption = f"{updated_caption.strip()} {new_percentage}"
+    elif percentage_match and not new_percentage:
+        updated_caption = re.sub(
+            re.escape(percentage_match.group(0)),
+            '',
+            updated_caption
+        ).strip()
+
+    if brand and original_brand and brand.lower() != original_brand.lower():
+        updated_caption = re.sub(
+            r'^\s*' + re.escape(original_brand) + r'\b',
+            brand,
+            updated_caption,
+            flags=re.IGNORECASE
+        )
+
+    updated_caption = updated_caption[:1024]
+    return updated_caption.strip()
+
 def extract_sizes(description):
     letter_size_pattern = r'\b(X{0,3}(?:XS|S|M|L|XL|XXL|XXXL))\b'
     numeric_size_pattern = r'\b(\d{1,2}(?:\.\d)?(?:-\d{1,2}(?:\.\d)?)?)\b'
@@ -91,13 +192,39 @@ def extract_sizes(description):
     sizes = [s for s in letter_sizes + numeric_sizes if not re.match(r'^-?\d+%$', s)]
     return ' '.join(sorted(sizes)) if sizes else None
 
-def select_unique_photos(photos):
+def parse_caption(description):
+    brand_match = re.search(r'^\s*([A-Za-z\s&]+)(?:\s*[\W\s]*(?:\d+\.?\d*\s*[€$]|\s*$))?', description, re.IGNORECASE)
+    brand = brand_match.group(1).strip() if brand_match else "Unknown"
+    price_match = re.search(r'(\d+\.?\d*)\s*([€$])', description)
+    price = float(price_match.group(1)) if price_match else None
+    currency = price_match.group(2) if price_match else '€'
+    sizes = extract_sizes(description)
+    percentage_match = re.search(r'([-+]\d+%?)', description)
+    original_percentage = percentage_match.group(0) if percentage_match else None
+    return brand, price, currency, sizes, original_percentage
+
+def select_unique_photos(photos, target_resolution=None):
     if not photos:
         return []
-    photo_groups = {}
+    target = PHOTO_CONFIG["target_resolution"] if target_resolution is None else target_resolution
+    variants = [photo for photo in photos if getattr(photo, 'file_id', None) and getattr(photo, 'width', None)]
+    if variants:
+        # message.photo holds size variants of one photo; every variant has its own file_unique_id,
+        # so file_unique_id only drops exact repeats and the variant is chosen by resolution
+        unique = {}
+        for photo in variants:
+            unique.setdefault(getattr(photo, 'file_unique_id', None) or photo.file_id, photo)
+        candidates = sorted(unique.values(), key=lambda photo: photo.width * photo.height)
+        for photo in candidates:
+            if max(photo.width, photo.height) >= target:
+                return [photo.file_id]
+        return [candidates[-1].file_id]
+    seen = set()
+    selected = []
     for photo in photos:
-        if hasattr(photo, 'file_id') and photo.file_id:
-            base_id = photo.file_id[:50]
-            if base_id not in photo_groups or (hasattr(photo, 'file_size') and photo.file_size and photo.file_size > (photo_groups[base_id].file_size or 0)):
-                photo_groups[base_id] = photo
-    return [photo.file_id for photo in photo_groups.values()]
\ No newline at end of file
+        if getattr(photo, 'file_id', None):
+            key = getattr(photo, 'file_unique_id', None) or photo.file_id
+            if key not in seen:
+                seen.add(key)
+                selected.append(photo.file_id)
+    return selected
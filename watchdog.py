@@ -0,0 +1,97 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from metrics import metrics
+from config import WATCHDOG_CONFIG
+
+class LoopWatchdog:
+    # A heartbeat coroutine measures how late the loop wakes it up; a sampling thread captures the loop thread's
+    # stack while the heartbeat is overdue, so blocking time can be pinned on the call site that held the loop
+    def __init__(self, threshold_ms=None, interval=None, sample_interval=None, attribute_files=None):
+        self.threshold_ms = threshold_ms or WATCHDOG_CONFIG["threshold_ms"]
+        self.interval = interval or WATCHDOG_CONFIG["interval"]
+        self.sample_interval = sample_interval or WATCHDOG_CONFIG["sample_interval"]
+        self.attribute_files = set(attribute_files or WATCHDOG_CONFIG["attribute_files"])
+        self.lock = threading.Lock()
+        self.samples = []  # (site, stack) captured by the sampling thread during the current stall
+        self.sites = {}  # site -> {"count", "total", "max", "stack"}, only touched on the loop thread
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        print(f"DEBUG - Loop watchdog started: threshold={self.threshold_ms}ms, interval={self.interval * 1000:.0f}ms")
+        return asyncio.create_task(self._heartbeat())
+
+    def stop(self):
+        self.stopped.set()
+
+    def attribute(self, stack):
+        for frame in reversed(stack):
+            if os.path.basename(frame.filename) in self.attribute_files:
+                return f"{os.path.basename(frame.filename)}:{frame.lineno} {frame.name}"
+        return "other"
+
+    def _watch(self):
+        while not self.stopped.wait(self.sample_interval):
+            stalled = time.monotonic() - self.last_beat - self.interval
+            if stalled * 1000 < self.threshold_ms:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            with self.lock:
+                self.samples.append((self.attribute(stack), stack))
+
+    async def _heartbeat(self):
+        while not self.stopped.is_set():
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_beat = now
+            lag = max(now - expected, 0.0)
+            metrics.observe("loop.lag", lag)
+            metrics.set_gauge("loop.lag_ms", round(lag * 1000, 1))
+            with self.lock:
+                samples, self.samples = self.samples, []
+            if lag * 1000 >= self.threshold_ms:
+                self._record_block(lag, samples)
+
+    def _record_block(self, lag, samples):
+        metrics.incr("loop.blocked")
+        if not samples:
+            samples = [("unsampled", None)]
+        counts = Counter(site for site, _ in samples)
+        stacks = {site: stack for site, stack in samples}
+        for site, count in counts.items():
+            # Blocking time is split between sites in proportion to how often they were on top of the stack
+            share = lag * count / len(samples)
+            metrics.observe(f"loop.blocked {site}", share)
+            entry = self.sites.setdefault(site, {"count": 0, "total": 0.0, "max": 0.0, "stack": None})
+            entry["count"] += 1
+            entry["total"] += share
+            entry["max"] = max(entry["max"], share)
+            entry["stack"] = stacks[site] or entry["stack"]
+        site, _ = counts.most_common(1)[0]
+        print(f"BLOCKED LOOP - {lag * 1000:.0f}ms, mostly in {site}")
+        if WATCHDOG_CONFIG["log_stacks"] and stacks[site]:
+            print(''.join(traceback.format_list(stacks[site][-WATCHDOG_CONFIG["stack_depth"]:])).rstrip())
+
+    def format_report(self, top=10):
+        lines = ["Loop watchdog report"]
+        ranked = sorted(self.sites.items(), key=lambda kv: kv[1]["total"], reverse=True)[:top]
+        for site, entry in ranked:
+            lines.append(f"  {site}: blocks={entry['count']}, total={entry['total'] * 1000:.0f}ms, max={entry['max'] * 1000:.0f}ms")
+        if len(lines) == 1:
+            lines.append("  no blocking above threshold")
+        return '\n'.join(lines)
+
+loop_watchdog = LoopWatchdog()
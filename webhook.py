@@ -0,0 +1,80 @@
+import asyncio
+import argparse
+import hashlib
+import json
+import aiohttp
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from config import BOT_TOKENS, WEBHOOK_CONFIG
+
+def webhook_path(bot_name):
+    return WEBHOOK_CONFIG["path"].format(bot_name=bot_name)
+
+def webhook_port(bot_name):
+    return WEBHOOK_CONFIG["port"] or WEBHOOK_CONFIG["ports"][bot_name]
+
+def webhook_secret(bot_name):
+    # Telegram only allows [A-Za-z0-9_-] in the secret token, so derive a per-bot hex digest
+    raw = f"{WEBHOOK_CONFIG['secret']}:{bot_name}:{BOT_TOKENS[bot_name]}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def build_webhook_app(bot, dp, bot_name):
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=webhook_secret(bot_name)
+    ).register(app, path=webhook_path(bot_name))
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook(bot, dp, bot_name):
+    app = build_webhook_app(bot, dp, bot_name)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = webhook_port(bot_name)
+    site = web.TCPSite(runner, WEBHOOK_CONFIG["host"], port)
+    await site.start()
+    print(f"DEBUG - Webhook server listening: host={WEBHOOK_CONFIG['host']}, port={port}, path={webhook_path(bot_name)}")
+    try:
+        if WEBHOOK_CONFIG["set_webhook"]:
+            url = WEBHOOK_CONFIG["base_url"].rstrip('/') + webhook_path(bot_name)
+            await bot.set_webhook(
+                url,
+                secret_token=webhook_secret(bot_name),
+                drop_pending_updates=WEBHOOK_CONFIG["drop_pending_updates"]
+            )
+            print(f"DEBUG - Webhook registered: url={url}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def replay_updates(path, bot_name, url=None, delay=0.0):
+    url = url or f"http://127.0.0.1:{webhook_port(bot_name)}{webhook_path(bot_name)}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": webhook_secret(bot_name)}
+    sent = 0
+    async with aiohttp.ClientSession() as session:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                update = json.loads(line)
+                async with session.post(url, json=update, headers=headers) as response:
+                    print(f"DEBUG - Replayed update: update_id={update.get('update_id')}, status={response.status}")
+                sent += 1
+                if delay:
+                    await asyncio.sleep(delay)
+    print(f"Replayed {sent} updates to {url}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Webhook tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    replay = sub.add_parser("replay", help="POST recorded updates (JSON lines) to a running webhook server")
+    replay.add_argument("file")
+    replay.add_argument("--bot", default="bella", choices=list(BOT_TOKENS.keys()))
+    replay.add_argument("--url", default=None)
+    replay.add_argument("--delay", type=float, default=0.0)
+    args = parser.parse_args()
+    if args.command == "replay":
+        asyncio.run(replay_updates(args.file, args.bot, args.url, args.delay))